@@ -15,6 +15,7 @@ setup(name='b-records',
       description='creates b-records for content-first',
       test_suite='b_records.tests',
       provides=['b_records'],
+      entry_points={'console_scripts': ['b-records=b_records.main:main']},
       maintainer="ait",
       maintainer_email="shm@dbc.dk",
       zip_safe=False)
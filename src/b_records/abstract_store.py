@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.abstract_store` -- Abstract store
+
+==============
+Abstract Store
+==============
+
+Local SQLite store of harvested abstracts.
+
+Each pid is stored with its abstract and the md5 hash LOWELL computes for
+it, so a harvest only has to fetch abstracts whose hash differs from the
+stored one. Pids that disappear from LOWELL are marked as deleted, and
+every harvest is recorded with its time and the number of added, changed
+and deleted pids.
+"""
+from datetime import datetime
+import logging
+import sqlite3
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS abstracts (pid TEXT PRIMARY KEY,
+                                      abstract TEXT NOT NULL,
+                                      hash TEXT NOT NULL,
+                                      updated TEXT NOT NULL,
+                                      deleted INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS harvests (id INTEGER PRIMARY KEY,
+                                     started TEXT NOT NULL,
+                                     finished TEXT NOT NULL,
+                                     added INTEGER NOT NULL,
+                                     changed INTEGER NOT NULL,
+                                     deleted INTEGER NOT NULL);
+"""
+
+
+class AbstractStore():
+    """ SQLite store of pid -> abstract """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def hashes(self):
+        """ Returns pid -> hash of stored abstracts """
+        return dict(self.conn.execute("SELECT pid, hash FROM abstracts WHERE deleted = 0"))
+
+    def abstracts(self):
+        """ Returns pid -> abstract of stored abstracts """
+        return dict(self.conn.execute("SELECT pid, abstract FROM abstracts WHERE deleted = 0 ORDER BY pid"))
+
+    def upsert(self, rows):
+        """
+        Adds or replaces abstracts
+
+        :param rows:
+            iterable of (pid, abstract, hash)
+        """
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO abstracts (pid, abstract, hash, updated, deleted)
+                                     VALUES (?, ?, ?, ?, 0)""", ((p, a, h, now) for p, a, h in rows))
+
+    def delete(self, pids):
+        """ Marks abstracts as deleted """
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany("UPDATE abstracts SET deleted = 1, updated = ? WHERE pid = ?", ((now, p) for p in pids))
+
+    def record_harvest(self, started, added, changed, deleted):
+        with self.conn:
+            self.conn.execute("INSERT INTO harvests (started, finished, added, changed, deleted) VALUES (?, ?, ?, ?, ?)",
+                              (started.isoformat(), datetime.now().isoformat(), added, changed, deleted))
+
+    def last_harvest(self):
+        """ Returns time (ISO format) the last harvest started, or None """
+        row = self.conn.execute("SELECT started FROM harvests ORDER BY id DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+
+def is_store(path):
+    """ True if path is a SQLite file """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(16) == b'SQLite format 3\x00'
+    except OSError:
+        return False
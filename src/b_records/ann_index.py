@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.ann_index` -- Approximate nearest neighbour index
+
+==================
+Approximate Search
+==================
+
+Inverted file (IVF) index over unit length vectors.
+
+The vectors are clustered with spherical k-means, and each vector is
+stored in the list of its closest centroid. A query is only scored
+against the vectors in the `nprobe` lists whose centroids are closest to
+it, so the cost of a query grows with the list sizes rather than with the
+number of indexed vectors.
+
+The index is written as a npz file together with a hash of the indexed
+vectors, and is only reused as long as the vectors are unchanged.
+"""
+import hashlib
+import logging
+import os
+import time
+import numpy as np
+from scipy import sparse
+logger = logging.getLogger(__name__)
+
+NPROBE = 32
+
+
+class IVFIndex():
+    """ Inverted file index """
+    def __init__(self, centroids, indptr, members, fingerprint):
+        self.centroids = centroids
+        self.indptr = indptr
+        self.members = members
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, vectors, nlist=None, iterations=10, sample_size=100000, seed=0):
+        """
+        Clusters vectors and builds index
+
+        :param vectors:
+            unit length vectors to index
+        :param nlist:
+            Number of lists. Default is 4 * sqrt(len(vectors))
+        :param iterations:
+            Number of k-means iterations
+        :param sample_size:
+            Max number of vectors used for training the centroids
+        """
+        nlist = min(nlist or max(1, int(4 * np.sqrt(len(vectors)))), len(vectors))
+        logger.info("Building IVF index with %d lists over %d vectors", nlist, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > sample_size:
+            sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = _assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+        assignment = _assign(vectors, centroids)
+        members = np.argsort(assignment, kind='stable').astype(np.int64)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+        return cls(centroids, indptr, members, fingerprint(vectors))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['centroids'], f['indptr'], f['members'], str(f['fingerprint']))
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, centroids=self.centroids, indptr=self.indptr, members=self.members, fingerprint=self.fingerprint)
+        os.replace(tmp, path)
+
+    def search(self, queries, vectors, min_similarity, k=None, nprobe=NPROBE):
+        """
+        Returns sparse queries x vectors matrix with the similarity of the
+        neighbours found for each query
+
+        :param queries:
+            unit length query vectors
+        :param vectors:
+            the indexed vectors
+        :param min_similarity:
+            only neighbours above min_similarity are returned
+        :param k:
+            if given, at most k neighbours are returned for each query
+        :param nprobe:
+            number of lists scanned for each query
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        indptr = [0]
+        indices = []
+        data = []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate([self.members[self.indptr[c]:self.indptr[c + 1]] for c in lists])
+            scores = vectors[candidates] @ query
+            keep = scores > min_similarity
+            candidates, scores = candidates[keep], scores[keep]
+            if k and k < len(candidates):
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates, scores = candidates[top], scores[top]
+            indices.append(candidates)
+            data.append(scores)
+            indptr.append(indptr[-1] + len(candidates))
+        return sparse.csr_matrix((np.concatenate(data or [[]]).astype(np.float32), np.concatenate(indices or [[]]), indptr),
+                                 shape=(len(queries), len(vectors)))
+
+
+def _assign(vectors, centroids, block_size=4096):
+    """ Returns index of closest centroid for each vector """
+    return np.concatenate([np.argmax(vectors[i:i + block_size] @ centroids.T, axis=1)
+                           for i in range(0, len(vectors), block_size)])
+
+
+def fingerprint(vectors):
+    """ Returns hash identifying the indexed vectors """
+    vectors = np.ascontiguousarray(vectors)
+    h = hashlib.sha1(str(vectors.shape).encode())
+    h.update(vectors.data)
+    return h.hexdigest()
+
+
+def load_or_build(path, vectors, nlist=None):
+    """
+    Loads index from path if it was built from the same vectors,
+    otherwise a new index is built and written to path
+    """
+    if os.path.exists(path):
+        index = IVFIndex.load(path)
+        if index.fingerprint == fingerprint(vectors):
+            logger.info("Reusing IVF index %s", path)
+            return index
+        logger.info("Vectors have changed since %s was built", path)
+    index = IVFIndex.build(vectors, nlist=nlist)
+    logger.info("Writing IVF index to %s", path)
+    index.save(path)
+    return index
+
+
+def recall_report(index, queries, vectors, min_similarity, k=None, nprobe=NPROBE):
+    """
+    Compares neighbours found by index with exact search
+
+    :returns:
+        dict with mean recall and time per query for both searches
+    """
+    start = time.perf_counter()
+    approximate = index.search(queries, vectors, min_similarity, k=k, nprobe=nprobe)
+    ann_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = queries @ vectors.T
+    recalls = []
+    for row, found in zip(scores, approximate):
+        exact = np.flatnonzero(row > min_similarity)
+        if k and k < len(exact):
+            exact = exact[np.argpartition(-row[exact], k - 1)[:k]]
+        if len(exact):
+            recalls.append(len(np.intersect1d(exact, found.indices)) / len(exact))
+    exact_time = time.perf_counter() - start
+
+    report = {'queries': len(queries),
+              'recall': float(np.mean(recalls)) if recalls else 1.0,
+              'ann_ms_per_query': 1000 * ann_time / max(len(queries), 1),
+              'exact_ms_per_query': 1000 * exact_time / max(len(queries), 1)}
+    logger.info("Recall %.3f over %d queries (ann %.2f ms/query, exact %.2f ms/query)", report['recall'], report['queries'],
+                report['ann_ms_per_query'], report['exact_ms_per_query'])
+    return report
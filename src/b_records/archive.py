@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.archive` -- Content-first archive
+
+=====================
+Content-First Archive
+=====================
+
+Integer coded form of the content-first archive shared by all stages.
+
+The archive is parsed once and converted to
+
+* `pids` -- every tagged pid
+* `offsets` and `codes` -- the tags of each pid as sorted codes into `tags`
+* `tags` -- every tag, sorted
+* `id2label` -- the label of each tag id
+
+The converted form is cached in an npz file next to the archive (or in a
+given cache directory), named by a key derived from the path, size and
+modification time of the archive, so later stages load the arrays instead
+of parsing the archive again. Caches of earlier versions of the same
+archive are removed when a new one is written.
+
+`Archive` is a read only mapping of pid -> frozenset of tags, so it can be
+used wherever the dict of sets from `recommender_common` was used.
+"""
+from collections.abc import Mapping
+import glob
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from scipy import sparse
+from b_records import metrics
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class Archive(Mapping):
+    """ pid -> frozenset of tags, stored as integer codes """
+    def __init__(self, pids, offsets, codes, tags, id2label):
+        self.pids = pids
+        self.offsets = offsets
+        self.codes = codes
+        self.tags = tags
+        self.id2label = id2label
+        self.index = {pid: i for i, pid in enumerate(pids)}
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        return iter(self.pids)
+
+    def __contains__(self, pid):
+        return pid in self.index
+
+    def __getitem__(self, pid):
+        i = self.index[pid]
+        return frozenset(self.tags[c] for c in self.codes[self.offsets[i]:self.offsets[i + 1]])
+
+    def tag_matrix(self, pids):
+        """
+        Returns sparse pid x tag indicator matrix for pids, and the tag of each
+        column. Only tags carried by one of the pids get a column
+        """
+        rows = np.array([self.index[pid] for pid in pids], dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        codes = self.codes[positions]
+        used = np.unique(codes)
+        indices = np.searchsorted(used, codes)
+        data = np.ones(len(indices), dtype=np.float32)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(pids), len(used))), [self.tags[c] for c in used]
+
+    def save(self, path):
+        """ Writes archive to npz file atomically """
+        tmp = path + '.tmp.npz'
+        meta = json.dumps({'version': VERSION, 'tags': self.tags, 'id2label': list(self.id2label.items())}, ensure_ascii=False)
+        np.savez(tmp, pids=np.array(self.pids, dtype=str), offsets=self.offsets, codes=self.codes, meta=np.array(meta))
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path):
+        """ Reads archive written by save """
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            return cls(f['pids'].tolist(), f['offsets'], f['codes'], meta['tags'], {k: v for k, v in meta['id2label']})
+
+
+def convert(archive_file):
+    """ Parses archive file and returns the integer coded archive """
+    import recommender_common.load_compass_data as ld
+
+    logger.info("Converting archive %s", archive_file)
+    pid2tags = {k: {p[0] for p in v} for k, v in ld.pid2tags(ld.load_tag_data(archive_file))}
+    tags = sorted({tag for pid_tags in pid2tags.values() for tag in pid_tags})
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+    pids = list(pid2tags)
+    lengths = [len(pid2tags[pid]) for pid in pids]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    codes = np.array([c for pid in pids for c in sorted(tag_index[tag] for tag in pid2tags[pid])], dtype=np.int32)
+    return Archive(pids, offsets, codes, tags, ld.load_id_expanded_tag_map(archive_file))
+
+
+def load(archive_file, cache_dir=None):
+    """
+    Returns integer coded archive, converting the archive file if it is not cached
+
+    :param archive_file:
+        Content-first archive file
+    :param cache_dir:
+        Directory holding converted archives. Default is the directory of archive_file
+    """
+    with metrics.phase('load archive') as measured:
+        archive = _load(archive_file, cache_dir)
+        measured.items = len(archive)
+    return archive
+
+
+def _load(archive_file, cache_dir=None):
+    cache_file = _cache_file(archive_file, cache_dir)
+    if os.path.exists(cache_file):
+        logger.debug("Loading converted archive %s", cache_file)
+        return Archive.read(cache_file)
+    archive = convert(archive_file)
+    pattern = os.path.join(glob.escape(os.path.dirname(cache_file)), glob.escape(os.path.basename(archive_file)) + '.*.archive.npz')
+    try:
+        for stale in glob.glob(pattern):
+            os.remove(stale)
+        archive.save(cache_file)
+        logger.info("Cached converted archive in %s", cache_file)
+    except OSError as e:
+        logger.warning("Could not cache converted archive in %s: %s", cache_file, e)
+    return archive
+
+
+def _cache_file(archive_file, cache_dir=None):
+    """ Cache file of archive, named by a key of its path, size and modification time """
+    path = os.path.abspath(archive_file)
+    stat = os.stat(path)
+    key = hashlib.sha1(json.dumps([VERSION, path, stat.st_size, stat.st_mtime_ns]).encode()).hexdigest()[:16]
+    cache_dir = cache_dir or os.path.dirname(path)
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{key}.archive.npz")
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.benchmark` -- Benchmarks
+
+==========
+Benchmarks
+==========
+
+Times the stages of the flow on a synthetic corpus without LOWELL or a
+real content-first archive.
+
+The corpus is drawn from a number of topics, each with its own word
+distribution over a shared vocabulary, so documents of the same topic
+are similar. A share of the pids is content-first and tagged with tags of
+their topic. The archive is written directly in its converted form (see
+:mod:`b_records.archive`) next to a placeholder archive file, so stages
+load it as if it had been converted from a real archive.
+
+LOWELL is replaced by an in-process fake cursor serving the `metadata`
+rows of the synthetic corpus to the queries of :mod:`b_records.get_abstract`
+and :mod:`b_records.report`.
+
+The stages timed are
+
+* harvest -- get_abstracts through the fake cursor
+* tokenize -- tokenization of the harvested abstracts
+* train -- building the vocabulary and each training epoch
+* generate -- tag generation against synthetic vectors clustered by topic,
+  so the timing does not depend on the quality of the trained model
+* report -- rendering the report of the generated tags
+
+Results are written as json with the commit, scale, parameters and the
+wall time, cpu time and throughput of each stage. Two result files are
+compared with `compare`.
+
+`startup` guards the startup time of the `b-records` command (see
+:mod:`b_records.main`). It runs `b-records --help` and `b-records COMMAND
+--help` for each command in fresh interpreters. A command fails when its
+best time exceeds the budget, or when it imports one of the heavy
+dependencies that should only be loaded when they are used.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from b_records import archive
+from b_records import db
+logger = logging.getLogger(__name__)
+
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+STAGES = ['harvest', 'tokenize', 'train', 'generate', 'report']
+STARTUP_BUDGET = 1.0
+HEAVY_IMPORTS = ['gensim', 'psycopg2', 'colored', 'recommender_common', 'joblib']
+
+
+def corpus(n, topics=50, vocabulary=20000, words=(40, 80), tagged_share=0.1, tags_per_topic=5, seed=0):
+    """
+    Returns synthetic metadata and content-first archive
+
+    :param n:
+        number of pids
+    :returns:
+        (metadata, archive, topic) where metadata is pid -> dict with abstract, type, dk5,
+        creator and title, archive is an archive.Archive and topic is the topic of each pid
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"ord{i}" for i in range(vocabulary)])
+    zipf = 1 / np.arange(1, len(vocabulary) + 1)
+    zipf /= zipf.sum()
+    orders = [rng.permutation(len(vocabulary)) for _ in range(topics)]
+    topic = rng.integers(0, topics, n)
+    lengths = rng.integers(words[0], words[1] + 1, n)
+    pids = [f"870970-basis:{50000000 + i}" for i in range(n)]
+    metadata = {}
+    for t in range(topics):
+        members = np.flatnonzero(topic == t)
+        tokens = orders[t][rng.choice(len(vocabulary), int(lengths[members].sum()), p=zipf)]
+        offsets = np.concatenate([[0], np.cumsum(lengths[members])])
+        for k, i in enumerate(members):
+            book = rng.random() < 0.8
+            metadata[pids[i]] = {'abstract': ' '.join(vocabulary[tokens[offsets[k]:offsets[k + 1]]]).capitalize() + '.',
+                                 'type': ['Bog'] if book else ['Film (dvd)'], 'dk5': ['sk'] if book else ['77.7'],
+                                 'creator': f"Forfatter {i % 997}", 'title': f"Titel {i}"}
+
+    tagged = np.sort(rng.choice(n, int(n * tagged_share), replace=False))
+    tags = list(range(topics * tags_per_topic))
+    codes = [np.unique(topic[i] * tags_per_topic + rng.choice(tags_per_topic, rng.integers(1, 4), replace=False)) for i in tagged]
+    offsets = np.concatenate([[0], np.cumsum([len(c) for c in codes])]).astype(np.int64)
+    id2label = {tag: f"emne {tag // tags_per_topic}/{tag % tags_per_topic}" for tag in tags}
+    tag_archive = archive.Archive([pids[i] for i in tagged], offsets, np.concatenate(codes).astype(np.int32), tags, id2label)
+    return metadata, tag_archive, topic
+
+
+def topic_vectors(topic, dim=300, noise=1.0, seed=0):
+    """ Returns float32 vectors clustered around a random center for each topic """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(int(topic.max()) + 1, dim)).astype(np.float32)
+    return centers[topic] + noise * rng.normal(size=(len(topic), dim)).astype(np.float32)
+
+
+class _FakeCursor():
+    """
+    Answers the metadata queries of get_abstract and report from a dict of pid -> metadata.
+    Like the connection pool of db.Cursor, it fails when more cursors are open at once than
+    the largest maxconn asked for
+    """
+    def __init__(self, metadata, pool, maxconn=db.MAXCONN):
+        self.metadata = metadata
+        self.pool = pool
+        self.maxconn = maxconn
+        self.rows = iter(())
+        self.itersize = db.ITERSIZE
+
+    def __enter__(self):
+        with self.pool['lock']:
+            self.pool['maxconn'] = max(self.pool['maxconn'], self.maxconn)
+            if self.pool['open'] >= self.pool['maxconn']:
+                raise RuntimeError("connection pool exhausted")
+            self.pool['open'] += 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self.pool['lock']:
+            self.pool['open'] -= 1
+
+    def __iter__(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+    def execute(self, stmt, params):
+        if "'creator'" in stmt:
+            self.rows = iter([(pid, self.metadata[pid]['creator'], self.metadata[pid]['title'])
+                              for pid in params['pids'] if pid in self.metadata])
+        elif 'compass_pids' in params:
+            self.rows = self._abstracts(params, hashes='md5(' in stmt)
+        else:
+            self.rows = ((pid, self.metadata[pid]['abstract'], _md5(self.metadata[pid]['abstract']))
+                         for pid in params['pids'] if pid in self.metadata)
+
+    def _abstracts(self, params, hashes):
+        compass_pids = set(params['compass_pids'])
+        count = 0
+        for pid, m in self.metadata.items():
+            if params.get('limit') and count >= params['limit']:
+                return
+            if 'partitions' in params and zlib.crc32(pid.encode()) % params['partitions'] != params['partition']:
+                continue
+            if pid in compass_pids or (len(m['abstract']) >= params['min_length']
+                                       and any(t.startswith(('Bog', 'Lydbog', 'Ebog')) for t in m['type'])
+                                       and any(d == 'sk' or d == '99.4' or d.startswith('99.4 ') for d in m['dk5'])):
+                count += 1
+                yield pid, _md5(m['abstract']) if hashes else m['abstract']
+
+
+def _md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def fake_lowell(metadata):
+    """ Serves metadata to db.Cursor users within the block instead of LOWELL """
+    original = db.Cursor
+    pool = {'lock': threading.Lock(), 'open': 0, 'maxconn': 0}
+    db.Cursor = lambda *args, maxconn=db.MAXCONN, **kwargs: _FakeCursor(metadata, pool, maxconn)
+    try:
+        yield
+    finally:
+        db.Cursor = original
+
+
+def write_archive(tag_archive, path):
+    """ Writes placeholder archive file with tag_archive cached as its converted form """
+    with open(path, 'w') as f:
+        f.write("synthetic content-first archive, see b_records.benchmark\n")
+    tag_archive.save(archive._cache_file(path))
+
+
+def _timed(results, stage, items, function, *args, **kwargs):
+    """ Runs function, adds its timing to results and returns its result """
+    logger.info("Running %s", stage)
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    results[stage] = {'seconds': wall, 'cpu_seconds': cpu, 'items': items, 'items_per_second': items / wall if wall else None}
+    logger.info("%s took %.2fs (%d items)", stage, wall, items)
+    return result
+
+
+def run(n, workdir=None, stages=STAGES, epochs=2, emb_size=300, workers=1, parallel=1, index='exact', report_limit=10000,
+        seed=0):
+    """
+    Runs the benchmark
+
+    :param n:
+        number of pids in the synthetic corpus
+    :param workdir:
+        directory for the generated files. Default is a temporary directory that is removed afterwards
+    :param stages:
+        stages to time. tokenize needs harvest, and train needs tokenize
+    :param epochs:
+        number of training epochs timed
+    :param emb_size:
+        size of the trained and the synthetic vectors
+    :param workers:
+        number of processes used for tokenization and tag generation
+    :param parallel:
+        number of partitions harvested concurrently
+    :param index:
+        exact or ann, see generate_subjects
+    :param report_limit:
+        number of pids reported
+    :returns:
+        dict of results
+    """
+    from b_records import build_doc2vec_model, generate_subjects, get_abstract, report, vectors as vector_store
+
+    for stage, needed in [('tokenize', 'harvest'), ('train', 'tokenize'), ('report', 'generate')]:
+        if stage in stages and needed not in stages:
+            raise ValueError(f"{stage} needs {needed}")
+    started = datetime.now()
+    results = {}
+    params = {'n': n, 'stages': list(stages), 'epochs': epochs, 'emb_size': emb_size, 'workers': workers, 'parallel': parallel,
+              'index': index, 'report_limit': report_limit, 'seed': seed}
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix='b-records-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        metadata, tag_archive, topic = _timed(results, 'corpus', n, corpus, n, seed=seed)
+        archive_file = os.path.join(workdir, 'archive')
+        write_archive(tag_archive, archive_file)
+
+        with fake_lowell(metadata):
+            if 'harvest' in stages:
+                harvested = len(_timed(results, 'harvest', n, get_abstract.get_abstracts, archive_file,
+                                       os.path.join(workdir, 'abstracts'), min_length=100, parallel=parallel))
+                abstracts_file = os.path.join(workdir, f"abstracts-100-{harvested}.pkl")
+            if 'tokenize' in stages:
+                corpus_file = _timed(results, 'tokenize', harvested, build_doc2vec_model.tokenize, abstracts_file,
+                                     cache_dir=workdir, workers=workers)
+            if 'train' in stages:
+                _train(results, corpus_file, epochs, emb_size)
+            if 'generate' in stages:
+                vectors_path = os.path.join(workdir, 'vectors')
+                vector_store.export(list(metadata), topic_vectors(topic, emb_size, seed=seed), vectors_path)
+                queries = len(metadata) - len(tag_archive)
+                _timed(results, 'generate', queries, generate_subjects.generate_tags, vectors_path, archive_file,
+                       os.path.join(workdir, 'predicted-tags'), index=index, workers=workers)
+            if 'report' in stages:
+                tags_file = os.path.join(workdir, 'predicted-tags.tags')
+                out = io.StringIO()
+                _timed(results, 'report', min(report_limit, len(generate_subjects.load_tags(tags_file))), report.make_report,
+                       tags_file, archive_file, limit=report_limit, output_format='text', out=out)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'started': started.isoformat(), 'commit': _commit(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'params': params, 'stages': results}
+
+
+def _train(results, corpus_file, epochs, emb_size):
+    """ Times building the vocabulary and each epoch of training as build_doc2vec_model.train does """
+    from gensim.models.doc2vec import Doc2Vec
+    from b_records.build_doc2vec_model import EpochLogger, _count_lines, _train_epochs, line_corpus, set_doctags
+
+    lines_file, pids = line_corpus(corpus_file)
+    model = Doc2Vec(vector_size=emb_size, dm=1, min_count=2, workers=12)
+    _timed(results, 'build_vocab', _count_lines(corpus_file), model.build_vocab, corpus_file=lines_file)
+    set_doctags(model, pids)
+    epoch_logger = EpochLogger()
+    _timed(results, 'train', model.corpus_count * epochs, _train_epochs, model, lines_file, epochs, callbacks=[epoch_logger])
+    results['train']['epoch_seconds'] = epoch_logger.timings
+
+
+def _commit():
+    """ Current git commit of the source tree, or None """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup(commands=None, repeat=3, budget=STARTUP_BUDGET):
+    """
+    Times the startup of the b-records command
+
+    :param commands:
+        commands to time. Default is all. The command itself is always timed
+    :param repeat:
+        number of runs of each command. The fastest is used
+    :param budget:
+        maximum number of seconds a command may take
+    :returns:
+        list of dict with the command, seconds, import seconds, heavy dependencies
+        imported, and whether the command is within budget and only imported the
+        heavy dependencies it is allowed to
+    """
+    from b_records.main import COMMANDS
+
+    env = dict(os.environ)
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([src] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    results = []
+    for command in [None] + list(commands or COMMANDS):
+        argv = [sys.executable, '-m', 'b_records'] + ([command] if command else []) + ['--help']
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            seconds.append(time.perf_counter() - start)
+        imported = _imported(argv, env)
+        heavy = sorted(set(HEAVY_IMPORTS).intersection(imported))
+        results.append({'command': command or '', 'seconds': min(seconds), 'import_seconds': sum(imported.values()),
+                        'heavy_imports': heavy, 'ok': min(seconds) <= budget and not heavy})
+    return results
+
+
+def _imported(argv, env):
+    """ Returns top level package -> seconds spent importing its modules when running argv with -X importtime """
+    process = subprocess.run(argv[:1] + ['-X', 'importtime'] + argv[1:], env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, check=True)
+    imported = {}
+    for line in process.stderr.decode().splitlines():
+        if line.startswith('import time:') and not line.rstrip().endswith('| imported package'):
+            own, _, name = line[len('import time:'):].split('|')
+            package = name.strip().split('.')[0]
+            imported[package] = imported.get(package, 0) + int(own) / 1e6
+    return imported
+
+
+def compare(old, new):
+    """ Returns (stage, old seconds, new seconds, new / old) for stages in both results """
+    rows = []
+    for stage, result in new['stages'].items():
+        if stage in old['stages']:
+            before, after = old['stages'][stage]['seconds'], result['seconds']
+            rows.append((stage, before, after, after / before if before else None))
+    return rows
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+
+    if sys.argv[1:2] == ['compare']:
+        return _compare_cli(sys.argv[2:])
+    if sys.argv[1:2] == ['startup']:
+        return _startup_cli(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Time the stages of the flow on a synthetic corpus with a fake LOWELL',
+                                     epilog="Results are compared with 'compare OLD NEW'. "
+                                            "Startup time of the b-records command is checked with 'startup'")
+    parser.add_argument('-s', '--scale', type=_scale, default=SCALES['10k'],
+                        help=f"number of pids, or one of {', '.join(SCALES)}. Default is 10k")
+    parser.add_argument('--stages', choices=STAGES, nargs='+', default=STAGES,
+                        help='stages to time. Default is all')
+    parser.add_argument('-e', '--epochs', type=int,
+                        help='number of training epochs timed. Default is 2', default=2)
+    parser.add_argument('-z', '--embedding-size', type=int,
+                        help='size of vectors. Default is 300', default=300)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes used for tokenization and tag generation. Default is 1', default=1)
+    parser.add_argument('-p', '--parallel', type=int,
+                        help='number of partitions harvested concurrently. Default is 1', default=1)
+    parser.add_argument('--index', choices=['exact', 'ann'], default='exact',
+                        help='index used for tag generation. Default is exact')
+    parser.add_argument('--workdir',
+                        help='keep generated files in this directory. Default is a temporary directory', default=None)
+    parser.add_argument('-o', '--outfile',
+                        help='file to write results to. Default is benchmark-SCALE.json', default=None)
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    results = run(args.scale, args.workdir, args.stages, args.epochs, args.embedding_size, args.workers, args.parallel, args.index)
+    outfile = args.outfile or f"benchmark-{args.scale}.json"
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    for stage, result in results['stages'].items():
+        print(f"{stage:12s} {result['seconds']:10.2f}s {result['items_per_second'] or 0:14.1f} items/s")
+    logger.info("Wrote results to %s", outfile)
+
+
+def _compare_cli(argv):
+    """ Commandline interface for comparing results """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='benchmark compare', description='Compare two benchmark results')
+    parser.add_argument('old',
+                        help='results of the baseline')
+    parser.add_argument('new',
+                        help='results to compare')
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{'stage':12s} {'old':>10s} {'new':>10s} {'new/old':>8s}")
+    for stage, before, after, ratio in compare(old, new):
+        print(f"{stage:12s} {before:9.2f}s {after:9.2f}s {ratio or 0:8.2f}")
+
+
+def _startup_cli(argv):
+    """ Commandline interface for timing startup """
+    import argparse
+    from b_records.main import COMMANDS
+
+    parser = argparse.ArgumentParser(prog='benchmark startup',
+                                     description='Time the startup of b-records and its commands, and fail if it is too slow')
+    parser.add_argument('commands', nargs='*', metavar='COMMAND',
+                        help=f"commands to time ({', '.join(COMMANDS)}). Default is all")
+    parser.add_argument('--budget', type=float,
+                        help=f'maximum number of seconds a command may take. Default is {STARTUP_BUDGET}', default=STARTUP_BUDGET)
+    parser.add_argument('-r', '--repeat', type=int,
+                        help='number of runs of each command. The fastest is used. Default is 3', default=3)
+    parser.add_argument('-o', '--outfile',
+                        help='file to write results to', default=None)
+    args = parser.parse_args(argv)
+    unknown = [command for command in args.commands if command not in COMMANDS]
+    if unknown:
+        parser.error(f"unknown commands {', '.join(unknown)}")
+
+    results = startup(args.commands, args.repeat, args.budget)
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(f"{'command':16s} {'seconds':>8s} {'imports':>8s}  heavy imports")
+    for result in results:
+        print(f"{result['command'] or '(none)':16s} {result['seconds']:7.2f}s {result['import_seconds']:7.2f}s  "
+              f"{', '.join(result['heavy_imports'])}{'' if result['ok'] else '  FAILED'}")
+    failed = [result['command'] or '(none)' for result in results if not result['ok']]
+    if failed:
+        print(f"Startup of {', '.join(failed)} exceeds {args.budget}s or imports heavy dependencies", file=sys.stderr)
+        sys.exit(1)
+
+
+def _scale(value):
+    import argparse
+
+    if value.lower() in SCALES:
+        return SCALES[value.lower()]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"scale must be a number or one of {', '.join(SCALES)}, got '{value}'")
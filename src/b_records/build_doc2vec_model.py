@@ -9,18 +9,82 @@ Builds Doc2vec Model
 ====================
 
 Builds doc2vec model based on harvested abstracts
+
+The abstracts are tokenized once by a pool of processes and written to a
+pre-tokenized corpus file, with one line of `pid<TAB>tokens` per abstract.
+The file is named by a hash of the abstracts file, the filters and the
+limit, so reruns on the same abstracts skip tokenization, and every
+training pass streams from the file instead of preprocessing again.
+
+The model is trained in gensim's `corpus_file` mode, where each worker
+thread reads its own part of a file of tokens with one document per line,
+so training is not bound by a single Python thread feeding the workers.
+gensim tags the documents by line number, so the pid of each line is
+written to a pids file and the doctags are set to the pids after the
+vocabulary is built. Abstracts without tokens are left out of the line
+corpus, since gensim skips empty lines without counting them.
+
+A hash of the tokens of each abstract is written next to the model. An
+existing model can then be updated with new or changed abstracts by
+inferring their vectors with the frozen model, which leaves the vectors of
+unchanged abstracts as they are. The updated vectors are written to a
+vector store (see :mod:`b_records.vectors`). If too large a part of the
+corpus has changed, a new model is trained instead.
+
+Training can be validated every few epochs by re-inferring the vectors of
+a sample of documents and measuring how often the inferred vector is
+closest to the document's own trained vector. Training stops when this
+stops improving, and the best model is kept.
+
+Long trainings can checkpoint the model and the training state every few
+epochs, and an interrupted training resumed from the last checkpoint.
+Models are written atomically.
+
+Near-duplicate abstracts can be removed before training (see
+:mod:`b_records.dedup`), so the model is trained on one representative of
+each cluster. The clusters are written next to the model and in its vector
+store, so the other members can be given the vector of their
+representative.
 """
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import functools
+import hashlib
 import logging
-from gensim.models.doc2vec import TaggedDocument
-from gensim.models.doc2vec import Doc2Vec
-import gensim.parsing.preprocessing as pre
-import joblib
+import os
+import random
+import shutil
+import time
 import json
+import numpy as np
+from b_records import checkpoint
+from b_records import dedup
+from b_records import metrics
+from b_records import vectors
+from b_records.abstract_store import AbstractStore, is_store
 logger = logging.getLogger(__name__)
 
 
-FILTERS = [pre.strip_tags, pre.strip_punctuation, pre.strip_multiple_whitespaces, pre.strip_numeric, pre.strip_short]
+FILTER_NAMES = ['strip_tags', 'strip_punctuation', 'strip_multiple_whitespaces', 'strip_numeric', 'strip_short']
+
+
+@functools.lru_cache(maxsize=None)
+def _filters():
+    import gensim.parsing.preprocessing as pre
+    return [getattr(pre, name) for name in FILTER_NAMES]
+
+
+def __getattr__(name):
+    # FILTERS holds the gensim filter functions, so gensim is only imported when they are used
+    if name == 'FILTERS':
+        return _filters()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def preprocess(text):
+    """ Returns the tokens of text after applying the gensim preprocessing FILTERS """
+    import gensim.parsing.preprocessing as pre
+    return pre.preprocess_string(text, filters=_filters())
 
 
 class Docs():
@@ -34,22 +98,69 @@ class Docs():
         return self
 
     def __next__(self):
+        from gensim.models.doc2vec import TaggedDocument
+
         self.i += 1
         if self.i > len(self.data):
             self.i = 0
             raise StopIteration
         pid = self.pids[self.i-1]
         text = self.data[pid]
-        tokens = pre.preprocess_string(text, filters=FILTERS)
-        return TaggedDocument(tokens, [pid])
+        return TaggedDocument(preprocess(text), [pid])
 
 
-def train(abstracts_file, emb_size=300, min_count=2, epochs=200, limit=None, outfile_prefix='abstract-model'):
+class TokenizedDocs():
+    """ Document iterator over a pre-tokenized corpus file """
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        from gensim.models.doc2vec import TaggedDocument
+
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                pid, _, tokens = line.rstrip('\n').partition('\t')
+                yield TaggedDocument(tokens.split(), [pid])
+
+
+class EpochLogger():
+    """
+    Logs the duration of each epoch. Implements the gensim training callbacks
+    without deriving from CallbackAny2Vec, so gensim is not imported with the module
+    """
+    def __init__(self):
+        self.epoch = 0
+        self.timings = []
+
+    def on_train_begin(self, model):
+        pass
+
+    def on_train_end(self, model):
+        pass
+
+    def on_batch_begin(self, model):
+        pass
+
+    def on_batch_end(self, model):
+        pass
+
+    def on_epoch_begin(self, model):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, model):
+        self.epoch += 1
+        self.timings.append(time.perf_counter() - self.start)
+        logger.info("Epoch %d took %.1fs", self.epoch, self.timings[-1])
+
+
+def train(abstracts_file, emb_size=300, min_count=2, epochs=200, limit=None, outfile_prefix='abstract-model', cache_dir=None,
+          tokenize_workers=None, export_dtype=None, eval_every=None, patience=3, min_delta=0.001, validation_size=500,
+          checkpoint_every=None, resume=False, dedup_threshold=None):
     """
     Trains doc2vec model
 
     :param abstracts_file:
-        Path to file containing abstracts
+        Path to file containing abstracts, or abstract store
     :param emb_size:
         Size of trained embedding
     :param min_count:
@@ -60,22 +171,424 @@ def train(abstracts_file, emb_size=300, min_count=2, epochs=200, limit=None, out
         Limits the number of abstracts to use
     :param outfile-prefix:
         filename prefix
+    :param cache_dir:
+        Directory holding tokenized corpus files. Default is the directory of abstracts_file
+    :param tokenize_workers:
+        Number of processes used for tokenization. Default is the number of cpus
+    :param export_dtype:
+        If given, the docvecs are also written to a memory mappable vector store
+        (MODEL_FILE.vectors) of this type (float32, float16 or int8)
+    :param eval_every:
+        If given, the model is validated every eval_every epochs, and training stops
+        early when validation has not improved by min_delta for patience validations.
+        The best model is checkpointed to MODEL_FILE.best and the validation curve
+        is written to MODEL_FILE.curve.json
+    :param validation_size:
+        Number of documents re-inferred for validation
+    :param checkpoint_every:
+        If given, the model and training state are checkpointed to MODEL_FILE.checkpoint
+        every checkpoint_every epochs
+    :param resume:
+        Continue training from the checkpoint of an interrupted training of the same
+        corpus and parameters, if there is one, and train the remaining epochs. Without
+        checkpoint_every the interval of the checkpoint is kept
+    :param dedup_threshold:
+        If given, near-duplicate abstracts with an estimated shingle similarity of at least
+        this are clustered, and only one representative of each cluster is trained. The
+        clusters are written to MODEL_FILE.clusters.npz (see :mod:`b_records.dedup`)
     """
     start = datetime.now()
-    num, data = _load_data(abstracts_file, limit)
-    model = Doc2Vec(vector_size=emb_size, dm=1, min_count=min_count, workers=12)
-    model.build_vocab(Docs(data))
-    model.train(Docs(data), total_examples=model.corpus_count, epochs=epochs)
-    if outfile_prefix:
-        outfile = f"{outfile_prefix}-{emb_size}-{num}.d2v"
+    tokens_file = corpus_file = tokenize(abstracts_file, limit, cache_dir, tokenize_workers)
+    clusters_file = None
+    if dedup_threshold:
+        corpus_file, clusters_file = dedup.dedup(tokens_file, dedup_threshold, workers=tokenize_workers)
+    num = _count_lines(corpus_file)
+    outfile = _model_file(outfile_prefix, emb_size, num) if outfile_prefix else None
+    docs = TokenizedDocs(corpus_file)
+    lines_file, pids = line_corpus(corpus_file)
+    epoch_logger = EpochLogger()
+    checkpoint_file = f"{outfile}.checkpoint" if outfile and (checkpoint_every or resume) else None
+    params = {'corpus': os.path.basename(corpus_file), 'epochs': epochs, 'min_count': min_count, 'eval_every': eval_every,
+              'validation_size': validation_size, 'checkpoint_every': checkpoint_every}
+    saved = _load_checkpoint(checkpoint_file, params) if resume and checkpoint_file else None
+    state = saved['state'] if saved else None
+    if state:
+        checkpoint_every = params['checkpoint_every'] = checkpoint_every or saved['params'].get('checkpoint_every')
+        import joblib
+
+        with metrics.phase('load model', 1):
+            model = joblib.load(checkpoint_file)
+        epoch_logger.epoch = state['done']
+    else:
+        from gensim.models.doc2vec import Doc2Vec
+
+        model = Doc2Vec(vector_size=emb_size, dm=1, min_count=min_count, workers=12)
+        with metrics.phase('build vocab', num):
+            model.build_vocab(corpus_file=lines_file)
+        set_doctags(model, pids)
+    with metrics.phase('train') as measured:
+        if eval_every or checkpoint_every or state:
+            model = _train_in_chunks(model, docs, epochs, [epoch_logger], outfile, eval_every, patience, min_delta, validation_size,
+                                     checkpoint_every, checkpoint_file, params, state, lines_file)
+        else:
+            _train_epochs(model, lines_file, epochs, callbacks=[epoch_logger])
+        measured.items = num * (epoch_logger.epoch - (state['done'] if state else 0))
+    if outfile:
         logger.info("Writing model to %s", outfile)
-        joblib.dump(model, outfile)
+        checkpoint.dump(model, outfile)
+        if checkpoint_file:
+            for path in [checkpoint_file, f"{checkpoint_file}.json"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        # every abstract is hashed, also the cluster members left out of the deduplicated corpus
+        hashes = _doc_hashes(tokens_file)
+        _write_hashes(f"{outfile}.hashes.json", hashes)
+        if clusters_file:
+            shutil.copyfile(clusters_file, f"{outfile}.clusters.npz")
+        if export_dtype:
+            vectors.export_model(model, f"{outfile}.vectors", export_dtype)
+            _write_hashes(os.path.join(f"{outfile}.vectors", 'hashes.json'), hashes)
+            if clusters_file:
+                shutil.copyfile(clusters_file, os.path.join(f"{outfile}.vectors", 'clusters.npz'))
     logger.info("Created model in [%s]", datetime.now() - start)
     return model
 
 
+def _train_epochs(model, lines_file, epochs, **kwargs):
+    """ Trains model for epochs on line corpus in gensim's corpus_file mode. kwargs are passed to model.train """
+    model.train(corpus_file=lines_file, total_examples=model.corpus_count, total_words=model.corpus_total_words, epochs=epochs,
+                **kwargs)
+
+
+def _train_in_chunks(model, docs, epochs, callbacks=(), outfile=None, eval_every=None, patience=3, min_delta=0.001,
+                     validation_size=500, checkpoint_every=None, checkpoint_file=None, params=None, state=None, lines_file=None):
+    """
+    Trains a few epochs at a time with a linearly decaying learning rate.
+
+    With eval_every the model is validated every eval_every epochs, and training
+    stops when validation has not improved by min_delta for patience validations.
+    The best model is returned. With checkpoint_every the model and the training
+    state are written to checkpoint_file every checkpoint_every epochs. Training
+    continues from state if given (see _load_checkpoint). The model is trained on
+    lines_file (see line_corpus), and docs are only read for validation
+    """
+    sample = _validation_sample(docs, validation_size) if eval_every else None
+    state = state or {'done': 0, 'curve': [], 'best': -1, 'best_epoch': 0, 'stale': 0}
+    # model.train overwrites model.alpha and model.min_alpha with the range of each chunk,
+    # so the range of the whole training is kept in the state
+    state.setdefault('alpha', model.alpha)
+    state.setdefault('min_alpha', model.min_alpha)
+
+    def alpha(epoch):
+        return state['alpha'] - (state['alpha'] - state['min_alpha']) * epoch / epochs
+
+    done = state['done']
+    while done < epochs:
+        n = epochs - done
+        for every in (eval_every, checkpoint_every):
+            if every:
+                n = min(n, every - done % every)
+        _train_epochs(model, lines_file, n, start_alpha=alpha(done), end_alpha=alpha(done + n), callbacks=callbacks)
+        done = state['done'] = done + n
+        if eval_every and (done % eval_every == 0 or done == epochs):
+            score = _self_similarity(model, sample)
+            state['curve'].append({'epoch': done, 'self_similarity': score})
+            logger.info("Validation after epoch %d: self similarity %.4f", done, score)
+            if score > state['best'] + min_delta:
+                state['best'], state['best_epoch'], state['stale'] = score, done, 0
+                if outfile:
+                    checkpoint.dump(model, f"{outfile}.best")
+            else:
+                state['stale'] += 1
+                if state['stale'] >= patience:
+                    logger.info("No improvement for %d validations. Stopping after epoch %d", state['stale'], done)
+                    break
+        if checkpoint_file and checkpoint_every and done % checkpoint_every == 0 and done < epochs:
+            _save_checkpoint(model, checkpoint_file, params, state)
+
+    if eval_every and outfile:
+        checkpoint.write_json({'best_epoch': state['best_epoch'], 'curve': state['curve']}, f"{outfile}.curve.json")
+        if state['best_epoch'] != done:
+            import joblib
+
+            logger.info("Using best model from epoch %d", state['best_epoch'])
+            model = joblib.load(f"{outfile}.best")
+    return model
+
+
+def _save_checkpoint(model, checkpoint_file, params, state):
+    """
+    Writes model to checkpoint_file, and params, training state and a fingerprint of the model
+    file to CHECKPOINT_FILE.json. The two files are replaced one at a time, so the fingerprint
+    tells whether they were written by the same checkpoint
+    """
+    checkpoint.dump(model, checkpoint_file)
+    checkpoint.write_json({'params': params, 'state': state, 'model': checkpoint.fingerprint(checkpoint_file)},
+                          f"{checkpoint_file}.json")
+    logger.info("Checkpointed model after epoch %d to %s", state['done'], checkpoint_file)
+
+
+def _load_checkpoint(checkpoint_file, params):
+    """
+    Returns params and training state of checkpoint_file if it was written with params and the
+    model file is the one they were saved with, otherwise None. checkpoint_every is only compared if given
+    """
+    saved = checkpoint.read_json(f"{checkpoint_file}.json")
+    if saved is None or not os.path.exists(checkpoint_file):
+        logger.info("No checkpoint in %s. Training from scratch", checkpoint_file)
+        return None
+    ignored = [] if params['checkpoint_every'] else ['checkpoint_every']
+    if {k: v for k, v in saved['params'].items() if k not in ignored} != {k: v for k, v in params.items() if k not in ignored}:
+        logger.info("Checkpoint %s was written with other parameters. Training from scratch", checkpoint_file)
+        return None
+    if saved.get('model') != checkpoint.fingerprint(checkpoint_file):
+        logger.warning("Checkpoint %s does not match its training state. Training from scratch", checkpoint_file)
+        return None
+    logger.info("Resuming training from epoch %d", saved['state']['done'])
+    return saved
+
+
+def _validation_sample(docs, size, seed=0):
+    """ Returns random sample of size documents """
+    rng = random.Random(seed)
+    sample = []
+    for i, doc in enumerate(docs):
+        if len(sample) < size:
+            sample.append(doc)
+        elif rng.randrange(i + 1) < size:
+            sample[rng.randrange(size)] = doc
+    return sample
+
+
+def _self_similarity(model, sample):
+    """ Share of sampled documents whose re-inferred vector is most similar to their own docvec """
+    with metrics.phase('validation', len(sample)):
+        return _count_self_similar(model, sample) / max(len(sample), 1)
+
+
+def _count_self_similar(model, sample):
+    offsets = {tag: i for i, tag in enumerate(model.docvecs.offset2doctag)}
+    docvecs = model.docvecs.vectors_docs
+    docvecs = docvecs / np.maximum(np.linalg.norm(docvecs, axis=1, keepdims=True), 1e-12)
+    hits = 0
+    for doc in sample:
+        sims = docvecs @ model.infer_vector(doc.words)
+        hits += np.argmax(sims) == offsets[doc.tags[0]]
+    return hits
+
+
+def update(abstracts_file, model_file, vectors_path=None, max_drift=0.2, limit=None, outfile_prefix='abstract-model', cache_dir=None,
+           tokenize_workers=None, export_dtype='float32', min_count=2, epochs=200):
+    """
+    Updates the docvecs of a model with new or changed abstracts without retraining
+
+    Vectors for new and changed abstracts are inferred with the model, vectors
+    for unchanged abstracts are kept, and vectors for removed abstracts are
+    dropped. The result is written to the vector store
+    OUTFILE_PREFIX-SIZE-NUM.vectors. If the model was trained with dedup, the
+    unchanged members of clusters with an unchanged representative stay in
+    the clusters file of the store, and other members get their own vector.
+    If the share of new, changed and removed abstracts since the model was
+    trained exceeds max_drift, a new model is trained and exported instead,
+    with the dedup threshold of the model.
+
+    :param abstracts_file:
+        Path to file containing abstracts, or abstract store
+    :param model_file:
+        File containing pickled doc2vec model
+    :param vectors_path:
+        Vector store from a previous update. Default is the docvecs of the model
+    :param max_drift:
+        Largest share of abstracts that are new, changed or removed since the model was trained
+        (MODEL_FILE.hashes.json) that is updated rather than retrained
+    :param export_dtype:
+        Type of the written vectors (float32, float16 or int8). A new model is only exported if it is given
+    :param min_count, epochs:
+        Used when a new model is trained
+    :returns:
+        path to written vector store, or None if a new model was trained without export_dtype
+    """
+    import joblib
+
+    start = datetime.now()
+    corpus_file = tokenize(abstracts_file, limit, cache_dir, tokenize_workers)
+    current = _doc_hashes(corpus_file)
+    with metrics.phase('load model', 1):
+        model = joblib.load(model_file)
+    trained = _read_hashes(f"{model_file}.hashes.json")
+    if trained is None:
+        logger.warning("No abstract hashes stored with %s. Changed abstracts are not detected", model_file)
+        trained = {tag: current[tag] for tag in model.docvecs.offset2doctag if tag in current}
+    if vectors_path:
+        store = vectors.load(vectors_path)
+        tags, matrix = store.tags, store.matrix()
+        previous = _read_hashes(os.path.join(vectors_path, 'hashes.json'))
+        if previous is None:
+            logger.warning("No abstract hashes stored with %s. Changed abstracts are not detected", vectors_path)
+            previous = {tag: current[tag] for tag in tags if tag in current}
+    else:
+        tags = [model.docvecs.offset2doctag[i] for i in range(len(model.docvecs))]
+        matrix = model.docvecs.vectors_docs
+        previous = trained
+    model_clusters = dedup.clusters_file(model_file)
+    clusters_file = dedup.clusters_file(vectors_path) if vectors_path else model_clusters
+    clusters, stats = dedup.load_clusters(clusters_file) if clusters_file else ({}, {})
+
+    index = {tag: i for i, tag in enumerate(tags)}
+    unchanged = {pid for pid, h in current.items() if pid in index and previous.get(pid) == h}
+    # members keep the vector of their representative until either of them changes
+    clusters = {member: representative for member, representative in clusters.items()
+                if representative in unchanged and member in current and previous.get(member) == current[member]}
+    changed = {pid for pid in current if pid not in unchanged and pid not in clusters}
+    # drift is measured against the corpus the model was trained on, so chained updates add up
+    drifted = sum(1 for pid, h in current.items() if trained.get(pid) != h)
+    removed = len(trained.keys() - current.keys())
+    drift = (drifted + removed) / max(len(trained), 1)
+    logger.info("%d new or changed abstracts to infer. %d new or changed and %d removed abstracts since training (drift %.1f%%)",
+                len(changed), drifted, removed, 100 * drift)
+    if drift > max_drift:
+        logger.info("Drift exceeds %.1f%%. Training new model", 100 * max_drift)
+        threshold = dedup.load_clusters(model_clusters)[1].get('threshold') if model_clusters else None
+        train(abstracts_file, model.vector_size, min_count, epochs, limit, outfile_prefix, cache_dir, tokenize_workers,
+              export_dtype, dedup_threshold=threshold)
+        if not export_dtype:
+            return None
+        trained_file = dedup.dedup(corpus_file, threshold, workers=tokenize_workers)[0] if threshold else corpus_file
+        return f"{_model_file(outfile_prefix, model.vector_size, _count_lines(trained_file))}.vectors"
+
+    with metrics.phase('infer', len(changed)):
+        inferred = {doc.tags[0]: model.infer_vector(doc.words) for doc in TokenizedDocs(corpus_file) if doc.tags[0] in changed}
+    pids = [pid for pid in current if pid not in clusters]
+    updated = np.array([inferred[pid] if pid in inferred else matrix[index[pid]] for pid in pids], dtype=np.float32)
+    outfile = f"{outfile_prefix}-{model.vector_size}-{len(current)}.vectors"
+    vectors.export(pids, updated, outfile, export_dtype or 'float32')
+    _write_hashes(os.path.join(outfile, 'hashes.json'), current)
+    if clusters:
+        dedup.save_clusters(os.path.join(outfile, 'clusters.npz'), clusters, stats)
+    logger.info("Updated vectors in [%s]", datetime.now() - start)
+    return outfile
+
+
+def tokenize(abstracts_file, limit=None, cache_dir=None, workers=None):
+    """
+    Writes the tokenized abstracts to a corpus file, unless it already exists
+
+    :param abstracts_file:
+        Path to file containing abstracts
+    :param limit:
+        Limits the number of abstracts to use
+    :param cache_dir:
+        Directory holding tokenized corpus files. Default is the directory of abstracts_file
+    :param workers:
+        Number of processes used for tokenization. Default is the number of cpus
+    :returns:
+        path to corpus file
+    """
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(abstracts_file))
+    corpus_file = os.path.join(cache_dir, f"tokens-{_corpus_key(abstracts_file, limit)}.txt")
+    if os.path.exists(corpus_file):
+        logger.info("Using tokenized corpus %s", corpus_file)
+        return corpus_file
+
+    start = datetime.now()
+    with metrics.phase('load abstracts') as measured:
+        _, data = _load_data(abstracts_file, limit)
+        measured.items = len(data)
+    tmp = corpus_file + '.tmp'
+    with metrics.phase('tokenize', len(data)), ProcessPoolExecutor(workers) as executor, open(tmp, 'w', encoding='utf-8') as f:
+        for pid, tokens in zip(data.keys(), executor.map(_tokenize, data.values(), chunksize=1000)):
+            f.write(f"{pid}\t{tokens}\n")
+    os.replace(tmp, corpus_file)
+    logger.info("Tokenized %d abstracts to %s in [%s]", len(data), corpus_file, datetime.now() - start)
+    return corpus_file
+
+
+def line_corpus(corpus_file):
+    """
+    Writes the tokens of a tokenized corpus file to a line corpus for gensim's corpus_file mode,
+    and the pid of each line to a pids file, unless they already exist. Abstracts without tokens
+    are left out
+
+    :returns:
+        path to line corpus and list of the pid of each line
+    """
+    stem = os.path.splitext(corpus_file)[0]
+    lines_file, pids_file = f"{stem}.lines.txt", f"{stem}.pids.txt"
+    if not (os.path.exists(lines_file) and os.path.exists(pids_file)):
+        with open(corpus_file, encoding='utf-8') as f, open(f"{lines_file}.tmp", 'w', encoding='utf-8') as lines, \
+                open(f"{pids_file}.tmp", 'w', encoding='utf-8') as pids:
+            for line in f:
+                pid, _, tokens = line.rstrip('\n').partition('\t')
+                if tokens.strip():
+                    lines.write(f"{tokens}\n")
+                    pids.write(f"{pid}\n")
+        os.replace(f"{lines_file}.tmp", lines_file)
+        os.replace(f"{pids_file}.tmp", pids_file)
+    with open(pids_file, encoding='utf-8') as f:
+        return lines_file, [line.rstrip('\n') for line in f]
+
+
+def set_doctags(model, pids):
+    """ Replaces the line number doctags of a model built in corpus_file mode with the pid of each line """
+    from gensim.models.doc2vec import Doctag
+
+    docvecs = model.docvecs
+    docvecs.offset2doctag = list(pids)
+    docvecs.doctags = {pid: Doctag(i, 0, 1) for i, pid in enumerate(pids)}
+    docvecs.max_rawint = -1
+
+
+def _tokenize(text):
+    return ' '.join(preprocess(text))
+
+
+def _corpus_key(abstracts_file, limit):
+    """ Hash of abstracts file content, filters and limit """
+    h = hashlib.sha1()
+    with open(abstracts_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(json.dumps([FILTER_NAMES, limit]).encode())
+    return h.hexdigest()
+
+
+def _model_file(outfile_prefix, emb_size, num):
+    """ Path to model trained on a corpus of num abstracts """
+    return f"{outfile_prefix}-{emb_size}-{num}.d2v"
+
+
+def _doc_hashes(corpus_file):
+    """ Returns pid -> hash of tokens for each abstract in corpus file """
+    with open(corpus_file, encoding='utf-8') as f:
+        return {pid: hashlib.md5(tokens.encode('utf-8')).hexdigest()
+                for pid, _, tokens in (line.rstrip('\n').partition('\t') for line in f)}
+
+
+def _write_hashes(path, hashes):
+    with open(path, 'w') as f:
+        json.dump(hashes, f)
+
+
+def _read_hashes(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _count_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+
 def _load_data(abstracts_file, limit):
-    data = joblib.load(abstracts_file)
+    if is_store(abstracts_file):
+        with AbstractStore(abstracts_file) as store:
+            data = store.abstracts()
+    else:
+        import joblib
+
+        data = joblib.load(abstracts_file)
     num = len(data)
     if limit:
         num = min(num, limit)
@@ -89,7 +602,7 @@ def cli():
 
     parser = argparse.ArgumentParser(description='Create document vector model')
     parser.add_argument('abstracts',
-                        help='file containing harvested abstracts')
+                        help='file containing harvested abstracts, or abstract store')
     parser.add_argument('-o', '--outfile-prefix',
                         help='file to write result to. Default is abstract-model', default='abstract-model')
     parser.add_argument('-l', '--limit', dest='limit', type=int,
@@ -98,6 +611,31 @@ def cli():
                         help='Embedding size. Default is 300', default=300)
     parser.add_argument('-e', '--epochs', dest='epochs', type=int,
                         help='number of epochs. Default is 200', default=200)
+    parser.add_argument('--cache-dir',
+                        help='directory for tokenized corpus files. Default is the directory of the abstracts file', default=None)
+    parser.add_argument('--tokenize-workers', type=int,
+                        help='number of processes used for tokenization. Default is the number of cpus', default=None)
+    parser.add_argument('--export', choices=vectors.DTYPES,
+                        help='also write docvecs of this type to a memory mappable vector store', default=None)
+    parser.add_argument('--eval-every', type=int,
+                        help='validate every N epochs and stop when validation stops improving', default=None)
+    parser.add_argument('--patience', type=int,
+                        help='validations without improvement before stopping. Default is 3', default=3)
+    parser.add_argument('--checkpoint-every', type=int,
+                        help='checkpoint model every N epochs to MODEL_FILE.checkpoint', default=None)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted training from its checkpoint')
+    parser.add_argument('--dedup', metavar='THRESHOLD', type=float, nargs='?', const=dedup.THRESHOLD,
+                        help=f'train one representative of each cluster of near-duplicate abstracts. Default threshold is '
+                             f'{dedup.THRESHOLD}', default=None)
+    parser.add_argument('-u', '--update', metavar='MODEL',
+                        help='update docvecs of existing model with new or changed abstracts instead of training', default=None)
+    parser.add_argument('--vectors',
+                        help='vector store from a previous update to update (with --update)', default=None)
+    parser.add_argument('--max-drift', type=float,
+                        help='with --update, train new model if more than this share of abstracts changed. Default is 0.2',
+                        default=0.2)
+    metrics.add_arguments(parser)
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='verbose output')
     args = parser.parse_args()
@@ -107,4 +645,13 @@ def cli():
         level = logging.DEBUG
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
 
-    train(args.abstracts, emb_size=args.z, epochs=args.epochs, limit=args.limit, outfile_prefix=args.outfile_prefix)
+    with metrics.instrument(args.metrics_file, args.profile):
+        if args.update:
+            update(args.abstracts, args.update, vectors_path=args.vectors, max_drift=args.max_drift, limit=args.limit,
+                   outfile_prefix=args.outfile_prefix, cache_dir=args.cache_dir, tokenize_workers=args.tokenize_workers,
+                   export_dtype=args.export or 'float32', epochs=args.epochs)
+        else:
+            train(args.abstracts, emb_size=args.z, epochs=args.epochs, limit=args.limit, outfile_prefix=args.outfile_prefix,
+                  cache_dir=args.cache_dir, tokenize_workers=args.tokenize_workers, export_dtype=args.export,
+                  eval_every=args.eval_every, patience=args.patience, checkpoint_every=args.checkpoint_every, resume=args.resume,
+                  dedup_threshold=args.dedup)
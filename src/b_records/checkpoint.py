@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.checkpoint` -- Checkpoints
+
+===========
+Checkpoints
+===========
+
+Atomic writes and resumable partial results for long running jobs.
+
+Files are written to a temporary name next to the target and renamed into
+place, so a job that is killed while writing never leaves a truncated file
+behind.
+
+Partial results are flushed as numbered part files to a directory holding
+a manifest with a key identifying the job. A resumed job with the same key
+reads the completed blocks from the part files and only computes the
+rest. A job with a different key starts over.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+from b_records import metrics
+logger = logging.getLogger(__name__)
+
+
+def dump(obj, path):
+    """ Pickles obj to path atomically """
+    import joblib
+
+    tmp = f"{path}.tmp"
+    with metrics.phase('serialization', 1):
+        joblib.dump(obj, tmp)
+    os.replace(tmp, path)
+
+
+def write_json(obj, path):
+    """ Writes obj as json to path atomically """
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+def fingerprint(path):
+    """ Returns sha1 of the content of path """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_json(path):
+    """ Returns json content of path, or None if path does not exist """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class Partial():
+    """ Directory of results of completed blocks """
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.parts = 0
+
+    def open(self, key, resume=False):
+        """
+        Returns block -> results of the completed blocks if resume is set and the directory
+        was written by a job with the same key. Otherwise the directory is cleared
+        """
+        manifest = os.path.join(self.path, 'manifest.json')
+        if resume and (read_json(manifest) or {}).get('key') == key:
+            import joblib
+
+            completed = {}
+            parts = sorted(glob.glob(os.path.join(self.path, 'part-*.pkl')))
+            for part in parts:
+                completed.update(joblib.load(part))
+            self.parts = len(parts)
+            logger.info("Resuming with %d completed blocks from %s", len(completed), self.path)
+            return completed
+        if resume:
+            logger.info("No matching partial results in %s. Starting over", self.path)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        write_json({'key': key}, manifest)
+        return {}
+
+    def add(self, block, results):
+        """ Adds results of a completed block. They are written on the next flush """
+        self.pending[block] = results
+
+    def flush(self):
+        """ Writes the added results to a new part file """
+        if self.pending:
+            dump(self.pending, os.path.join(self.path, f"part-{self.parts:06d}.pkl"))
+            logger.debug("Flushed %d blocks to %s", len(self.pending), self.path)
+            self.parts += 1
+            self.pending = {}
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
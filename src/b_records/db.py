@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.db` -- LOWELL connections
+
+=================
+LOWELL Connection
+=================
+
+Pooled postgres connections shared by the stages that read from LOWELL.
+
+One thread safe connection pool is kept for each database url, so
+concurrent harvest partitions and consecutive queries reuse connections
+instead of connecting for every query.
+"""
+import logging
+import os
+import threading
+logger = logging.getLogger(__name__)
+
+ITERSIZE = 10000
+MAXCONN = 4
+
+_pools = {}
+_retired = []
+_lock = threading.Lock()
+
+
+def lowell_url():
+    return os.environ['LOWELL_URL']
+
+
+def _pool(postgres_url, maxconn):
+    """
+    Returns connection pool for postgres_url holding at least maxconn connections.
+    A pool that is too small is replaced but kept open until close_pools, since
+    other threads may still be using its connections
+    """
+    from psycopg2.pool import ThreadedConnectionPool
+
+    with _lock:
+        pool = _pools.get(postgres_url)
+        if pool is None or pool.maxconn < maxconn:
+            if pool is not None:
+                _retired.append(pool)
+            logger.debug("Creating connection pool with %d connections", maxconn)
+            pool = _pools[postgres_url] = ThreadedConnectionPool(1, maxconn, postgres_url)
+        return pool
+
+
+def close_pools():
+    """ Closes all pooled connections """
+    with _lock:
+        for pool in list(_pools.values()) + _retired:
+            pool.closeall()
+        _pools.clear()
+        _retired.clear()
+
+
+class Cursor():
+    """
+    postgres cursor on a pooled connection
+
+    If name is given a server side cursor is used, which fetches itersize
+    rows at a time instead of the whole result set. The transaction is
+    committed when the block exits normally and rolled back otherwise
+    """
+    def __init__(self, postgres_url=None, name=None, itersize=ITERSIZE, cursor_factory=None, maxconn=MAXCONN):
+        self.postgres_url = postgres_url or lowell_url()
+        self.name = name
+        self.itersize = itersize
+        self.cursor_factory = cursor_factory
+        self.maxconn = maxconn
+
+    def __enter__(self):
+
+        self.pool = _pool(self.postgres_url, self.maxconn)
+        self.conn = self.pool.getconn()
+        self.cur = self.conn.cursor(name=self.name, cursor_factory=self.cursor_factory)
+        self.cur.itersize = self.itersize
+        return self.cur
+
+    def __exit__(self, type, value, traceback):
+
+        try:
+            if type is None:
+                self.cur.close()
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.pool.putconn(self.conn)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.dedup` -- Near-duplicate abstracts
+
+======================
+Near-Duplicate Removal
+======================
+
+Clusters near-identical abstracts, such as the book, audiobook and ebook
+editions of the same work, so only one representative of each cluster is
+used to train the doc2vec model.
+
+Each tokenized abstract is summarized by a MinHash signature of its word
+shingles. The signatures are split into bands, and abstracts sharing a band
+are candidate duplicates. A candidate is only accepted if the share of
+equal signature values, an estimate of the Jaccard similarity of the
+shingles, is at least the threshold. Accepted pairs are joined into
+clusters, and the abstract with the most tokens represents its cluster.
+
+The result is a corpus file holding only the representatives, and a
+clusters file (`.clusters.npz`) mapping every other member to its
+representative. The clusters file is written next to the model and in its
+vector store, and :mod:`b_records.generate_subjects` gives the members the
+vector of their representative, scores each cluster once and fans the tags
+out to all members.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import zlib
+import numpy as np
+from b_records import metrics
+logger = logging.getLogger(__name__)
+
+THRESHOLD = 0.8
+NUM_PERM = 128
+SHINGLE_SIZE = 3
+MAX_HEADS = 10
+
+_PRIME = np.uint64(4294967291)
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+def dedup(corpus_file, threshold=THRESHOLD, num_perm=NUM_PERM, workers=None):
+    """
+    Writes the representatives of the near-duplicate clusters in a tokenized corpus
+    file to a new corpus file, unless it already exists
+
+    :param corpus_file:
+        Tokenized corpus file with lines of `pid<TAB>tokens`
+        (see :func:`b_records.build_doc2vec_model.tokenize`)
+    :param threshold:
+        Minimum estimated Jaccard similarity of the shingles of two abstracts in a cluster
+    :param num_perm:
+        Number of values in each MinHash signature. At most NUM_PERM
+    :param workers:
+        Number of processes computing signatures. Default is the number of cpus
+    :returns:
+        (path to deduplicated corpus file, path to clusters file)
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+    if not 0 < num_perm <= NUM_PERM:
+        raise ValueError(f"num_perm must be in (0, {NUM_PERM}], got {num_perm}")
+    stem = f"{os.path.splitext(corpus_file)[0]}.dedup-{_key(threshold, num_perm)}"
+    deduped_file, clusters_file = f"{stem}.txt", f"{stem}.clusters.npz"
+    if os.path.exists(deduped_file) and os.path.exists(clusters_file):
+        logger.info("Using deduplicated corpus %s", deduped_file)
+        return deduped_file, clusters_file
+
+    start = datetime.now()
+    pids, docs = [], []
+    with open(corpus_file, encoding='utf-8') as f:
+        for line in f:
+            pid, _, tokens = line.rstrip('\n').partition('\t')
+            pids.append(pid)
+            docs.append(tokens)
+    with metrics.phase('dedup', len(pids)):
+        with ProcessPoolExecutor(workers) as executor:
+            signatures = np.array(list(executor.map(_signature, docs, [num_perm] * len(docs), chunksize=1000)), dtype=np.uint32)
+        lengths = np.array([len(doc.split()) for doc in docs], dtype=np.int64)
+        representative = _cluster(signatures.reshape(len(docs), num_perm), lengths, threshold)
+    keep = representative == np.arange(len(pids))
+    stats = _stats(representative, lengths, threshold, num_perm)
+
+    tmp = f"{deduped_file}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for i in np.flatnonzero(keep):
+            f.write(f"{pids[i]}\t{docs[i]}\n")
+    os.replace(tmp, deduped_file)
+    members = np.flatnonzero(~keep)
+    save_clusters(clusters_file, {pids[i]: pids[representative[i]] for i in members}, stats)
+    logger.info("Deduplicated %d abstracts to %d in [%s]. %d clusters of near-duplicates, the largest of %d. "
+                "Corpus shrank by %.1f%% of the abstracts and %.1f%% of the tokens", stats['documents'], stats['representatives'],
+                datetime.now() - start, stats['clusters'], stats['largest_cluster'], 100 * stats['document_reduction'],
+                100 * stats['token_reduction'])
+    return deduped_file, clusters_file
+
+
+def save_clusters(path, clusters, stats=None):
+    """ Writes member pid -> representative pid and the dedup statistics to path atomically """
+    tmp = f"{path}.tmp.npz"
+    np.savez(tmp, members=np.array(list(clusters.keys()), dtype=str), representatives=np.array(list(clusters.values()), dtype=str),
+             stats=np.array(json.dumps(stats or {})))
+    os.replace(tmp, path)
+
+
+def load_clusters(path):
+    """ Returns member pid -> representative pid and the dedup statistics of clusters file """
+    with np.load(path) as f:
+        return dict(zip(f['members'].tolist(), f['representatives'].tolist())), json.loads(str(f['stats']))
+
+
+def clusters_file(model_file):
+    """ Returns path to the clusters file of a model file or vector store, or None if it was trained without dedup """
+    path = os.path.join(model_file, 'clusters.npz') if os.path.isdir(model_file) else f"{model_file}.clusters.npz"
+    return path if os.path.exists(path) else None
+
+
+def _key(threshold, num_perm):
+    return hashlib.sha1(json.dumps([threshold, num_perm, SHINGLE_SIZE]).encode()).hexdigest()[:16]
+
+
+def _signature(doc, num_perm=NUM_PERM):
+    """ MinHash signature of the word shingles of doc """
+    tokens = doc.split()
+    if not tokens:
+        return np.full(num_perm, _PRIME, dtype=np.uint32)
+    n = max(len(tokens) - SHINGLE_SIZE + 1, 1)
+    shingles = np.array([zlib.crc32(' '.join(tokens[i:i + SHINGLE_SIZE]).encode('utf-8')) for i in range(n)], dtype=np.uint64)
+    return ((shingles[:, None] * _A[:num_perm] + _B[:num_perm]) % _PRIME).min(axis=0)
+
+
+def _bands(threshold, num_perm):
+    """
+    Returns the number of rows in each band. Candidates are pairs sharing a band, and the
+    approximate similarity (1/bands)^(1/rows) where pairs start to become candidates is kept
+    at or below threshold, so few duplicates are missed
+    """
+    best = 1
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0 and (rows / num_perm) ** (1 / rows) <= threshold:
+            best = rows
+    return best
+
+
+def _cluster(signatures, lengths, threshold):
+    """ Returns the index of the representative of each document """
+    n, num_perm = signatures.shape
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = _bands(threshold, num_perm)
+    multipliers = np.random.RandomState(2).randint(1, 1 << 62, size=rows, dtype=np.int64).astype(np.uint64)
+    empty = (signatures == _PRIME).all(axis=1)
+    for start in range(0, num_perm, rows):
+        keys = signatures[:, start:start + rows].astype(np.uint64) @ multipliers
+        order = np.argsort(keys, kind='stable')
+        order = order[~empty[order]]
+        starts = np.r_[0, np.flatnonzero(np.diff(keys[order])) + 1]
+        sizes = np.diff(np.r_[starts, len(order)])
+        for group_start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            _join(order[group_start:group_start + size], signatures, threshold, find, parent)
+
+    roots = np.array([find(i) for i in range(n)])
+    representative = np.arange(n)
+    clusters = {}
+    for i, root in enumerate(roots):
+        clusters.setdefault(root, []).append(i)
+    for members in clusters.values():
+        if len(members) > 1:
+            representative[members] = max(members, key=lambda i: (lengths[i], -i))
+    return representative
+
+
+def _join(group, signatures, threshold, find, parent):
+    """ Joins the documents of a bucket that are similar to one of the first MAX_HEADS unmatched documents """
+    for _ in range(MAX_HEADS):
+        if len(group) < 2:
+            return
+        head, rest = group[0], group[1:]
+        similar = (signatures[rest] == signatures[head]).mean(axis=1) >= threshold
+        for i in rest[similar]:
+            a, b = find(head), find(i)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        group = rest[~similar]
+
+
+def _stats(representative, lengths, threshold, num_perm):
+    keep = representative == np.arange(len(representative))
+    sizes = np.bincount(representative, minlength=len(representative))
+    tokens = int(lengths.sum()) if len(lengths) else 0
+    kept_tokens = int(lengths[keep].sum()) if len(lengths) else 0
+    return {'threshold': threshold, 'num_perm': num_perm, 'shingle_size': SHINGLE_SIZE,
+            'documents': len(representative), 'representatives': int(keep.sum()), 'clusters': int((sizes > 1).sum()),
+            'largest_cluster': int(sizes.max()) if len(sizes) else 0, 'tokens': tokens, 'representative_tokens': kept_tokens,
+            'document_reduction': 1 - keep.sum() / len(keep) if len(keep) else 0.0,
+            'token_reduction': 1 - kept_tokens / tokens if tokens else 0.0}
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Remove near-duplicate abstracts from a tokenized corpus')
+    parser.add_argument('corpus_file',
+                        help='tokenized corpus file (tokens-*.txt written by build_doc2vec_model)')
+    parser.add_argument('-t', '--threshold', type=float,
+                        help=f'minimum estimated Jaccard similarity of near-duplicates. Default is {THRESHOLD}', default=THRESHOLD)
+    parser.add_argument('--num-perm', type=int,
+                        help=f'number of values in each MinHash signature. Default is {NUM_PERM}', default=NUM_PERM)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes computing signatures. Default is the number of cpus', default=None)
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    deduped_file, clusters = dedup(args.corpus_file, args.threshold, args.num_perm, args.workers)
+    print(json.dumps(load_clusters(clusters)[1], indent=2))
@@ -16,26 +16,95 @@ For each pid the closest n other pids a found (cosimilarity in the
 doc2vec model), and their labels are grouped and counted. The most
 frequent tags are then assigned to the pid.
 
-The doc2vec model is build from the abstracts of each pid.
+The docvecs are normalized once, and untagged pids are scored in blocks
+against a matrix holding only the vectors of the content-first pids, so
+each block costs a single matrix multiplication. Tags are aggregated for
+the whole block by multiplying the neighbour weights with a sparse
+content-first pid x tag matrix.
+
+With `index='ann'` an approximate nearest neighbour index over the
+content-first pids is built (or reused) next to the model file, or in a
+given index file, and each pid is only scored against the candidates it
+returns.
+
+Blocks can be scored by a pool of worker processes sharing the vectors
+through memory mapped files, and the pids can be split into shards that
+are processed separately and merged afterwards.
+
+Given a state file, the neighbours found for each pid are stored between
+runs (see :mod:`b_records.neighbours`), so a rerun only searches pids
+whose vectors are new or changed. The same neighbour cache lets `sweep`
+compare the coverage of many parameter combinations without searching
+again.
+
+With `method='centroid'` each pid is instead scored against one
+normalized centroid per tag, built from the vectors of the content-first
+pids carrying the tag, which costs one similarity per tag rather than one
+per content-first pid.
+
+The doc2vec model is build from the abstracts of each pid. Instead of the
+pickled model, a vector store exported from it (see
+:mod:`b_records.vectors`) can be given, in which case the docvecs are
+memory mapped rather than loaded.
+
+When the result is written to file, the results of completed blocks are
+flushed to a partial directory every few blocks (see
+:mod:`b_records.checkpoint`), so an interrupted run can be resumed, and
+the result file is written atomically.
+
+The tags are streamed to a columnar tag store (see
+:mod:`b_records.tag_store`) as they are generated, so the result does not
+have to fit in memory. By default the pickled dict of pid -> tags is
+written as well, for the consumers that still read it. An inverted index
+of the tags is written next to them (see :mod:`b_records.tag_index`),
+except for shards, which are indexed when they are merged.
+
+If the model was trained on the representatives of clusters of
+near-duplicate abstracts (see :mod:`b_records.dedup`), the other members
+get the vector of their representative. Each cluster is scored once and
+its tags are fanned out to all its untagged members.
+
 There are several parameters to tweak to get the result you want.
 """
+import copy
+import hashlib
+import json
 import logging
-from tqdm import tqdm
-from collections import defaultdict
-import joblib
-import recommender_common.load_compass_data as ld
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+from scipy import sparse
+from b_records import ann_index
+from b_records import archive
+from b_records import checkpoint
+from b_records import dedup
+from b_records import metrics
+from b_records import neighbours as neighbour_lists
+from b_records import tag_index
+from b_records import tag_store
+from b_records import vectors as vector_store
 logger = logging.getLogger(__name__)
 
+BLOCK_SIZE = 256
+SWEEP_NEIGHBOURS = 1000
+CHECKPOINT_EVERY = 100
+OUTPUT_FORMATS = ['store', 'pickle', 'both']
+
 
-def generate_tags(model_file, archive_file, output_prefix=None, topn=None, min_similarity=0.45, by_value=False, min_value=None):
+def generate_tags(model_file, archive_file, output_prefix=None, topn=None, min_similarity=0.45, by_value=False, min_value=None,
+                  block_size=BLOCK_SIZE, index='exact', neighbours=None, nprobe=ann_index.NPROBE, recall_sample=None,
+                  workers=1, shard=None, state_file=None, method='knn', resume=False, checkpoint_every=CHECKPOINT_EVERY,
+                  output_format='both', index_file=None):
     """
     Generates tags for pids based on likeness to content-first pids
     :param model_file:
-        File containing doc2vec file
+        File containing doc2vec model, or directory containing vector store. If the model was
+        trained with dedup, the members of its clusters are tagged as well
     :param archive file:
         Content-first archive file
     :param output_prefix:
-        If given, the generated tags are written to file
+        If given, the generated tags are written to file (see output_format)
     :param topn:
         Retain max topn tags for each pid
     :param min_similarity:
@@ -45,66 +114,563 @@ def generate_tags(model_file, archive_file, output_prefix=None, topn=None, min_s
         if True - tag value is calculated by accumulating similarity scores
     :param min_value:
         <inimum value for tags
+    :param block_size:
+        Number of pids scored in each matrix multiplication
+    :param index:
+        'exact' scores every content-first pid
+        'ann' only scores candidates from an approximate index stored in index_file
+    :param neighbours:
+        If given, at most this many of the most similar content-first pids are used for each pid
+    :param nprobe:
+        Number of index lists scanned for each pid when index is 'ann'
+    :param recall_sample:
+        If given, the recall of the approximate index is measured on this many pids
+    :param workers:
+        Number of worker processes scoring blocks of pids
+    :param shard:
+        (i, n) tuple. If given, only the i'th of n deterministic slices of the pids is processed
+        (0 <= i < n), and the result is written as a shard file that can be merged with merge_shards
+    :param state_file:
+        If given, the neighbours of each pid are read from and written to this file, and only pids
+        that are new or whose vectors have changed are searched again. Runs in a single process, so
+        it can not be combined with workers
+    :param method:
+        'knn' - tags are aggregated from the neighbouring content-first pids
+        'centroid' - each pid is scored against the normalized centroid of the vectors of the
+        content-first pids carrying each tag. The tag value is the similarity to the centroid,
+        and min_similarity, topn and min_value apply to it. by_value, index and neighbours are ignored
+    :param resume:
+        Continue from the results flushed by an interrupted run with the same model, archive and
+        parameters. Without state_file the results of completed blocks are flushed to
+        OUTPUT_PREFIX.partial while tags are generated
+    :param checkpoint_every:
+        Number of completed blocks flushed at a time
+    :param output_format:
+        'store' - tags are streamed to the tag store OUTPUT_PREFIX.tags
+        'pickle' - dict of pid -> tags is pickled to OUTPUT_PREFIX-N.pkl
+        'both' - both are written
+        Unless shard is given, the inverted tag index OUTPUT_PREFIX.tag-index is written as well.
+        Shards are indexed when they are merged
+    :param index_file:
+        File holding the approximate index. Default is MODEL_FILE.ivf.npz
+    :returns:
+        dict of pid -> [(tag, value)], or the written tag store if only the store is written
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {output_format}. Must be one of {OUTPUT_FORMATS}")
+    if state_file and shard:
+        raise ValueError("state_file can not be combined with shard")
+    if state_file and workers > 1:
+        raise ValueError("state_file can not be combined with workers")
+    if state_file and method == 'centroid':
+        raise ValueError("state_file can not be combined with centroid method")
+    if resume and not output_prefix:
+        raise ValueError("resume requires output_prefix")
     logger.info("Loading data")
-    model = _load_model(model_file)
+    labels, vectors = _load_vectors(model_file)
     pid2tags = _load_pid2tag(archive_file)
-    labels = [model.docvecs.offset2doctag[i] for i in range(len(model.docvecs))]
+    clusters_file = dedup.clusters_file(model_file)
+    fanout = None
+    if clusters_file:
+        labels, vectors, fanout = _expand_clusters(labels, vectors, pid2tags, clusters_file)
+    index_file = (index_file or f"{model_file.rstrip('/')}.ivf.npz") if index == 'ann' and method == 'knn' else None
+    scorer = _Scorer(topn, min_similarity, by_value, min_value, neighbours, nprobe, method)
+    stem = output_prefix
+    if output_prefix and shard:
+        stem = f"{output_prefix}-shard-{shard[0]}-of-{shard[1]}"
+    partial = checkpoint.Partial(f"{stem}.partial") if output_prefix and not state_file else None
+
+    if state_file:
+        generated = _generate_tags_incremental(vectors, pid2tags, labels, scorer, state_file, block_size, index_file)
+    else:
+        generated = _generate_tags(vectors, pid2tags, labels, scorer, block_size, index_file, recall_sample, workers, shard,
+                                   partial, resume, checkpoint_every)
+    if fanout:
+        generated = _fan_out(generated, fanout)
+    if not output_prefix:
+        return {label: tags for label, tags in generated}
+    result = _write_tags(generated, stem, output_format, index=not shard)
+    if partial:
+        partial.remove()
+    return result
+
+
+def merge_shards(shard_files, output_prefix='predicted-tags', output_format='both'):
+    """
+    Merges the results written by sharded runs of generate_tags
+
+    :param shard_files:
+        Tag stores or pickle files written by generate_tags with shard
+    :param output_prefix:
+        If given, the merged tags are written to file
+    :param output_format:
+        as in generate_tags. The inverted tag index OUTPUT_PREFIX.tag-index of the merged tags is written as well
+    """
+    def generated():
+        for shard_file in shard_files:
+            logger.info("Loading shard %s", shard_file)
+            yield from load_tags(shard_file).items()
+
+    if not output_prefix:
+        return dict(generated())
+    return _write_tags(generated(), output_prefix, output_format)
+
 
-    result = {label: tags for label, tags in _generate_tags(model, pid2tags, labels, topn, min_similarity, by_value, min_value)}
-    if output_prefix:
-        name = f"{output_prefix}-{len(result)}.pkl"
+def load_tags(path):
+    """ Returns pid -> [(tag, value)] from tag store or pickle file written by generate_tags """
+    if tag_store.is_store(path):
+        return tag_store.load(path)
+    import joblib
+    return joblib.load(path)
+
+
+def _write_tags(generated, stem, output_format, index=True):
+    """
+    Writes (pid, subjects) pairs to tag store STEM.tags and/or pickle STEM-N.pkl, and if index
+    is set the inverted tag index STEM.tag-index, and returns the tags
+    """
+    result = {} if output_format != 'store' else None
+    writer = tag_store.Writer(f"{stem}.tags") if output_format != 'pickle' else None
+    try:
+        for label, tags in generated:
+            if writer:
+                writer.write(label, tags)
+            if result is not None:
+                result[label] = tags
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.close()
+    if result is None:
+        result = tag_store.load(f"{stem}.tags")
+    else:
+        name = f"{stem}-{len(result)}.pkl"
         logger.info("Writing result to file %s", name)
-        joblib.dump(result, name)
+        checkpoint.dump(result, name)
+    if index:
+        tag_index.build(result, f"{stem}.tag-index")
     return result
 
 
-def _generate_tags(model, pid2tags, labels, topn, min_similarity, by_value, min_value):
-    for i, label in tqdm(enumerate(labels)):
-        if label not in pid2tags:
-            sims = model.docvecs.most_similar(positive=[model.docvecs[i]], topn=len(model.docvecs))
-            sims = [s for s in sims if s[0] in pid2tags and s[1] > min_similarity]
-            logger.debug("found %d similar items for %s", len(sims), labels)
-            tags = _get_subjects(sims, pid2tags, topn, by_value)
-            if min_value:
-                tags = [(t, v) for t, v in tags if v >= min_value]
-            logger.debug("Identified following tags for %s: %s", label, tags)
-            if tags:
-                yield label, tags
+def sweep(model_file, archive_file, min_similarities=(0.45,), topns=(None,), by_values=(False,), min_values=(None,),
+          neighbours=SWEEP_NEIGHBOURS, cache_file=None, block_size=BLOCK_SIZE, out=None):
+    """
+    Summarizes the coverage of generated tags for combinations of parameters
+
+    The top neighbours of each pid above the smallest min_similarity are
+    computed once and cached, and tags are aggregated from the cache for
+    every combination of parameters.
+
+    :param model_file:
+        File containing doc2vec model, or directory containing vector store
+    :param archive file:
+        Content-first archive file
+    :param min_similarities, topns, by_values, min_values:
+        Values of the generate_tags parameters to combine
+    :param neighbours:
+        Number of neighbours cached for each pid. The summary matches generate_tags
+        as long as no pid has more neighbours than this above min_similarity
+    :param cache_file:
+        File holding the cached neighbours. Default is MODEL_FILE.neighbours-NEIGHBOURS.npz
+    :param out:
+        If given, the summary is written to this stream as tab separated values
+    :returns:
+        list of dicts with parameters, pids, pids_with_tags, coverage and mean_tags
+    """
+    labels, vectors = _load_vectors(model_file)
+    pid2tags = _load_pid2tag(archive_file)
+    scorer = _Scorer(None, min(min_similarities), True, None, neighbours)
+    vectors, queries = _prepare(vectors, pid2tags, labels, scorer)
+    cache_file = cache_file or f"{model_file.rstrip('/')}.neighbours-{neighbours}.npz"
+    _, similarities = _update_neighbours(vectors, queries, pid2tags, labels, scorer, cache_file, block_size)
+
+    summary = []
+    for min_similarity in sorted(set(min_similarities)):
+        kept = similarities.multiply(similarities > min_similarity).tocsr()
+        for by_value in by_values:
+            weights = kept.copy()
+            if not by_value:
+                weights.data[:] = 1
+            tag_values = (weights @ scorer.tag_matrix).tocsr()
+            for min_value in min_values:
+                above = tag_values.copy()
+                above.data = (above.data >= min_value) if min_value else (above.data != 0)
+                counts = np.asarray(above.sum(axis=1)).ravel()
+                for topn in topns:
+                    tag_counts = np.minimum(counts, topn) if topn else counts
+                    with_tags = int(np.count_nonzero(tag_counts))
+                    summary.append({'min_similarity': min_similarity, 'topn': topn, 'by_value': by_value, 'min_value': min_value,
+                                    'pids': len(queries), 'pids_with_tags': with_tags,
+                                    'coverage': with_tags / max(len(queries), 1),
+                                    'mean_tags': float(tag_counts.sum()) / max(with_tags, 1)})
+    if out:
+        columns = list(summary[0].keys()) if summary else []
+        out.write('\t'.join(columns) + '\n')
+        for row in summary:
+            out.write('\t'.join(f'{row[c]:.4f}' if isinstance(row[c], float) else str(row[c]) for c in columns) + '\n')
+    return summary
+
+
+class TagScorer():
+    """
+    Scores vectors of new pids against the content-first pids of a model the way generate_tags does
+
+    :param labels, vectors:
+        doc tags and docvecs of the model
+    :param pid2tags:
+        content-first archive (see :mod:`b_records.archive`)
+    :param topn, min_similarity, by_value, min_value, neighbours, method:
+        as in generate_tags
+    :param clusters_file:
+        If given, the members of the near-duplicate clusters of the model are added as in generate_tags,
+        and the untagged members get the tags of the pid scored for their cluster
+    """
+    def __init__(self, labels, vectors, pid2tags, topn=None, min_similarity=0.45, by_value=False, min_value=None, neighbours=None,
+                 method='knn', clusters_file=None):
+        self.fanout = {}
+        if clusters_file:
+            labels, vectors, self.fanout = _expand_clusters(labels, vectors, pid2tags, clusters_file)
+        self.scorer = _Scorer(topn, min_similarity, by_value, min_value, neighbours, method=method)
+        _prepare(vectors, pid2tags, labels, self.scorer)
+
+    def score(self, pids, vectors):
+        """ Yields (pid, subjects) for pids and their vectors, each followed by the cluster members getting its subjects """
+        return _fan_out(zip(pids, self.scorer(_normalize(vectors))), self.fanout)
+
+
+class _Scorer():
+    """ Scores blocks of pids against the content-first pids, or against the tag centroids """
+    def __init__(self, topn, min_similarity, by_value, min_value, neighbours=None, nprobe=ann_index.NPROBE, method='knn'):
+        self.method = method
+        self.topn = topn
+        self.min_similarity = min_similarity
+        self.by_value = by_value
+        self.min_value = min_value
+        self.neighbours = neighbours
+        self.nprobe = nprobe
+        self.tagged_vectors = None
+        self.tag_matrix = None
+        self.tags = None
+        self.index = None
+        self.centroids = None
+
+    def __call__(self, vectors):
+        """ Returns the (tag, value) list for each of the given normalized vectors """
+        if self.method == 'centroid':
+            with metrics.phase('similarity', len(vectors)):
+                scores = vectors @ self.centroids.T
+                scores = np.where(scores > self.min_similarity, scores, 0)
+            with metrics.phase('aggregation', len(vectors)):
+                return list(_top_subjects(scores, self.tags, self.topn, True, self.min_value))
+        if self.index:
+            return self.subjects(self.similarities(vectors))
+        with metrics.phase('similarity', len(vectors)):
+            weights = _weights(vectors @ self.tagged_vectors.T, self.min_similarity, self.neighbours, self.by_value)
+        with metrics.phase('aggregation', len(vectors)):
+            return list(_get_subjects(weights, self.tag_matrix, self.tags, self.topn, self.by_value, self.min_value))
+
+    def similarities(self, vectors):
+        """ Returns sparse matrix with the similarity of the neighbours kept for each of the given normalized vectors """
+        with metrics.phase('similarity', len(vectors)):
+            if self.index:
+                return self.index.search(vectors, self.tagged_vectors, self.min_similarity, self.neighbours, self.nprobe)
+            return sparse.csr_matrix(_weights(vectors @ self.tagged_vectors.T, self.min_similarity, self.neighbours, True))
+
+    def subjects(self, similarities):
+        """ Returns the (tag, value) list for each row of a neighbour similarity matrix """
+        with metrics.phase('aggregation', similarities.shape[0]):
+            weights = similarities
+            if not self.by_value:
+                weights = similarities.copy()
+                weights.data[:] = 1
+            return list(_get_subjects(weights, self.tag_matrix, self.tags, self.topn, self.by_value, self.min_value))
+
+
+def _generate_tags(vectors, pid2tags, labels, scorer, block_size=BLOCK_SIZE, index_file=None, recall_sample=None, workers=1,
+                   shard=None, partial=None, resume=False, checkpoint_every=CHECKPOINT_EVERY):
+    """ Yields (pid, subjects) of the pids to tag. Given a checkpoint.Partial, completed blocks are flushed to it """
+    from tqdm import tqdm
+
+    vectors, queries = _prepare(vectors, pid2tags, labels, scorer, index_file, recall_sample, shard)
+    blocks = [queries[start:start + block_size] for start in range(0, len(queries), block_size)]
+    completed = partial.open(_job_key(vectors, labels, queries, block_size, scorer), resume) if partial else {}
+    pending = [b for b in range(len(blocks)) if b not in completed]
+    with tqdm(total=len(queries), initial=sum(len(blocks[b]) for b in completed)) as progress:
+        for results in completed.values():
+            yield from results
+        for b, block_subjects in zip(pending, _score_blocks(scorer, vectors, [blocks[b] for b in pending], workers)):
+            results = []
+            for i, subjects in zip(blocks[b], block_subjects):
+                logger.debug("Identified following tags for %s: %s", labels[i], subjects)
+                if subjects:
+                    results.append((labels[i], subjects))
+            yield from results
+            if partial:
+                partial.add(b, results)
+                if len(partial.pending) >= checkpoint_every:
+                    partial.flush()
+            progress.update(len(blocks[b]))
+    if partial:
+        partial.flush()
+
+
+def _expand_clusters(labels, vectors, pid2tags, clusters_file):
+    """
+    Adds the members of the clusters of near-duplicates that are not in the model, with the
+    vector of their representative. Tagged members are added as content-first pids. Of the
+    untagged members only one is added, if the representative is tagged, and the others get
+    the tags of the pid scored for their cluster.
+
+    :returns:
+        labels, vectors and pid -> members getting the tags of pid
+    """
+    clusters, _ = dedup.load_clusters(clusters_file)
+    index = {label: i for i, label in enumerate(labels)}
+    added, rows = [], []
+    fanout = {}
+    scored = {}
+    for member, representative in clusters.items():
+        if member in index or representative not in index:
+            continue
+        if member in pid2tags or (representative in pid2tags and representative not in scored):
+            added.append(member)
+            rows.append(index[representative])
+            if member not in pid2tags:
+                scored[representative] = member
+        else:
+            fanout.setdefault(scored.get(representative, representative), []).append(member)
+    if rows:
+        labels = list(labels) + added
+        vectors = np.concatenate([np.asarray(vectors), np.asarray(vectors)[rows]])
+    fanned = sum(len(members) for members in fanout.values())
+    queries = sum(1 for label in labels if label not in pid2tags)
+    logger.info("Scoring %d pids for %d pids to tag. %d near-duplicates get the tags of their cluster (%.1f%% less scoring)",
+                queries, queries + fanned, fanned, 100 * fanned / max(queries + fanned, 1))
+    return labels, vectors, fanout
+
+
+def _fan_out(generated, fanout):
+    """ Yields the (pid, subjects) pairs of generated followed by the members getting the subjects of pid """
+    for label, subjects in generated:
+        yield label, subjects
+        for member in fanout.get(label, ()):
+            yield member, subjects
+
+
+def _job_key(vectors, labels, queries, block_size, scorer):
+    """ Hash identifying the vectors, tags, pids and parameters of a run, so partial results are only reused by the same run """
+    h = hashlib.sha1(ann_index.fingerprint(vectors).encode())
+    h.update(json.dumps([[labels[i] for i in queries], [str(t) for t in scorer.tags], block_size, scorer.method, scorer.topn,
+                         scorer.min_similarity, scorer.by_value, scorer.min_value, scorer.neighbours, scorer.nprobe,
+                         scorer.index is not None]).encode())
+    h.update(scorer.tag_matrix.indptr.tobytes())
+    h.update(scorer.tag_matrix.indices.tobytes())
+    return h.hexdigest()
+
+
+def _generate_tags_incremental(vectors, pid2tags, labels, scorer, state_file, block_size=BLOCK_SIZE, index_file=None):
+    """ Like _generate_tags, but reuses the neighbours stored in state_file and writes the updated neighbours back """
+    from tqdm import tqdm
+
+    vectors, queries = _prepare(vectors, pid2tags, labels, scorer, index_file)
+    query_labels, similarities = _update_neighbours(vectors, queries, pid2tags, labels, scorer, state_file, block_size)
+    for start in tqdm(range(0, len(queries), block_size)):
+        for label, subjects in zip(query_labels[start:start + block_size], scorer.subjects(similarities[start:start + block_size])):
+            logger.debug("Identified following tags for %s: %s", label, subjects)
+            if subjects:
+                yield label, subjects
+
+
+def _update_neighbours(vectors, queries, pid2tags, labels, scorer, state_file, block_size=BLOCK_SIZE):
+    """ Returns pids and neighbour similarities of queries, reusing and updating the neighbours stored in state_file """
+    query_labels = [labels[i] for i in queries]
+    tagged_labels = [label for label in labels if label in pid2tags]
+    method = 'ann' if scorer.index else 'exact'
+
+    state = neighbour_lists.load(state_file)
+    if state is not None and (state['method'], state['min_similarity'], state['neighbours']) != \
+            (method, scorer.min_similarity, scorer.neighbours):
+        logger.info("Search parameters differ from %s. Searching all pids", state_file)
+        state = None
+    similarities, query_hashes, tagged_hashes = neighbour_lists.update(state, scorer, vectors[queries], query_labels, tagged_labels,
+                                                                       block_size)
+    neighbour_lists.save(state_file, {'queries': query_labels, 'tagged': tagged_labels, 'query_hashes': query_hashes,
+                                      'tagged_hashes': tagged_hashes, 'similarities': similarities, 'method': method,
+                                      'min_similarity': scorer.min_similarity, 'neighbours': scorer.neighbours})
+    return query_labels, similarities
+
+
+def _prepare(vectors, pid2tags, labels, scorer, index_file=None, recall_sample=None, shard=None):
+    """ Sets up scorer with the content-first pids, and returns normalized vectors and the indices of the pids to tag """
+    with metrics.phase('prepare', len(labels)):
+        return _prepare_scorer(vectors, pid2tags, labels, scorer, index_file, recall_sample, shard)
+
+
+def _prepare_scorer(vectors, pid2tags, labels, scorer, index_file=None, recall_sample=None, shard=None):
+    vectors = _normalize(vectors)
+    tagged = [i for i, label in enumerate(labels) if label in pid2tags]
+    queries = [i for i, label in enumerate(labels) if label not in pid2tags]
+    if shard:
+        queries = queries[shard[0]::shard[1]]
+    scorer.tagged_vectors = vectors[tagged]
+    scorer.tag_matrix, scorer.tags = _tag_matrix(pid2tags, [labels[i] for i in tagged])
+    if scorer.method == 'centroid':
+        scorer.centroids = _normalize(scorer.tag_matrix.T.dot(scorer.tagged_vectors))
+    logger.info("Scoring %d pids against %d content-first pids with %d tags", len(queries), len(tagged), len(scorer.tags))
+
+    if index_file:
+        scorer.index = ann_index.load_or_build(index_file, scorer.tagged_vectors)
+        if recall_sample:
+            sample = np.random.default_rng(0).choice(queries, min(recall_sample, len(queries)), replace=False)
+            ann_index.recall_report(scorer.index, vectors[sample], scorer.tagged_vectors, scorer.min_similarity,
+                                    scorer.neighbours, scorer.nprobe)
+    return vectors, queries
+
+
+def _score_blocks(scorer, vectors, blocks, workers):
+    """
+    Yields the scored subjects of each block. With more than one worker the
+    vectors are memory mapped by the workers, so they share the pages instead
+    of each receiving a pickled copy. Vectors that are not already mapped
+    from a file are written to a temporary directory first
+    """
+    if workers <= 1:
+        for block in blocks:
+            yield scorer(vectors[block])
+        return
+
+    with tempfile.TemporaryDirectory(prefix='generate-subjects-') as tmpdir:
+        vectors_file = getattr(vectors, 'filename', None)
+        if not vectors_file:
+            vectors_file = os.path.join(tmpdir, 'vectors.npy')
+            np.save(vectors_file, vectors)
+        tagged_file = os.path.join(tmpdir, 'tagged.npy')
+        np.save(tagged_file, scorer.tagged_vectors)
+        shared = copy.copy(scorer)
+        shared.tagged_vectors = None
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(shared, vectors_file, tagged_file)) as pool:
+            yield from pool.imap(_score_block, blocks)
+
+
+_worker = {}
+
+
+def _init_worker(scorer, vectors_file, tagged_file):
+    scorer.tagged_vectors = np.load(tagged_file, mmap_mode='r')
+    _worker['scorer'] = scorer
+    _worker['vectors'] = np.load(vectors_file, mmap_mode='r')
+
+
+def _score_block(block):
+    return _worker['scorer'](_worker['vectors'][block])
+
+
+def _normalize(vectors):
+    """ Returns float32 vectors scaled to unit length. Vectors that already are unit length are not copied """
+    vectors = np.asarray(vectors, dtype=np.float32) if not isinstance(vectors, np.ndarray) else vectors
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    if vectors.dtype == np.float32 and np.allclose(norms, 1, atol=1e-4):
+        return vectors
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+def _weights(scores, min_similarity, neighbours, by_value):
+    """ Returns the score (by_value) or 1 for the neighbours kept in each row, and 0 elsewhere """
+    keep = scores > min_similarity
+    if neighbours and neighbours < scores.shape[1]:
+        top = np.zeros_like(keep)
+        np.put_along_axis(top, np.argpartition(-scores, neighbours - 1, axis=1)[:, :neighbours], True, axis=1)
+        keep &= top
+    return np.where(keep, scores, 0) if by_value else keep.astype(np.float32)
 
 
 def _load_model(path):
+    import joblib
+
     logger.debug("Loading model from %s", path)
     return joblib.load(path)
 
 
+def _load_vectors(path):
+    """ Returns doc tags and docvecs from vector store or pickled doc2vec model """
+    with metrics.phase('load model') as measured:
+        if vector_store.is_store(path):
+            store = vector_store.load(path)
+            labels, vectors = store.tags, store.matrix()
+        else:
+            model = _load_model(path)
+            labels, vectors = [model.docvecs.offset2doctag[i] for i in range(len(model.docvecs))], model.docvecs.vectors_docs
+        measured.items = len(labels)
+    return labels, vectors
+
+
 def _load_pid2tag(archive_file):
-    logger.debug("Loading ta archive from %s", archive_file)
-    tag_archive_content = ld.load_tag_data(archive_file)
-    return {k: {p[0] for p in v} for k, v in ld.pid2tags(tag_archive_content)}
+    """ Returns pid -> tags of content-first archive (see :mod:`b_records.archive`) """
+    logger.debug("Loading tag archive from %s", archive_file)
+    return archive.load(archive_file)
+
+
+def _tag_matrix(pid2tags, pids):
+    """ Returns sparse pid x tag indicator matrix for pids, and the tag of each column """
+    if isinstance(pid2tags, archive.Archive):
+        return pid2tags.tag_matrix(pids)
+    tags = sorted({tag for pid in pids for tag in pid2tags[pid]})
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+    indptr = [0]
+    indices = []
+    for pid in pids:
+        indices.extend(sorted(tag_index[tag] for tag in pid2tags[pid]))
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(pids), len(tags))), tags
 
 
-def _get_subjects(sims, pid2tags, topn, by_value):
-    tag_value = defaultdict(lambda: 0)
-    for pid, value in sims:
-        for tag in pid2tags[pid]:
-            if by_value:
-                tag_value[tag] += value
-            else:
-                tag_value[tag] += 1
-    tags = sorted(list(tag_value.items()), key=lambda x: x[1], reverse=True)
-    if topn:
-        tags = tags[:topn]
-    return tags
+def _get_subjects(weights, tag_matrix, tags, topn, by_value, min_value):
+    """
+    Yields the (tag, value) list of each row in weights
+
+    :param weights:
+        queries x tagged pids matrix (dense or sparse) holding the similarity
+        (by_value) or 1 for each neighbour, and 0 elsewhere
+    """
+    tag_values = tag_matrix.T.dot(weights.T).T
+    tag_values = tag_values.toarray() if sparse.issparse(tag_values) else np.asarray(tag_values)
+    return _top_subjects(tag_values, tags, topn, by_value, min_value)
+
+
+def _top_subjects(tag_values, tags, topn, by_value, min_value):
+    """ Yields the (tag, value) list of the highest non-zero values in each row of tag_values """
+    for row in tag_values:
+        candidates = np.flatnonzero(row)
+        if topn and topn < len(candidates):
+            candidates = candidates[np.argpartition(-row[candidates], topn - 1)[:topn]]
+        candidates = candidates[np.lexsort((candidates, -row[candidates]))]
+        if by_value:
+            subjects = [(tags[c], float(row[c])) for c in candidates]
+        else:
+            subjects = [(tags[c], int(round(row[c]))) for c in candidates]
+        if min_value:
+            subjects = [(t, v) for t, v in subjects if v >= min_value]
+        yield subjects
 
 
 def cli():
     """ Commandline interface """
     import argparse
+    import sys
+
+    subcommands = {'merge': _merge_cli, 'sweep': _sweep_cli}
+    if sys.argv[1:2] and sys.argv[1] in subcommands:
+        return subcommands[sys.argv[1]](sys.argv[2:])
 
-    parser = argparse.ArgumentParser(description='Generate tags based on abstract')
+    parser = argparse.ArgumentParser(description='Generate tags based on abstract',
+                                     epilog="Shard results are combined with 'merge SHARD_FILE...'. "
+                                            "Parameters are compared with 'sweep MODEL_FILE ARCHIVE_FILE'")
     parser.add_argument('model_file',
-                        help='file containing abstract_model')
+                        help='file containing abstract_model, or directory containing exported vectors')
     parser.add_argument('archive_file',
                         help='archive file')
     parser.add_argument('-o', '--outfile-prefix',
@@ -117,6 +683,35 @@ def cli():
                         help='calculates tag value by similarity rather than occurence')
     parser.add_argument('--min-value', type=float,
                         help='minimum value of a tag to be returned (This will be at a different scale if you have chosen by-value)')
+    parser.add_argument('--block-size', type=int,
+                        help=f'number of pids scored in each batch. Default is {BLOCK_SIZE}', default=BLOCK_SIZE)
+    parser.add_argument('--index', choices=['exact', 'ann'], default='exact',
+                        help='exact scores all content-first pids, ann uses an approximate index stored next to the model. Default is exact')
+    parser.add_argument('--index-file',
+                        help='file holding the ann index. Default is MODEL_FILE.ivf.npz', default=None)
+    parser.add_argument('--neighbours', type=int,
+                        help='maximum number of neighbours used for each item', default=None)
+    parser.add_argument('--nprobe', type=int,
+                        help=f'number of index lists scanned with --index ann. Default is {ann_index.NPROBE}', default=ann_index.NPROBE)
+    parser.add_argument('--recall-sample', type=int,
+                        help='reports recall of the ann index against exact search on this many items', default=None)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of worker processes. Default is 1', default=1)
+    parser.add_argument('--shard', type=_shard,
+                        help='only process shard i of n (given as i/n, 0 <= i < n)', default=None)
+    parser.add_argument('--method', choices=['knn', 'centroid'], default='knn',
+                        help='knn counts tags of similar content-first items, centroid scores items against one centroid per tag. '
+                             'Default is knn')
+    parser.add_argument('--state',
+                        help='file storing neighbours between runs. Only new or changed items are searched again. '
+                             'Runs in a single process', default=None)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run from the results flushed to OUTFILE_PREFIX.partial')
+    parser.add_argument('--checkpoint-every', type=int,
+                        help=f'number of completed batches flushed at a time. Default is {CHECKPOINT_EVERY}', default=CHECKPOINT_EVERY)
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='both',
+                        help='write a tag store (OUTFILE_PREFIX.tags), a pickle (OUTFILE_PREFIX-N.pkl) or both. Default is both')
+    metrics.add_arguments(parser)
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='verbose output')
     args = parser.parse_args()
@@ -126,4 +721,87 @@ def cli():
         level = logging.DEBUG
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
 
-    generate_tags(args.model_file, args.archive_file, args.outfile_prefix, args.topn, args.min_similarity, args.by_value, args.min_value)
+    with metrics.instrument(args.metrics_file, args.profile):
+        generate_tags(args.model_file, args.archive_file, args.outfile_prefix, args.topn, args.min_similarity, args.by_value,
+                      args.min_value, args.block_size, args.index, args.neighbours, args.nprobe, args.recall_sample,
+                      args.workers, args.shard, args.state, args.method, args.resume, args.checkpoint_every,
+                      args.format, args.index_file)
+
+
+def _merge_cli(argv):
+    """ Commandline interface for merging shards """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='generate_subjects merge', description='Merge results of sharded tag generation')
+    parser.add_argument('shard_files', nargs='+',
+                        help='tag stores or files written by sharded runs')
+    parser.add_argument('-o', '--outfile-prefix',
+                        help='file to write result to. Default is predicted-tags', default='predicted-tags')
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='both',
+                        help='write a tag store, a pickle or both. Default is both')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args(argv)
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    merge_shards(args.shard_files, args.outfile_prefix, args.format)
+
+
+def _sweep_cli(argv):
+    """ Commandline interface for parameter sweeps """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='generate_subjects sweep',
+                                     description='Summarize tag coverage for combinations of parameters from cached neighbours')
+    parser.add_argument('model_file',
+                        help='file containing abstract_model, or directory containing exported vectors')
+    parser.add_argument('archive_file',
+                        help='archive file')
+    parser.add_argument('--min-similarity', type=float, nargs='+',
+                        help='minimum similarities to try. Default is 0.45', default=[0.45])
+    parser.add_argument('--topn', type=int, nargs='+',
+                        help='topn values to try (0 means no limit). Default is 0', default=[0])
+    parser.add_argument('--mode', choices=['count', 'value'], nargs='+',
+                        help='count tags by occurence and/or by similarity (by-value). Default is count', default=['count'])
+    parser.add_argument('--min-value', type=float, nargs='+',
+                        help='minimum values to try (0 means no minimum). Default is 0', default=[0])
+    parser.add_argument('--neighbours', type=int,
+                        help=f'number of neighbours cached for each item. Default is {SWEEP_NEIGHBOURS}', default=SWEEP_NEIGHBOURS)
+    parser.add_argument('--cache-file',
+                        help='file holding cached neighbours. Default is MODEL_FILE.neighbours-NEIGHBOURS.npz', default=None)
+    parser.add_argument('-o', '--outfile',
+                        help='file to write summary to. Default is stdout', default=None)
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args(argv)
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    params = dict(min_similarities=args.min_similarity, topns=[t or None for t in args.topn],
+                  by_values=[m == 'value' for m in args.mode], min_values=[v or None for v in args.min_value],
+                  neighbours=args.neighbours, cache_file=args.cache_file)
+    if args.outfile:
+        with open(args.outfile, 'w') as out:
+            sweep(args.model_file, args.archive_file, out=out, **params)
+    else:
+        sweep(args.model_file, args.archive_file, out=sys.stdout, **params)
+
+
+def _shard(value):
+    import argparse
+
+    try:
+        i, n = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must be given as i/n, got '{value}'")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard index must satisfy 0 <= i < n, got '{value}'")
+    return i, n
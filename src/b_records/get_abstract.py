@@ -10,69 +10,113 @@ Get Abstracts
 
 Harvest abstracts from LOWELL and writes them to file.
 
+Alternatively abstracts can be harvested incrementally into a local
+:mod:`b_records.abstract_store`. LOWELL is then only asked for the md5
+hash of each abstract, and only new or changed abstracts are fetched.
+
+With `parallel` set to N, the metadata scan is split into N disjoint
+partitions by a hash of the pid, and the partitions are fetched
+concurrently on pooled connections.
+
 """
-import joblib
-import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import logging
-import os
-from psycopg2 import connect
-import psycopg2.extras
 
-import recommender_common.load_compass_data as ld
+from b_records import archive
+from b_records import db
+from b_records import metrics
+from b_records.abstract_store import AbstractStore
 
 logger = logging.getLogger(__name__)
 
 
-class _Cursor():
-    """ postgres cursor """
-    def __init__(self, postgres_url):
-        self.postgres_url = postgres_url
+ITERSIZE = db.ITERSIZE
+CHUNK_SIZE = 10000
 
-    def __enter__(self):
 
-        self.conn = connect(self.postgres_url)
-        self.cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        return self.cur
+def _get_abstracts(compass_pids, limit=None, min_length=1, itersize=ITERSIZE, hashes=False, partition=None, maxconn=db.MAXCONN):
+    """
+    Yields (pid, abstract) for content-first pids, and for other pids that
+    are books (Bog, Lydbog, Ebog), fiction or biographies (dk5 sk, 99.4)
+    and have abstracts of at least min_length chars.
+    If hashes is True, the md5 hash of the abstract is yielded instead.
+    If partition (i, n) is given, only the i'th of n partitions of the pids is fetched.
+    maxconn is the size of the connection pool, which must cover the concurrent partitions
+    """
+    logger.info(f"Fetching abstracts from LOWELL limit={limit}, min_length={min_length}, partition={partition}")
+    abstract = _first('abstract')
+    column = f"md5({abstract})" if hashes else abstract
+    stmt = f"""SELECT pid, {column} AS abstract
+               FROM metadata
+               WHERE metadata->>'abstract' IS NOT NULL
+                 AND metadata->'collection' ?| ARRAY['870970-basis']
+                 AND metadata->'audience' ?| ARRAY['voksenmaterialer']
+                 AND metadata->'language' ?| ARRAY['dan']
+                 AND (pid = ANY(%(compass_pids)s)
+                      OR (length({abstract}) >= %(min_length)s
+                          AND EXISTS (SELECT 1 FROM jsonb_array_elements_text({_as_array('type')}) AS t(type)
+                                      WHERE t.type LIKE 'Bog%%' OR t.type LIKE 'Lydbog%%' OR t.type LIKE 'Ebog%%')
+                          AND EXISTS (SELECT 1 FROM jsonb_array_elements_text({_as_array('dk5')}) AS d(dk5)
+                                      WHERE d.dk5 = 'sk' OR d.dk5 = '99.4' OR d.dk5 LIKE '99.4 %%')))"""
+    params = {'compass_pids': list(compass_pids), 'min_length': min_length}
+    if partition:
+        stmt += " AND mod(hashtext(pid)::bigint + 2147483648, %(partitions)s) = %(partition)s"
+        params['partition'], params['partitions'] = partition
+    if limit:
+        stmt += " LIMIT %(limit)s"
+        params['limit'] = limit
+    with db.Cursor(name='abstracts', itersize=itersize, maxconn=maxconn) as cur:
+        cur.execute(stmt, params)
+        for pid, abstract in cur:
+            yield pid, abstract
 
-    def __exit__(self, type, value, traceback):
 
-        self.conn.commit()
-        self.cur.close()
-        self.conn.close()
+def _as_array(field):
+    """ SQL expression for a metadata field, with a scalar wrapped in a one element array so its elements can be extracted """
+    return (f"CASE jsonb_typeof(metadata->'{field}') WHEN 'array' THEN metadata->'{field}' "
+            f"ELSE jsonb_build_array(metadata->'{field}') END")
 
 
-def _type(item):
-    if item.startswith('Bog') or item.startswith('Lydbog') or item.startswith('Ebog'):
-        return True
-    return False
+def _first(field):
+    """ SQL expression for the first element of a metadata field as text, or the field itself if it is a scalar """
+    return f"({_as_array(field)})->>0"
 
 
-def _dk5(item):
-    if item == 'sk' or item == '99.4' or item.startswith('99.4 '):
-        return True
-    return False
+def _get_abstracts_parallel(compass_pids, limit=None, min_length=1, itersize=ITERSIZE, hashes=False, parallel=1):
+    """ Returns list of (pid, abstract) fetched by parallel concurrent partitions, see _get_abstracts """
+    if parallel <= 1:
+        return list(_get_abstracts(compass_pids, limit, min_length, itersize, hashes))
 
+    def fetch(i):
+        return list(_get_abstracts(compass_pids, -(-limit // parallel) if limit else None, min_length, itersize, hashes,
+                                   partition=(i, parallel), maxconn=_maxconn(parallel)))
 
-def _get_abstracts(compass_pids, limit=None, min_length=1):
-    logger.info(f"Fetching abstracts from LOWELL limit={limit}, min_length={min_length}")
-    stmt = """SELECT pid, metadata->>'dk5' AS dk5, metadata->>'type' AS type, metadata->>'abstract' AS abstract
-              FROM metadata
-              WHERE metadata->>'abstract' IS NOT NULL
-                AND metadata->'collection' ?| ARRAY['870970-basis']
-                AND metadata->'audience' ?| ARRAY['voksenmaterialer']
-                AND metadata->'language' ?| ARRAY['dan']"""
-    if limit:
-        stmt += f" limit {limit}"
-    with _Cursor(os.environ['LOWELL_URL']) as cur:
-        cur.execute(stmt)
-        for row in cur:
-            if 'abstract' in row and row['pid'] in compass_pids:
-                yield(row['pid'], json.loads(row['abstract'])[0])
-            elif _type and _dk5 and len(row['abstract']) >= min_length:
-                yield(row['pid'], json.loads(row['abstract'])[0])
+    with ThreadPoolExecutor(parallel) as executor:
+        rows = [row for partition in executor.map(fetch, range(parallel)) for row in partition]
+    return rows[:limit] if limit else rows
+
+
+def _fetch_abstracts(pids, itersize=ITERSIZE, maxconn=db.MAXCONN):
+    """ Yields (pid, abstract, hash) for pids """
+    with db.Cursor(name='changed_abstracts', itersize=itersize, maxconn=maxconn) as cur:
+        abstract = _first('abstract')
+        cur.execute(f"""SELECT pid, {abstract}, md5({abstract})
+                       FROM metadata
+                       WHERE pid = ANY(%(pids)s)""", {'pids': list(pids)})
+        yield from cur
+
+
+def _maxconn(parallel):
+    """ Pool size holding a connection for each of parallel concurrent queries. The pool does not block when exhausted """
+    return max(parallel, db.MAXCONN)
+
+
+def _load_compass_pids(archive_file):
+    return set(archive.load(archive_file).pids)
 
 
-def get_abstracts(archive_file, outfile_prefix='abstracts', limit=None, min_length=100):
+def get_abstracts(archive_file, outfile_prefix='abstracts', limit=None, min_length=100, itersize=ITERSIZE, parallel=1):
     """
     :param archive file:
         Content-first archive file
@@ -82,17 +126,79 @@ def get_abstracts(archive_file, outfile_prefix='abstracts', limit=None, min_leng
         Limits the number of harvested abstracts
     :param min_length:
         Minimum length of harvested abstracts
+    :param itersize:
+        Number of rows fetched from LOWELL at a time
+    :param parallel:
+        Number of partitions fetched concurrently
     """
-    tag_archive_content = ld.load_tag_data(archive_file)
-    compass_pids = {k for k, v in ld.pid2tags(tag_archive_content)}
-    abstracts = {p: a for p, a in _get_abstracts(compass_pids, limit=limit, min_length=min_length)}
+    compass_pids = _load_compass_pids(archive_file)
+    with metrics.phase('db fetch') as measured:
+        abstracts = {p: a for p, a in _get_abstracts_parallel(compass_pids, limit=limit, min_length=min_length, itersize=itersize,
+                                                              parallel=parallel)}
+        measured.items = len(abstracts)
     if outfile_prefix:
+        import joblib
+
         name = f"{outfile_prefix}-{min_length}-{len(abstracts)}.pkl"
         logger.info(f"Writing data to {name}")
-        joblib.dump(abstracts, name)
+        with metrics.phase('serialization', len(abstracts)):
+            joblib.dump(abstracts, name)
     return abstracts
 
 
+def harvest(archive_file, store_file, limit=None, min_length=100, itersize=ITERSIZE, parallel=1):
+    """
+    Incrementally harvests abstracts into abstract store
+
+    Only abstracts that are new or whose hash has changed since the last
+    harvest are fetched, and abstracts that are no longer returned by
+    LOWELL are marked as deleted.
+
+    :param archive file:
+        Content-first archive file
+    :param store_file:
+        SQLite file holding the abstract store. It is created if missing
+    :param limit:
+        Limits the number of harvested abstracts. Nothing is deleted when limit is given
+    :param min_length:
+        Minimum length of harvested abstracts
+    :param itersize:
+        Number of rows fetched from LOWELL at a time
+    :param parallel:
+        Number of partitions fetched concurrently
+    :returns:
+        (added, changed, deleted) counts
+    """
+    started = datetime.now()
+    compass_pids = _load_compass_pids(archive_file)
+    with AbstractStore(store_file) as store:
+        logger.info("Last harvest into %s started %s", store_file, store.last_harvest())
+        stored = store.hashes()
+        with metrics.phase('db fetch') as measured:
+            current = dict(_get_abstracts_parallel(compass_pids, limit=limit, min_length=min_length, itersize=itersize, hashes=True,
+                                                   parallel=parallel))
+            measured.items = len(current)
+        updated = [pid for pid, h in current.items() if stored.get(pid) != h]
+        deleted = [] if limit else [pid for pid in stored if pid not in current]
+        logger.info("Fetching %d new or changed abstracts", len(updated))
+        chunks = [updated[start:start + CHUNK_SIZE] for start in range(0, len(updated), CHUNK_SIZE)]
+
+        def fetch(chunk):
+            with metrics.phase('db fetch', len(chunk)):
+                return list(_fetch_abstracts(chunk, itersize, _maxconn(parallel)))
+
+        with ThreadPoolExecutor(max(parallel, 1)) as executor:
+            for rows in executor.map(fetch, chunks):
+                with metrics.phase('store', len(rows)):
+                    store.upsert(rows)
+        store.delete(deleted)
+        added = sum(1 for pid in updated if pid not in stored)
+        store.record_harvest(started, added, len(updated) - added, len(deleted))
+    logger.info("Harvested %d new, %d changed and %d deleted abstracts in [%s]", added, len(updated) - added, len(deleted),
+                datetime.now() - started)
+    return added, len(updated) - added, len(deleted)
+
+
 def cli():
     """ Commandline interface """
     import argparse
@@ -106,6 +212,13 @@ def cli():
                         help='minimun number of chars in abstract', default=100)
     parser.add_argument('-l', '--limit', dest='limit', type=int,
                         help='limit number of harvested items)', default=None)
+    parser.add_argument('--itersize', type=int,
+                        help=f'number of rows fetched from LOWELL at a time. Default is {ITERSIZE}', default=ITERSIZE)
+    parser.add_argument('-p', '--parallel', type=int,
+                        help='number of partitions harvested concurrently. Default is 1', default=1)
+    parser.add_argument('-s', '--store',
+                        help='harvest incrementally into this abstract store (SQLite file) instead of writing a file', default=None)
+    metrics.add_arguments(parser)
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='verbose output')
     args = parser.parse_args()
@@ -115,4 +228,8 @@ def cli():
         level = logging.DEBUG
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
 
-    get_abstracts(args.archive, args.outfile_prefix, args.limit, args.min_length)
+    with metrics.instrument(args.metrics_file, args.profile):
+        if args.store:
+            harvest(args.archive, args.store, args.limit, args.min_length, args.itersize, args.parallel)
+        else:
+            get_abstracts(args.archive, args.outfile_prefix, args.limit, args.min_length, args.itersize, args.parallel)
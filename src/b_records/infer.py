@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.infer` -- Infer subjects
+
+==============
+Infer Subjects
+==============
+
+Generates subjects for new abstracts without retraining the doc2vec model.
+
+The abstracts are tokenized with the same filters used for training, a
+vector is inferred for each of them with the loaded model, and the vectors
+are scored against the content-first pids in micro batches with the same
+logic as :mod:`b_records.generate_subjects`. If the model was trained with
+dedup, the members of its near-duplicate clusters are added to the
+content-first pids and given the tags of their cluster, as in batch
+generation.
+
+The model can be held resident in a small http service, which accepts a
+POST of a json object mapping pid to abstract and answers with a json
+object mapping pid to a list of [tag, value] pairs.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from socketserver import ThreadingMixIn
+import threading
+import numpy as np
+from b_records import archive
+from b_records import dedup
+from b_records.build_doc2vec_model import preprocess
+from b_records.generate_subjects import TagScorer
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 64
+
+
+class Tagger():
+    """
+    Resident model and content-first pids for tagging new abstracts. Given the clusters file of
+    the model, the members of the clusters of a tagged pid are tagged with it
+    """
+    def __init__(self, model, pid2tags, topn=None, min_similarity=0.45, by_value=False, min_value=None, method='knn',
+                 batch_size=BATCH_SIZE, clusters_file=None):
+        self.model = model
+        self.batch_size = batch_size
+        labels = [model.docvecs.offset2doctag[i] for i in range(len(model.docvecs))]
+        self.scorer = TagScorer(labels, model.docvecs.vectors_docs, pid2tags, topn, min_similarity, by_value, min_value,
+                                method=method, clusters_file=clusters_file)
+        self.lock = threading.Lock()
+
+    def tag(self, abstracts):
+        """
+        Returns pid -> [(tag, value)] for the given abstracts, and for the cluster members
+        getting the tags of their pids
+
+        :param abstracts:
+            dict of pid -> abstract
+        """
+        items = list(abstracts.items())
+        result = {}
+        with self.lock:
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                vectors = np.array([self.model.infer_vector(preprocess(text)) for _, text in batch])
+                for pid, subjects in self.scorer.score([pid for pid, _ in batch], vectors):
+                    result[pid] = subjects
+        return result
+
+
+def load(model_file, archive_file, **kwargs):
+    """
+    Returns Tagger for pickled doc2vec model and content-first archive, with the clusters file
+    of the model if it was trained with dedup. kwargs are passed to Tagger
+    """
+    import joblib
+
+    logger.info("Loading model from %s", model_file)
+    return Tagger(joblib.load(model_file), archive.load(archive_file), clusters_file=dedup.clusters_file(model_file), **kwargs)
+
+
+def tag_abstracts(model_file, archive_file, abstracts, **kwargs):
+    """
+    Generates tags for new abstracts
+
+    :param model_file:
+        File containing pickled doc2vec model
+    :param archive file:
+        Content-first archive file
+    :param abstracts:
+        dict of pid -> abstract
+    :param kwargs:
+        topn, min_similarity, by_value, min_value, method and batch_size as in Tagger
+    """
+    return load(model_file, archive_file, **kwargs).tag(abstracts)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(tagger, host='localhost', port=8080):
+    """ Serves tagger over http until interrupted """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            try:
+                abstracts = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(abstracts, dict):
+                    raise ValueError("expected object of pid -> abstract")
+                for pid, abstract in abstracts.items():
+                    if not isinstance(abstract, str):
+                        raise ValueError(f"abstract of {pid} must be a string")
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+                return
+            self._reply(200, tagger.tag(abstracts))
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = _Server((host, port), Handler)
+    logger.info("Serving subjects on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Infer tags for new abstracts with an existing model')
+    parser.add_argument('model_file',
+                        help='file containing abstract_model')
+    parser.add_argument('archive_file',
+                        help='archive file')
+    parser.add_argument('abstracts', nargs='?',
+                        help='json file with object of pid -> abstract. Default is stdin', default=None)
+    parser.add_argument('--topn', type=int,
+                        help='limits the number of predicted tags for each item', default=None)
+    parser.add_argument('--min-similarity', type=float,
+                        help='minimum similarity to be considered. default is 0.45', default=0.45)
+    parser.add_argument('--by-value', action='store_true',
+                        help='calculates tag value by similarity rather than occurence')
+    parser.add_argument('--min-value', type=float,
+                        help='minimum value of a tag to be returned', default=None)
+    parser.add_argument('--method', choices=['knn', 'centroid'], default='knn',
+                        help='see generate_subjects. Default is knn')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='serve tags over http on this port instead of reading abstracts', default=None)
+    parser.add_argument('--host',
+                        help='host to serve on. Default is localhost', default='localhost')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    tagger = load(args.model_file, args.archive_file, topn=args.topn, min_similarity=args.min_similarity, by_value=args.by_value,
+                  min_value=args.min_value, method=args.method)
+    if args.serve:
+        serve(tagger, args.host, args.serve)
+    else:
+        if args.abstracts:
+            with open(args.abstracts) as f:
+                abstracts = json.load(f)
+        else:
+            abstracts = json.load(sys.stdin)
+        json.dump(tagger.tag(abstracts), sys.stdout, ensure_ascii=False)
+        sys.stdout.write('\n')
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.main` -- b-records command
+
+=================
+b-records Command
+=================
+
+Single command running the steps of the flow as subcommands, installed as
+the `b-records` console script (or run with `python -m b_records`)
+
+    b-records harvest ARCHIVE_FILE
+    b-records train ABSTRACTS_FILE
+    b-records generate MODEL_FILE ARCHIVE_FILE
+    b-records report PREDICTED_TAGS_FILE ARCHIVE_FILE
+
+The arguments following the subcommand are handled by the commandline
+interface of its module, which is only imported when the subcommand runs.
+The modules import heavy dependencies such as gensim, psycopg2, colored,
+recommender_common and joblib where they are used rather than at import
+time, so `b-records --help` and the help of the subcommands start without
+loading them. `benchmark startup` times the startup of each subcommand and
+fails when it exceeds a budget or loads any of these dependencies.
+"""
+from collections import OrderedDict
+import importlib
+import os
+import sys
+
+COMMANDS = OrderedDict([
+    ('harvest', ('get_abstract', 'harvest abstracts from LOWELL')),
+    ('dedup', ('dedup', 'remove near-duplicate abstracts from a tokenized corpus')),
+    ('train', ('build_doc2vec_model', 'build or update doc2vec model from harvested abstracts')),
+    ('export-vectors', ('vectors', 'export docvecs of a doc2vec model to a memory mappable vector store')),
+    ('generate', ('generate_subjects', "generate tags for pids. Also 'generate merge' and 'generate sweep'")),
+    ('report', ('report', 'create human readable report of generated tags')),
+    ('tags', ('tag_index', "look up pids by generated tags. Indexes are built with 'tags build'")),
+    ('infer', ('infer', 'infer tags for new abstracts with an existing model')),
+    ('pipeline', ('pipeline', 'run the whole flow, reusing the artifacts of unchanged steps')),
+    ('benchmark', ('benchmark', "time the steps on a synthetic corpus. Also 'benchmark startup' and 'benchmark compare'")),
+])
+
+
+def main(argv=None):
+    """ Runs the commandline interface of the subcommand given in argv. Default is sys.argv """
+    import argparse
+
+    argv = sys.argv[1:] if argv is None else argv
+    prog = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] and not sys.argv[0].endswith('.py') else 'b-records'
+    parser = argparse.ArgumentParser(prog=prog, usage=f"{prog} COMMAND [ARGS...]", description='Creates b-records for content-first',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='commands:\n' + '\n'.join(f"  {name:16s}{description}"
+                                                                      for name, (_, description) in COMMANDS.items()) +
+                                     f"\n\nRun '{prog} COMMAND --help' for the arguments of a command")
+    if not argv or argv[0] in ('-h', '--help'):
+        parser.print_help()
+        return 0 if argv else 2
+    command = argv[0]
+    if command not in COMMANDS:
+        parser.error(f"unknown command '{command}'. Choose from {', '.join(COMMANDS)}")
+
+    module = importlib.import_module(f"b_records.{COMMANDS[command][0]}")
+    sys.argv = [f"{prog} {command}"] + list(argv[1:])
+    return module.cli()
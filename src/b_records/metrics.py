@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.metrics` -- Metrics
+
+=======
+Metrics
+=======
+
+Lightweight instrumentation shared by the stages.
+
+Code marks the phases worth watching with
+
+    with metrics.phase('similarity', items=len(block)):
+        ...
+
+and each phase accumulates its number of calls, wall time, cpu time of the
+process, items and the peak resident set size of the process when the
+phase last ended. Phases may be nested or run on several threads; each is
+recorded on its own. Work done in worker processes is only seen as the
+wall time of the phase waiting for it.
+
+The entry points accept `--metrics-file`, which writes a json summary of
+the phases, and `--profile`, which writes cProfile statistics of the run
+that can be read with `pstats` or `snakeviz`.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import io
+import json
+import logging
+import pstats
+import resource
+import sys
+import threading
+import time
+logger = logging.getLogger(__name__)
+
+
+class Metrics():
+    """ Accumulated measurements of named phases """
+    def __init__(self):
+        self.started = datetime.now()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.phases = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, cpu_seconds, items=0):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0})
+            phase['calls'] += 1
+            phase['seconds'] += seconds
+            phase['cpu_seconds'] += cpu_seconds
+            phase['items'] += items
+            phase['peak_rss_bytes'] = peak_rss()
+
+    def summary(self):
+        """ Returns dict of total and per phase measurements """
+        with self.lock:
+            phases = OrderedDict((name, dict(phase, items_per_second=phase['items'] / phase['seconds'] if phase['seconds'] else None))
+                                 for name, phase in self.phases.items())
+        return {'started': self.started.isoformat(), 'argv': sys.argv,
+                'total': {'seconds': time.perf_counter() - self.wall, 'cpu_seconds': time.process_time() - self.cpu,
+                          'peak_rss_bytes': peak_rss(), 'children_peak_rss_bytes': peak_rss(children=True)},
+                'phases': phases}
+
+
+class _Phase():
+    """ Items processed in a running phase """
+    def __init__(self, items):
+        self.items = items
+
+
+_metrics = Metrics()
+
+
+def reset():
+    """ Discards the recorded measurements """
+    global _metrics
+    _metrics = Metrics()
+
+
+def summary():
+    return _metrics.summary()
+
+
+@contextmanager
+def phase(name, items=0):
+    """ Records the block as a phase. Items can be given or added to the yielded object's items """
+    current = _Phase(items)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        _metrics.record(name, time.perf_counter() - wall, time.process_time() - cpu, current.items)
+
+
+def peak_rss(children=False):
+    """ Peak resident set size in bytes of this process, or of its largest terminated child """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def add_arguments(parser):
+    """ Adds --metrics-file and --profile to argparse parser """
+    parser.add_argument('--metrics-file',
+                        help='write json summary of wall time, cpu time, peak memory and items/s of each phase to this file',
+                        default=None)
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write cProfile statistics of the run to this file', default=None)
+
+
+@contextmanager
+def instrument(metrics_file=None, profile_file=None):
+    """ Records the phases of the block, and writes metrics and profile when it exits """
+    reset()
+    profile = None
+    if profile_file:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        yield _metrics
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(profile_file)
+            stats = io.StringIO()
+            pstats.Stats(profile, stream=stats).sort_stats('cumulative').print_stats(15)
+            logger.info("Wrote profile to %s\n%s", profile_file, stats.getvalue())
+        result = summary()
+        for name, measured in result['phases'].items():
+            logger.info("%-20s %6d calls %10.2fs %10.2fs cpu %12d items %8.0f MB", name, measured['calls'], measured['seconds'],
+                        measured['cpu_seconds'], measured['items'], measured['peak_rss_bytes'] / 2 ** 20)
+        if metrics_file:
+            with open(metrics_file, 'w') as f:
+                json.dump(result, f, indent=2)
+            logger.info("Wrote metrics to %s", metrics_file)
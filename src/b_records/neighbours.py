@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.neighbours` -- Neighbour lists
+
+===============
+Neighbour Lists
+===============
+
+The neighbours of each untagged pid are kept as a sparse pid x
+content-first pid matrix holding the similarity of each neighbour.
+
+The matrix is written to a npz file together with the pids and a hash of
+the vector of each pid. When tags are generated again, only the rows of
+pids that are new or whose vectors have changed are searched again, and
+the remaining rows are only scored against content-first pids that are new
+or whose vectors have changed. Tags are always aggregated from the full
+matrix, so changed tags in the archive need no new search.
+"""
+import hashlib
+import logging
+import os
+import numpy as np
+from scipy import sparse
+logger = logging.getLogger(__name__)
+
+
+def row_hashes(vectors):
+    """ Returns 64 bit hash of each row in vectors """
+    return np.array([int.from_bytes(hashlib.blake2b(np.ascontiguousarray(row).tobytes(), digest_size=8).digest(), 'little')
+                     for row in vectors], dtype=np.uint64)
+
+
+def save(path, state):
+    """
+    Writes neighbour state
+
+    :param state:
+        dict with queries, tagged, query_hashes, tagged_hashes, similarities
+        (sparse queries x tagged matrix), method, min_similarity and neighbours
+    """
+    similarities = state['similarities'].tocsr()
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, queries=np.array(state['queries'], dtype=str), tagged=np.array(state['tagged'], dtype=str),
+             query_hashes=state['query_hashes'], tagged_hashes=state['tagged_hashes'],
+             indptr=similarities.indptr, indices=similarities.indices, data=similarities.data,
+             method=state['method'], min_similarity=state['min_similarity'], neighbours=state['neighbours'] or 0)
+    os.replace(tmp, path)
+    logger.info("Wrote neighbours of %d pids to %s", len(state['queries']), path)
+
+
+def load(path):
+    """ Returns neighbour state written by save, or None if path does not exist """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        state = {k: f[k] for k in ['queries', 'tagged', 'query_hashes', 'tagged_hashes']}
+        state['similarities'] = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                                  shape=(len(state['queries']), len(state['tagged'])))
+        state['method'] = str(f['method'])
+        state['min_similarity'] = float(f['min_similarity'])
+        state['neighbours'] = int(f['neighbours']) or None
+    return state
+
+
+def top_k(similarities, k):
+    """ Returns copy of similarities keeping only the k largest entries of each row """
+    similarities = similarities.tocsr()
+    indptr = [0]
+    indices = []
+    data = []
+    for i in range(similarities.shape[0]):
+        row = similarities.getrow(i)
+        keep = np.arange(row.nnz)
+        if k < row.nnz:
+            keep = np.argpartition(-row.data, k - 1)[:k]
+        indices.append(row.indices[keep])
+        data.append(row.data[keep])
+        indptr.append(indptr[-1] + len(keep))
+    return sparse.csr_matrix((np.concatenate(data or [[]]).astype(np.float32), np.concatenate(indices or [[]]), indptr),
+                             shape=similarities.shape)
+
+
+def update(state, scorer, query_vectors, query_labels, tagged_labels, block_size):
+    """
+    Returns the neighbour similarities of all queries, reusing state where possible
+
+    :param state:
+        state from previous run (see load), or None
+    :param scorer:
+        generate_subjects scorer holding the content-first vectors and search parameters
+    :param query_vectors:
+        normalized vectors of the queries
+    :param query_labels:
+        pid of each query
+    :param tagged_labels:
+        pid of each content-first vector in scorer
+    :returns:
+        (similarities, query_hashes, tagged_hashes)
+    """
+    query_hashes = row_hashes(query_vectors)
+    tagged_hashes = row_hashes(scorer.tagged_vectors)
+    n_tagged = len(tagged_labels)
+
+    reuse, old_rows = [], []
+    fresh_cols = np.arange(n_tagged)
+    reused = sparse.csr_matrix((0, n_tagged), dtype=np.float32)
+    if state is not None:
+        tagged_index = {label: j for j, label in enumerate(tagged_labels)}
+        col_map = np.array([tagged_index.get(label, -1) for label in state['tagged']], dtype=np.int64)
+        valid = col_map >= 0
+        col_map[valid] = np.where(tagged_hashes[col_map[valid]] == state['tagged_hashes'][valid], col_map[valid], -1)
+        fresh = np.ones(n_tagged, dtype=bool)
+        fresh[col_map[col_map >= 0]] = False
+        fresh_cols = np.flatnonzero(fresh)
+
+        query_index = {label: i for i, label in enumerate(state['queries'])}
+        for i, (label, h) in enumerate(zip(query_labels, query_hashes)):
+            r = query_index.get(label)
+            if r is not None and state['query_hashes'][r] == h:
+                reuse.append(i)
+                old_rows.append(r)
+
+        old = state['similarities'][old_rows].tocoo()
+        keep = col_map[old.col] >= 0
+        reused = sparse.csr_matrix((old.data[keep], (old.row[keep], col_map[old.col[keep]])), shape=(len(reuse), n_tagged))
+        if scorer.neighbours:
+            # rows that were full and lost a neighbour may have had more neighbours than were stored
+            lost = np.bincount(old.row[~keep], minlength=len(reuse)) > 0
+            full = np.diff(state['similarities'][old_rows].indptr) >= scorer.neighbours
+            retained = np.flatnonzero(~(lost & full))
+            reuse = [reuse[i] for i in retained]
+            reused = reused[retained]
+
+    if len(reuse) and len(fresh_cols):
+        fresh_vectors = scorer.tagged_vectors[fresh_cols]
+        blocks = []
+        for start in range(0, len(reuse), block_size):
+            scores = query_vectors[reuse[start:start + block_size]] @ fresh_vectors.T
+            coo = sparse.coo_matrix(np.where(scores > scorer.min_similarity, scores, 0))
+            blocks.append(sparse.csr_matrix((coo.data, (coo.row, fresh_cols[coo.col])), shape=(len(scores), n_tagged)))
+        reused = reused + sparse.vstack(blocks).tocsr()
+        if scorer.neighbours:
+            reused = top_k(reused, scorer.neighbours)
+
+    reused_set = set(reuse)
+    recompute = [i for i in range(len(query_labels)) if i not in reused_set]
+    logger.info("Reusing neighbours of %d pids, searching %d pids, scoring %d new or changed content-first pids",
+                len(reuse), len(recompute), len(fresh_cols) if reuse else 0)
+    searched = [scorer.similarities(query_vectors[recompute[start:start + block_size]])
+                for start in range(0, len(recompute), block_size)]
+    similarities = sparse.vstack([reused] + searched).tocsr()
+    order = np.argsort(np.array(reuse + recompute, dtype=np.int64), kind='stable')
+    return similarities[order].astype(np.float32), query_hashes, tagged_hashes
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.pipeline` -- Pipeline
+
+========
+Pipeline
+========
+
+Runs the whole flow, abstracts -> model -> tags -> report, as a graph of
+stages with cached artifacts.
+
+Each stage is identified by a key hashing its name, the parameters that
+affect its output, and the keys of the stages it depends on. The key of
+the archive is the hash of its content. A stage writes its artifacts to
+`WORKDIR/STAGE-KEY`, so a stage whose directory already exists is
+skipped. Changing a generation parameter therefore only reruns the tags
+and report stages, while the harvested abstracts and the trained model are
+reused.
+
+Every run first harvests LOWELL incrementally into an abstract store in
+the cache directory (see :mod:`b_records.abstract_store`), and the hash of
+the stored abstracts is part of the key of the abstracts stage. A change
+in LOWELL therefore reruns the stages depending on it, while an unchanged
+LOWELL reuses them.
+
+A stage runs in `WORKDIR/STAGE-KEY.partial` and the directory is renamed
+when the stage completes. Training and tag generation checkpoint to the
+partial directory (see :mod:`b_records.checkpoint`), so an interrupted
+stage resumes when the pipeline is run again. Stages whose dependencies
+are done are run concurrently.
+
+Every run writes `WORKDIR/manifest.json` with the key, directory, outputs,
+duration and size of each stage, and whether it was cached.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from b_records import ann_index
+from b_records import checkpoint
+from b_records import dedup
+logger = logging.getLogger(__name__)
+
+STAGES = ['abstracts', 'model', 'tags', 'report']
+DEFAULTS = {'abstracts': {'limit': None, 'min_length': 100},
+            'model': {'emb_size': 300, 'min_count': 2, 'epochs': 200, 'eval_every': None, 'patience': 3, 'dedup': None},
+            'tags': {'topn': None, 'min_similarity': 0.45, 'by_value': False, 'min_value': None, 'method': 'knn', 'index': 'exact',
+                     'neighbours': None, 'nprobe': ann_index.NPROBE},
+            'report': {'format': 'text', 'report_limit': None, 'maxn': None}}
+
+
+class Stage():
+    """
+    Stage of the pipeline
+
+    :param name:
+        name of the stage
+    :param run:
+        function(context, inputs, out_dir) returning dict of output name -> path in out_dir.
+        inputs is dict of input stage -> its outputs
+    :param inputs:
+        names of the stages this stage depends on
+    :param params:
+        parameters that affect the output of the stage. They are part of the key
+    :param resumable:
+        if True, the partial directory of an interrupted run is kept, so the stage can
+        resume from its checkpoints. Otherwise it is cleared
+    """
+    def __init__(self, name, run, inputs=(), params=None, resumable=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.resumable = resumable
+
+
+def run(stages, workdir, context=None, root_key='', jobs=2, force=()):
+    """
+    Runs stages, skipping those whose artifacts exist
+
+    :param stages:
+        list of Stage. Inputs must precede the stages depending on them
+    :param workdir:
+        directory holding artifacts and manifest
+    :param context:
+        passed to the run function of every stage
+    :param root_key:
+        hash of the external inputs (e.g. the archive), part of every key
+    :param jobs:
+        maximum number of stages run concurrently
+    :param force:
+        names of stages to run even if their artifacts exist. Stages depending on them are run as well
+    :returns:
+        manifest dict
+    """
+    os.makedirs(workdir, exist_ok=True)
+    keys = {}
+    force = set(force)
+    for stage in stages:
+        keys[stage.name] = _key(stage, root_key, [keys[name] for name in stage.inputs])
+        if force.intersection(stage.inputs):
+            force.add(stage.name)
+    by_name = {stage.name: stage for stage in stages}
+    started = datetime.now()
+    records = {}
+    outputs = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max(jobs, 1)) as executor:
+        while pending or running:
+            ready = [stage for stage in pending if all(name in outputs for name in stage.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                inputs = {name: outputs[name] for name in stage.inputs}
+                out_dir = os.path.join(workdir, f"{stage.name}-{keys[stage.name][:16]}")
+                running[executor.submit(_run_stage, stage, context, inputs, out_dir, keys[stage.name],
+                                        stage.name in force)] = stage.name
+            if not running:
+                raise ValueError(f"Stages {[stage.name for stage in pending]} depend on stages that are not in the pipeline")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                records[name] = future.result()
+                outputs[name] = records[name]['outputs']
+
+    manifest = {'started': started.isoformat(), 'finished': datetime.now().isoformat(), 'root_key': root_key,
+                'stages': [dict(records[stage.name], params=by_name[stage.name].params) for stage in stages]}
+    checkpoint.write_json(manifest, os.path.join(workdir, 'manifest.json'))
+    for record in manifest['stages']:
+        logger.info("%-10s %-8s %8.1fs %12d bytes  %s", record['stage'], 'cached' if record['cached'] else 'ran',
+                    record['seconds'], record['bytes'], record['dir'])
+    return manifest
+
+
+def _run_stage(stage, context, inputs, out_dir, key, force=False):
+    """ Runs stage into out_dir unless it exists, and returns its manifest record """
+    start = time.perf_counter()
+    cached = os.path.exists(os.path.join(out_dir, 'stage.json')) and not force
+    if cached:
+        logger.info("Using cached %s in %s", stage.name, out_dir)
+        with open(os.path.join(out_dir, 'stage.json')) as f:
+            relative = json.load(f)['outputs']
+    else:
+        logger.info("Running %s in %s", stage.name, out_dir)
+        partial = f"{out_dir}.partial"
+        if not stage.resumable:
+            shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial, exist_ok=True)
+        produced = stage.run(context, inputs, partial)
+        relative = {name: os.path.relpath(path, partial) for name, path in produced.items()}
+        checkpoint.write_json({'stage': stage.name, 'key': key, 'params': stage.params, 'outputs': relative},
+                              os.path.join(partial, 'stage.json'))
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(partial, out_dir)
+    return {'stage': stage.name, 'key': key, 'dir': out_dir, 'cached': cached,
+            'outputs': {name: os.path.join(out_dir, path) for name, path in relative.items()},
+            'seconds': time.perf_counter() - start, 'bytes': _size(out_dir)}
+
+
+def _key(stage, root_key, input_keys):
+    return hashlib.sha1(json.dumps([stage.name, root_key, stage.params, input_keys], sort_keys=True).encode()).hexdigest()
+
+
+def _size(path):
+    """ Total size of files below path """
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def _file_key(path):
+    """ Hash of file content """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _find(directory, pattern):
+    """ Returns the single path in directory matching pattern """
+    paths = glob.glob(os.path.join(glob.escape(directory), pattern))
+    if len(paths) != 1:
+        raise RuntimeError(f"Expected one {pattern} in {directory}, found {len(paths)}")
+    return paths[0]
+
+
+def _harvest(context):
+    """ Harvests LOWELL into the abstract store of the abstracts parameters, and returns the store and the hash of its abstracts """
+    from b_records import get_abstract
+    from b_records.abstract_store import AbstractStore
+
+    params = context['abstracts']
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    store_file = os.path.join(context['cache_dir'], f"abstracts-{key}.sqlite")
+    get_abstract.harvest(context['archive_file'], store_file, params['limit'], params['min_length'], context['itersize'],
+                         context['parallel'])
+    with AbstractStore(store_file) as store:
+        hashes = store.hashes()
+    return store_file, hashlib.sha1(json.dumps(sorted(hashes.items())).encode()).hexdigest()
+
+
+def _abstracts(context, inputs, out_dir):
+    path = os.path.join(out_dir, 'abstracts.sqlite')
+    shutil.copyfile(context['store_file'], path)
+    return {'abstracts': path}
+
+
+def _model(context, inputs, out_dir):
+    from b_records import build_doc2vec_model
+
+    params = context['model']
+    build_doc2vec_model.train(inputs['abstracts']['abstracts'], emb_size=params['emb_size'], min_count=params['min_count'],
+                              epochs=params['epochs'], outfile_prefix=os.path.join(out_dir, 'abstract-model'),
+                              cache_dir=context['cache_dir'],
+                              tokenize_workers=context['workers'], export_dtype='float32', eval_every=params['eval_every'],
+                              patience=params['patience'], checkpoint_every=context['checkpoint_every'], resume=True,
+                              dedup_threshold=params['dedup'])
+    model = _find(out_dir, 'abstract-model-*.d2v')
+    return {'model': model, 'vectors': f"{model}.vectors"}
+
+
+def _tags(context, inputs, out_dir):
+    from b_records import generate_subjects
+
+    params = context['tags']
+    prefix = os.path.join(out_dir, 'predicted-tags')
+    generate_subjects.generate_tags(inputs['model']['vectors'], context['archive_file'], prefix, params['topn'],
+                                    params['min_similarity'], params['by_value'], params['min_value'], index=params['index'],
+                                    neighbours=params['neighbours'], nprobe=params['nprobe'], workers=context['workers'],
+                                    method=params['method'], resume=True, index_file=os.path.join(out_dir, 'ann.ivf.npz'))
+    return {'tags': f"{prefix}.tags", 'index': f"{prefix}.tag-index"}
+
+
+def _report(context, inputs, out_dir):
+    from b_records import report
+
+    params = context['report']
+    path = os.path.join(out_dir, f"report.{params['format']}")
+    with open(path, 'w', encoding='utf-8') as out:
+        report.make_report(inputs['tags']['tags'], context['archive_file'], limit=params['report_limit'], maxn=params['maxn'],
+                           output_format=params['format'], out=out)
+    return {'report': path}
+
+
+def pipeline(archive_file, workdir='b-records', until='report', jobs=2, force=(), workers=1, parallel=1, itersize=10000,
+             checkpoint_every=10, **params):
+    """
+    Runs the b-records pipeline on a content-first archive
+
+    :param archive_file:
+        Content-first archive file
+    :param workdir:
+        directory holding the artifacts of each stage and the manifest
+    :param until:
+        last stage to run (abstracts, model, tags or report)
+    :param jobs:
+        maximum number of stages run concurrently
+    :param force:
+        names of stages to run even if their artifacts exist. Stages depending on them are run as well.
+        LOWELL is harvested on every run, and the abstracts stage reruns when the abstracts change
+    :param workers:
+        number of processes used for tokenization and tag generation
+    :param parallel:
+        number of partitions harvested concurrently
+    :param itersize:
+        number of rows fetched from LOWELL at a time
+    :param checkpoint_every:
+        epochs between model checkpoints
+    :param params:
+        stage parameters overriding DEFAULTS, e.g. min_similarity=0.5
+    :returns:
+        manifest dict
+    """
+    unknown = set(params) - {name for stage_params in DEFAULTS.values() for name in stage_params}
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}")
+    context = {'archive_file': archive_file, 'workers': workers, 'parallel': parallel, 'itersize': itersize,
+               'checkpoint_every': checkpoint_every, 'cache_dir': os.path.join(workdir, 'cache')}
+    os.makedirs(context['cache_dir'], exist_ok=True)
+    runs = {'abstracts': _abstracts, 'model': _model, 'tags': _tags, 'report': _report}
+    inputs = {'abstracts': [], 'model': ['abstracts'], 'tags': ['model'], 'report': ['tags']}
+    stages = []
+    for name in STAGES[:STAGES.index(until) + 1]:
+        context[name] = {k: params.get(k, v) for k, v in DEFAULTS[name].items()}
+        stage_params = context[name]
+        if name == 'abstracts':
+            context['store_file'], harvested = _harvest(context)
+            stage_params = dict(stage_params, harvested=harvested)
+        stages.append(Stage(name, runs[name], inputs[name], stage_params, resumable=name in ('model', 'tags')))
+    return run(stages, workdir, context, _file_key(archive_file), jobs, force)
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the b-records pipeline, reusing the artifacts of unchanged stages')
+    parser.add_argument('archive_file',
+                        help='archive file')
+    parser.add_argument('-d', '--workdir',
+                        help='directory holding artifacts and manifest. Default is b-records', default='b-records')
+    parser.add_argument('--until', choices=STAGES, default='report',
+                        help='last stage to run. Default is report')
+    parser.add_argument('--force', choices=STAGES, nargs='+', default=[],
+                        help='run these stages even if their artifacts exist')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='maximum number of stages run concurrently. Default is 2', default=2)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes used for tokenization and tag generation. Default is 1', default=1)
+    parser.add_argument('-p', '--parallel', type=int,
+                        help='number of partitions harvested concurrently. Default is 1', default=1)
+    parser.add_argument('--checkpoint-every', type=int,
+                        help='epochs between model checkpoints. Default is 10', default=10)
+    parser.add_argument('-l', '--limit', type=int,
+                        help='limit number of harvested items', default=None)
+    parser.add_argument('-m', '--min-length', type=int,
+                        help='minimun number of chars in abstract. Default is 100', default=100)
+    parser.add_argument('-z', '--embedding-size', dest='emb_size', type=int,
+                        help='Embedding size. Default is 300', default=300)
+    parser.add_argument('-e', '--epochs', type=int,
+                        help='number of epochs. Default is 200', default=200)
+    parser.add_argument('--eval-every', type=int,
+                        help='validate every N epochs and stop when validation stops improving', default=None)
+    parser.add_argument('--dedup', metavar='THRESHOLD', type=float, nargs='?', const=dedup.THRESHOLD,
+                        help=f'train one representative of each cluster of near-duplicate abstracts. Default threshold is {dedup.THRESHOLD}',
+                        default=None)
+    parser.add_argument('--topn', type=int,
+                        help='limits the number of predicted tags for each item', default=None)
+    parser.add_argument('--min-similarity', type=float,
+                        help='minimum similarity to be considered. default is 0.45', default=0.45)
+    parser.add_argument('--by-value', action='store_true',
+                        help='calculates tag value by similarity rather than occurence')
+    parser.add_argument('--min-value', type=float,
+                        help='minimum value of a tag to be returned', default=None)
+    parser.add_argument('--method', choices=['knn', 'centroid'], default='knn',
+                        help='see generate_subjects. Default is knn')
+    parser.add_argument('--index', choices=['exact', 'ann'], default='exact',
+                        help='see generate_subjects. Default is exact')
+    parser.add_argument('--neighbours', type=int,
+                        help='maximum number of neighbours used for each item', default=None)
+    parser.add_argument('-f', '--format', choices=['ansi', 'text', 'json', 'html'], default='text',
+                        help='report format. Default is text')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    pipeline(args.archive_file, args.workdir, args.until, args.jobs, args.force, args.workers, args.parallel,
+             checkpoint_every=args.checkpoint_every, limit=args.limit, min_length=args.min_length, emb_size=args.emb_size,
+             epochs=args.epochs, eval_every=args.eval_every, dedup=args.dedup, topn=args.topn, min_similarity=args.min_similarity,
+             by_value=args.by_value, min_value=args.min_value, method=args.method, index=args.index, neighbours=args.neighbours,
+             format=args.format)
@@ -9,108 +9,223 @@ Report
 ======
 
 Generate human readable report from generated tags file
+
+The pids are reported a page at a time. Creator and title for a whole
+page are fetched with a single query, and the next page is fetched in the
+background while the current one is written, so output is streamed with
+memory bounded by the page size.
+
+The generated tags are read from a tag store (see
+:mod:`b_records.tag_store`) page by page, so only the chunks holding the
+reported pids are loaded. Pickled tags are loaded whole.
+
+The report can be rendered as ansi colored text (default), plain text,
+json lines or html.
 """
+from concurrent.futures import ThreadPoolExecutor
+import html
+import itertools
 import logging
 import json
-import joblib
-import os
-from psycopg2 import connect
-import psycopg2.extras
 import random
-import recommender_common.load_compass_data as ld
-from colored import fg, bg, attr
+import sys
+from b_records import archive
+from b_records import db
+from b_records import metrics
+from b_records import tag_store
 
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE = 500
 
-class _Cursor():
-    """ postgres cursor """
-    def __init__(self, postgres_url):
-        self.postgres_url = postgres_url
 
-    def __enter__(self):
+def load_id2tag_map(archive_file):
+    return archive.load(archive_file).id2label
 
-        self.conn = connect(self.postgres_url)
-        self.cur = self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        return self.cur
 
-    def __exit__(self, type, value, traceback):
+def load_predicted_tags(predicted_tag_file):
+    """ Returns pid -> [(tag, value)] from tag store or pickle file """
+    with metrics.phase('load tags'):
+        if tag_store.is_store(predicted_tag_file):
+            return tag_store.load(predicted_tag_file)
+        import joblib
+        return joblib.load(predicted_tag_file)
 
-        self.conn.commit()
-        self.cur.close()
-        self.conn.close()
 
+def _sample(pids, limit=None):
+    """ Returns pids in random order, or a random sample of limit of them kept while iterating """
+    if not limit:
+        pids = list(pids)
+        random.shuffle(pids)
+        return pids
+    sample = []
+    for i, pid in enumerate(pids):
+        if len(sample) < limit:
+            sample.append(pid)
+        elif random.randrange(i + 1) < limit:
+            sample[random.randrange(limit)] = pid
+    random.shuffle(sample)
+    return sample
 
-def load_id2tag_map(archive_file):
-    id2tag = ld.load_id_expanded_tag_map(archive_file)
-    return id2tag
 
+def _pages(pids, page_size):
+    """ Yields lists of page_size pids """
+    pids = iter(pids)
+    page = list(itertools.islice(pids, page_size))
+    while page:
+        yield page
+        page = list(itertools.islice(pids, page_size))
 
-def load_predicted_tags(predicted_tag_file):
-    return joblib.load(predicted_tag_file)
 
+def _read_page(predicted, pids):
+    """ Returns pid -> [(tag, value)] for a page of pids """
+    if isinstance(predicted, tag_store.TagStore):
+        return predicted.read(pids)
+    return {pid: predicted[pid] for pid in pids}
 
-def get_metadata(cur, pid):
-    cur.execute("""SELECT pid, metadata->>'creator' as creator, metadata->>'title' as title
+
+def get_metadata(cur, pids):
+    """ Returns pid -> (creator, title) for pids """
+    with metrics.phase('db fetch', len(pids)):
+        return _get_metadata(cur, pids)
+
+
+def _get_metadata(cur, pids):
+    cur.execute("""SELECT pid, metadata->'creator'->>0 as creator, metadata->'title'->>0 as title
                    FROM metadata
-                   WHERE pid=%(pid)s""", {'pid': pid})
-    for row in cur:
-        creator = row.get('creator')
-        if not creator:
-            creator = '[""]'
-        title = row.get('title')
-        if not title:
-            title = '[""]'
-        creator = json.loads(creator)[0]
-        title = json.loads(title)[0]
-
-        rep = "* " + attr('bold') + row['pid'].ljust(30) + creator.ljust(40) + title + attr('reset')
-        return rep
-
-
-def make_report(predicted_tag_file, archive_file, recommendations_file=None, limit=None, maxn=None, min_value=None, shuffle=False):
+                   WHERE pid = ANY(%(pids)s)""", {'pids': list(pids)})
+    return {pid: (creator or '', title or '') for pid, creator, title in cur}
+
+
+class AnsiRenderer():
+    """ Colored terminal output """
+    def header(self):
+        return ''
+
+    def item(self, pid, creator, title, tags, recommendations):
+        from colored import fg, attr
+
+        lines = ["* " + attr('bold') + pid.ljust(30) + creator.ljust(40) + title + attr('reset') + '\n']
+        for tag, value, label in tags:
+            if label.startswith('stemning'):
+                lines.append(' '.join(["  ", fg('yellow') + tag.ljust(5), f'{value:4.2f}', label, attr('reset')]))
+            else:
+                lines.append(' '.join(["  ", tag.ljust(5), f'{value:4.2f}', label]))
+        if recommendations:
+            lines.append("\n    " + attr("underlined") + " Recommendations\n" + attr('reset'))
+            for rec in recommendations:
+                lines.append(' '.join(["   ", rec['pid'].ljust(30), rec['creator'].ljust(40), rec['title'].ljust(40),
+                                       str(rec['loancount'])]))
+        return '\n'.join(lines) + '\n\n\n\n'
+
+    def footer(self):
+        return ''
+
+
+class TextRenderer(AnsiRenderer):
+    """ Plain text output """
+    def item(self, pid, creator, title, tags, recommendations):
+        lines = ["* " + pid.ljust(30) + creator.ljust(40) + title + '\n']
+        for tag, value, label in tags:
+            lines.append(' '.join(["  ", tag.ljust(5), f'{value:4.2f}', label]))
+        if recommendations:
+            lines.append("\n     Recommendations\n")
+            for rec in recommendations:
+                lines.append(' '.join(["   ", rec['pid'].ljust(30), rec['creator'].ljust(40), rec['title'].ljust(40),
+                                       str(rec['loancount'])]))
+        return '\n'.join(lines) + '\n\n\n\n'
+
+
+class JsonRenderer(AnsiRenderer):
+    """ One json object per line """
+    def item(self, pid, creator, title, tags, recommendations):
+        return json.dumps({'pid': pid, 'creator': creator, 'title': title,
+                           'tags': [{'tag': tag, 'value': value, 'label': label} for tag, value, label in tags],
+                           'recommendations': recommendations or []}, ensure_ascii=False) + '\n'
+
+
+class HtmlRenderer(AnsiRenderer):
+    """ Html document """
+    def header(self):
+        return '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>b-records</title></head>\n<body>\n'
+
+    def item(self, pid, creator, title, tags, recommendations):
+        e = html.escape
+        lines = [f'<div class="item">\n<h3>{e(pid)} {e(creator)} <i>{e(title)}</i></h3>\n<table>']
+        for tag, value, label in tags:
+            style = ' class="mood"' if label.startswith('stemning') else ''
+            lines.append(f'<tr{style}><td>{e(tag)}</td><td>{value:4.2f}</td><td>{e(label)}</td></tr>')
+        lines.append('</table>')
+        if recommendations:
+            lines.append('<h4>Recommendations</h4>\n<ul>')
+            for rec in recommendations:
+                lines.append(f"<li>{e(rec['pid'])} {e(rec['creator'])} <i>{e(rec['title'])}</i> {e(str(rec['loancount']))}</li>")
+            lines.append('</ul>')
+        return '\n'.join(lines) + '\n</div>\n'
+
+    def footer(self):
+        return '</body>\n</html>\n'
+
+
+RENDERERS = {'ansi': AnsiRenderer, 'text': TextRenderer, 'json': JsonRenderer, 'html': HtmlRenderer}
+
+
+def make_report(predicted_tag_file, archive_file, recommendations_file=None, limit=None, maxn=None, min_value=None, shuffle=False,
+                output_format='ansi', out=None, page_size=PAGE_SIZE):
     """
     Creates human-readable report
     :param predicted_tag_file:
-        File with generated tags
+        Tag store or pickle file with generated tags
     :param archive_file:
         content-first archive file
     :param limit:
-        limits number of generated items
+        limits number of generated items. Only the reported pids are held in memory
+    :param maxn:
+        maximum number of tags displayed for each pid
+    :param min_value:
+        minimum value of displayed tags
+    :param shuffle:
+        report pids in random order
+    :param output_format:
+        one of ansi, text, json or html
+    :param out:
+        stream to write report to. Default is stdout
+    :param page_size:
+        number of pids fetched from LOWELL at a time
     """
+    out = out or sys.stdout
+    renderer = RENDERERS[output_format]()
     id2tag = load_id2tag_map(archive_file)
     predicted = load_predicted_tags(predicted_tag_file)
 
-    pids = list(predicted.keys())
-    if shuffle:
-        random.shuffle(pids)
+    pids = _sample(predicted, limit) if shuffle else itertools.islice(predicted, limit)
     recommendations = {}
     if recommendations_file:
+        import joblib
         recommendations = joblib.load(recommendations_file)
-    with _Cursor(os.environ['LOWELL_URL']) as cur:
-        for i, pid in enumerate(pids):
-            tags = predicted[pid]
-
-            print(get_metadata(cur, pid) + '\n')
-            if tags:
-                if maxn:
-                    tags = tags[:10]
-                for tag, value in tags:
-                    if not min_value or min_value < value:
-                        if id2tag[int(tag)].startswith('stemning'):
-                            print("  ", fg('yellow') + tag.ljust(5), f'{value:4.2f}', id2tag[int(tag)], attr('reset'))
-                        else:
-                            print("  ", tag.ljust(5), f'{value:4.2f}', id2tag[int(tag)])
-
-            if pid in recommendations:
-                print("\n    " + attr("underlined") + " Recommendations\n" + attr('reset'))
-                for rec in recommendations[pid]:
-                    print("   ", rec['pid'].ljust(30), rec['creator'].ljust(40), rec['title'].ljust(40), rec['loancount'])
-
-            if limit and i >= limit:
-                break
 
-            print('\n\n')
+    out.write(renderer.header())
+    pages = _pages(pids, page_size)
+    with db.Cursor() as cur, ThreadPoolExecutor(1) as prefetch:
+        page = next(pages, None)
+        metadata = prefetch.submit(get_metadata, cur, page) if page else None
+        while page:
+            page_metadata = metadata.result()
+            next_page = next(pages, None)
+            if next_page:
+                metadata = prefetch.submit(get_metadata, cur, next_page)
+            page_tags = _read_page(predicted, page)
+            with metrics.phase('render', len(page)):
+                for pid in page:
+                    creator, title = page_metadata.get(pid, ('', ''))
+                    tags = page_tags[pid] or []
+                    if maxn:
+                        tags = tags[:maxn]
+                    tags = [(tag, value, id2tag[int(tag)]) for tag, value in tags if not min_value or min_value < value]
+                    out.write(renderer.item(pid, creator, title, tags, recommendations.get(pid)))
+                out.flush()
+            page = next_page
+    out.write(renderer.footer())
 
 
 def cli():
@@ -119,7 +234,7 @@ def cli():
 
     parser = argparse.ArgumentParser(description='Creates human-readable report')
     parser.add_argument('predicted_tags_file',
-                        help='file containing predicted tags')
+                        help='tag store or file containing predicted tags')
     parser.add_argument('archive_file',
                         help='archive file')
     parser.add_argument('-r', '--recommendation-file',
@@ -132,6 +247,13 @@ def cli():
                         help='maximum displayed items for each pid', default=None)
     parser.add_argument('-s', '--shuffle', dest='shuffle', action='store_true',
                         help='shuffle')
+    parser.add_argument('-f', '--format', choices=sorted(RENDERERS), default='ansi',
+                        help='output format. Default is ansi')
+    parser.add_argument('-o', '--outfile',
+                        help='file to write report to. Default is stdout', default=None)
+    parser.add_argument('--page-size', type=int,
+                        help=f'number of items fetched from LOWELL at a time. Default is {PAGE_SIZE}', default=PAGE_SIZE)
+    metrics.add_arguments(parser)
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='verbose output')
     args = parser.parse_args()
@@ -141,4 +263,11 @@ def cli():
         level = logging.DEBUG
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
 
-    make_report(args.predicted_tags_file, args.archive_file, args.recommendation_file, args.limit, args.maxn, args.min_value, args.shuffle)
+    with metrics.instrument(args.metrics_file, args.profile):
+        if args.outfile:
+            with open(args.outfile, 'w', encoding='utf-8') as out:
+                make_report(args.predicted_tags_file, args.archive_file, args.recommendation_file, args.limit, args.maxn,
+                            args.min_value, args.shuffle, args.format, out, args.page_size)
+        else:
+            make_report(args.predicted_tags_file, args.archive_file, args.recommendation_file, args.limit, args.maxn, args.min_value,
+                        args.shuffle, args.format, page_size=args.page_size)
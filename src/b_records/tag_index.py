@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.tag_index` -- Inverted tag index
+
+==================
+Inverted Tag Index
+==================
+
+Inverted index of generated tags, answering which pids got a tag without
+loading the generated tags.
+
+The index is a directory of arrays that are memory mapped when it is
+opened, so a query only reads the pages it touches
+
+* `tags.npy` -- the tags, sorted
+* `tag_offsets.npy` -- start of the postings of each tag
+* `posting_pids.npy`, `posting_values.npy` -- the postings of each tag as
+  pid number and value, sorted by descending value and pid
+* `pids.npy` -- the pids, sorted. A pid number is the position of the pid
+* `pid_offsets.npy` -- start of the tags of each pid
+* `pid_tags.npy`, `pid_values.npy` -- tag number and value of the tags of
+  each pid, in generated order
+
+Values are stored as float32. The index is built next to the output of
+:mod:`b_records.generate_subjects` as `OUTPUT_PREFIX.tag-index`, and can be
+built from an existing tag store or pickle with `build`.
+
+    index = tag_index.load('predicted-tags.tag-index')
+    index.lookup('1234', min_value=3)
+    index.top('1234', 10)
+    index.intersect(['1234', '5678'])
+"""
+import logging
+import os
+import shutil
+import numpy as np
+from b_records import metrics
+from b_records import tag_store
+logger = logging.getLogger(__name__)
+
+ARRAYS = ['tags', 'tag_offsets', 'posting_pids', 'posting_values', 'pids', 'pid_offsets', 'pid_tags', 'pid_values']
+
+
+class TagIndex():
+    """ Memory mapped inverted index of tag -> [(pid, value)] """
+    def __init__(self, path):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+        self.tag_numbers = {tag: i for i, tag in enumerate(self.tags.tolist())}
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        return iter(self.tag_numbers)
+
+    def __contains__(self, tag):
+        return tag in self.tag_numbers
+
+    def count(self, tag, min_value=None):
+        """ Number of pids with tag, or with a value of at least min_value """
+        return len(self._postings(tag, min_value)[0])
+
+    def lookup(self, tag, min_value=None, n=None):
+        """ Returns [(pid, value)] of the pids with tag, or with a value of at least min_value, by descending value """
+        numbers, values = self._postings(tag, min_value)
+        if n is not None:
+            numbers, values = numbers[:n], values[:n]
+        return list(zip(self.pids[numbers].tolist(), values.tolist()))
+
+    def top(self, tag, n=10, min_value=None):
+        """ Returns [(pid, value)] of the n pids with the highest values of tag """
+        return self.lookup(tag, min_value, n)
+
+    def intersect(self, tags, min_value=None, n=None):
+        """
+        Returns [(pid, value)] of the pids having all tags, or all with a value of at least
+        min_value, by descending sum of the values of the tags
+        """
+        postings = sorted((self._postings(tag, min_value) for tag in tags), key=lambda p: len(p[0]))
+        if not postings:
+            return []
+        numbers = np.sort(postings[0][0])
+        for other, _ in postings[1:]:
+            numbers = np.intersect1d(numbers, other, assume_unique=True)
+        total = np.zeros(len(numbers), dtype=np.float64)
+        for other, values in postings:
+            order = np.argsort(other)
+            total += values[order][np.searchsorted(other[order], numbers)]
+        order = np.lexsort((numbers, -total))
+        if n is not None:
+            order = order[:n]
+        return list(zip(self.pids[numbers[order]].tolist(), total[order].tolist()))
+
+    def subjects(self, pid):
+        """ Returns [(tag, value)] of pid, or None if pid has no tags """
+        i = np.searchsorted(self.pids, pid)
+        if i == len(self.pids) or self.pids[i] != pid:
+            return None
+        start, stop = self.pid_offsets[i], self.pid_offsets[i + 1]
+        return list(zip(self.tags[self.pid_tags[start:stop]].tolist(), self.pid_values[start:stop].tolist()))
+
+    def _postings(self, tag, min_value=None):
+        """ Returns pid numbers and values of the postings of tag with a value of at least min_value """
+        i = self.tag_numbers.get(tag)
+        if i is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        start, stop = self.tag_offsets[i], self.tag_offsets[i + 1]
+        values = self.posting_values[start:stop]
+        if min_value is not None:
+            stop = start + np.searchsorted(-values, -np.float32(min_value), side='right')
+        return self.posting_pids[start:stop], self.posting_values[start:stop]
+
+
+def build(tags, path):
+    """
+    Writes the inverted index of generated tags to path. The index is written
+    to PATH.tmp and moved into place when complete
+
+    :param tags:
+        tag store (see :mod:`b_records.tag_store`) or dict of pid -> [(tag, value)]
+    :param path:
+        directory to write the index to
+    """
+    path = path.rstrip('/')
+    with metrics.phase('build index', len(tags)):
+        arrays = _index_arrays(tags)
+        tmp = f"{path}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, f"{name}.npy"), arrays[name])
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+    logger.info("Wrote index of %d tags of %d pids with %d postings to %s", len(arrays['tags']), len(arrays['pids']),
+                len(arrays['posting_pids']), path)
+    return path
+
+
+def _index_arrays(tags):
+    """ Returns the ARRAYS of the index of tags """
+    tag_numbers = {}
+    pids, row_pids, row_tags, row_values = [], [], [], []
+    seen = 0
+    for chunk in _columns(tags):
+        unique, inverse = np.unique(chunk['tags'], return_inverse=True)
+        numbers = np.array([tag_numbers.setdefault(tag, len(tag_numbers)) for tag in unique.tolist()], dtype=np.int32)
+        row_tags.append(numbers[inverse.ravel()])
+        row_pids.append(np.repeat(np.arange(seen, seen + len(chunk['pids']), dtype=np.int32), np.diff(chunk['offsets'])))
+        row_values.append(np.asarray(chunk['values'], dtype=np.float32))
+        pids.append(chunk['pids'])
+        seen += len(chunk['pids'])
+
+    pids = _concatenate(pids, str)
+    pid_order = np.argsort(pids, kind='stable')
+    pid_rank = np.empty(len(pids), dtype=np.int32)
+    pid_rank[pid_order] = np.arange(len(pids), dtype=np.int32)
+    tag_names = np.array(list(tag_numbers), dtype=str)
+    tag_order = np.argsort(tag_names, kind='stable')
+    tag_rank = np.empty(len(tag_names), dtype=np.int32)
+    tag_rank[tag_order] = np.arange(len(tag_names), dtype=np.int32)
+    row_pids = pid_rank[_concatenate(row_pids, np.int32)]
+    row_tags = tag_rank[_concatenate(row_tags, np.int32)]
+    row_values = _concatenate(row_values, np.float32)
+
+    postings = np.lexsort((row_pids, -row_values, row_tags))
+    rows = np.argsort(row_pids, kind='stable')
+    return {'tags': tag_names[tag_order], 'tag_offsets': _offsets(row_tags, len(tag_names)),
+            'posting_pids': row_pids[postings], 'posting_values': row_values[postings],
+            'pids': pids[pid_order], 'pid_offsets': _offsets(row_pids, len(pids)),
+            'pid_tags': row_tags[rows], 'pid_values': row_values[rows]}
+
+
+def _columns(tags):
+    """ Yields pids, offsets, tags and values arrays of chunks of tags """
+    if isinstance(tags, tag_store.TagStore):
+        yield from tags.columns()
+        return
+    items = list(tags.items())
+    for start in range(0, len(items), tag_store.CHUNK_SIZE):
+        chunk = items[start:start + tag_store.CHUNK_SIZE]
+        rows = [row for _, subjects in chunk for row in subjects]
+        yield {'pids': np.array([pid for pid, _ in chunk], dtype=str),
+               'offsets': np.cumsum([0] + [len(subjects) for _, subjects in chunk]),
+               'tags': np.array([str(t) for t, _ in rows], dtype=str), 'values': np.array([v for _, v in rows], dtype=np.float32)}
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype=dtype)
+
+
+def _offsets(numbers, n):
+    """ Returns start of the rows of each number 0..n in rows sorted by number """
+    return np.concatenate([[0], np.cumsum(np.bincount(numbers, minlength=n))]).astype(np.int64)
+
+
+def load(path):
+    """ Opens index """
+    logger.debug("Loading tag index from %s", path)
+    return TagIndex(path)
+
+
+def is_index(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'posting_pids.npy'))
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+    import json
+    import sys
+
+    if sys.argv[1:2] == ['build']:
+        return _build_cli(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Look up pids by generated tags in an inverted tag index',
+                                     epilog="An index is built from generated tags with 'build TAGS_FILE'")
+    parser.add_argument('index',
+                        help='tag index directory (OUTPUT_PREFIX.tag-index written by generate_subjects)')
+    parser.add_argument('tags', nargs='*', metavar='TAG',
+                        help='tag to look up. With several tags the pids having all of them are returned')
+    parser.add_argument('-n', '--top', type=int,
+                        help='return only the N pids with the highest values', default=None)
+    parser.add_argument('-m', '--min-value', type=float,
+                        help='minimum value of each tag', default=None)
+    parser.add_argument('-p', '--pid',
+                        help='return the tags of this pid instead', default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='write result as json')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    if bool(args.pid) == bool(args.tags):
+        parser.error('give either tags or --pid')
+    index = load(args.index)
+    if args.pid:
+        rows = index.subjects(args.pid) or []
+        keys = ('tag', 'value')
+    else:
+        rows = index.intersect(args.tags, args.min_value, args.top) if len(args.tags) > 1 else \
+            index.lookup(args.tags[0], args.min_value, args.top)
+        keys = ('pid', 'value')
+    if args.json:
+        print(json.dumps([dict(zip(keys, row)) for row in rows]))
+    else:
+        for key, value in rows:
+            print(f"{key}\t{value:.4f}")
+
+
+def _build_cli(argv):
+    """ Commandline interface for building an index """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tag_index build', description='Build inverted tag index of generated tags')
+    parser.add_argument('tags_file',
+                        help='tag store or pickle file written by generate_subjects')
+    parser.add_argument('-o', '--outfile',
+                        help='directory to write index to. Default is the tags file without extension followed by .tag-index',
+                        default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+    from b_records.generate_subjects import load_tags
+    build(load_tags(args.tags_file), args.outfile or f"{os.path.splitext(args.tags_file.rstrip('/'))[0]}.tag-index")
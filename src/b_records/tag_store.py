@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.tag_store` -- Predicted tag store
+
+===================
+Predicted Tag Store
+===================
+
+Columnar store of generated tags, written while the tags are generated so
+the whole result never has to be held in memory.
+
+The store is a directory of chunks, each holding the (pid, tag, value)
+rows of a number of pids as columns:
+
+* `chunk-NNNNNN.npz` -- `pids` of the chunk, `offsets` of the rows of each
+  pid, and the `tags` and `values` of the rows
+* `index.npz` -- every pid in written order with its chunk and position in
+  the chunk, and the order sorting the pids
+
+The store is read as a mapping of pid -> [(tag, value)] that only loads the
+chunks holding the requested pids. Chunks are read whole, so reading pids
+in bulk with `read` or in order with `items` is cheap, while scattered
+lookups cost a chunk each.
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+import logging
+import os
+import shutil
+import numpy as np
+from b_records import metrics
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10000
+CACHED_CHUNKS = 4
+
+
+class Writer():
+    """
+    Writes pids and tags to a store chunk by chunk
+
+    The store is written to PATH.tmp and moved to path when the writer is
+    closed, so an interrupted writer never leaves a partial store at path
+    """
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path.rstrip('/')
+        self.tmp = self.path + '.tmp'
+        self.chunk_size = chunk_size
+        self.pids = []
+        self.subjects = []
+        self.chunks = 0
+        self.index = {'pids': [], 'chunks': [], 'rows': []}
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, pid, subjects):
+        """ Adds the (tag, value) list of pid """
+        self.pids.append(pid)
+        self.subjects.append(subjects)
+        if len(self.pids) >= self.chunk_size:
+            self._flush()
+
+    def close(self):
+        """ Writes the last chunk and the index, and moves the store into place """
+        self._flush()
+        index = self.index
+        with metrics.phase('serialization', len(index['pids'])):
+            pids = np.array(index['pids'], dtype=str)
+            np.savez(os.path.join(self.tmp, 'index.npz'), pids=pids, chunks=np.array(index['chunks'], dtype=np.int32),
+                     rows=np.array(index['rows'], dtype=np.int32), order=np.argsort(pids, kind='stable'))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp, self.path)
+        logger.info("Wrote tags of %d pids to %s", len(pids), self.path)
+
+    def abort(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _flush(self):
+        if not self.pids:
+            return
+        with metrics.phase('serialization', len(self.pids)):
+            offsets = np.cumsum([0] + [len(s) for s in self.subjects])
+            rows = [row for subjects in self.subjects for row in subjects]
+            np.savez(os.path.join(self.tmp, f"chunk-{self.chunks:06d}.npz"), pids=np.array(self.pids, dtype=str), offsets=offsets,
+                     tags=np.array([t for t, _ in rows], dtype=str), values=np.array([v for _, v in rows]))
+        self.index['pids'].extend(self.pids)
+        self.index['chunks'].extend([self.chunks] * len(self.pids))
+        self.index['rows'].extend(range(len(self.pids)))
+        self.chunks += 1
+        self.pids, self.subjects = [], []
+
+
+class TagStore(Mapping):
+    """ pid -> [(tag, value)] read from a store """
+    def __init__(self, path):
+        self.path = path
+        with np.load(os.path.join(path, 'index.npz')) as f:
+            self.pids = f['pids']
+            self.chunks = f['chunks']
+            self.rows = f['rows']
+            self.order = f['order']
+        self.sorted_pids = self.pids[self.order]
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        for start in range(0, len(self.pids), CHUNK_SIZE):
+            yield from self.pids[start:start + CHUNK_SIZE].tolist()
+
+    def __contains__(self, pid):
+        return self._position(pid) is not None
+
+    def __getitem__(self, pid):
+        i = self._position(pid)
+        if i is None:
+            raise KeyError(pid)
+        return self._subjects(self._chunk(self.chunks[i]), self.rows[i])
+
+    def items(self):
+        """ Yields (pid, [(tag, value)]) in written order, one chunk at a time """
+        for chunk in self.columns():
+            for row, pid in enumerate(chunk['pids'].tolist()):
+                yield pid, self._subjects(chunk, row)
+
+    def columns(self):
+        """ Yields the pids, offsets, tags and values arrays of each chunk in written order """
+        for c in range(int(self.chunks[-1]) + 1 if len(self.chunks) else 0):
+            yield self._load_chunk(c)
+
+    def read(self, pids):
+        """ Returns pid -> [(tag, value)] for the given pids that are in the store, loading each chunk once """
+        with metrics.phase('load tags', len(pids)):
+            positions = [(pid, self._position(pid)) for pid in pids]
+            positions = sorted(((self.chunks[i], self.rows[i], pid) for pid, i in positions if i is not None), key=lambda p: p[:2])
+            return {pid: self._subjects(self._chunk(c), row) for c, row, pid in positions}
+
+    def slice(self, start, stop):
+        """ Returns pid -> [(tag, value)] for the pids written at positions start to stop """
+        return self.read(self.pids[start:stop].tolist())
+
+    def _position(self, pid):
+        i = np.searchsorted(self.sorted_pids, pid)
+        if i < len(self.sorted_pids) and self.sorted_pids[i] == pid:
+            return self.order[i]
+        return None
+
+    def _chunk(self, c):
+        c = int(c)
+        if c in self.cache:
+            self.cache.move_to_end(c)
+            return self.cache[c]
+        chunk = self.cache[c] = self._load_chunk(c)
+        if len(self.cache) > CACHED_CHUNKS:
+            self.cache.popitem(last=False)
+        return chunk
+
+    def _load_chunk(self, c):
+        with np.load(os.path.join(self.path, f"chunk-{c:06d}.npz")) as f:
+            return {k: f[k] for k in ['pids', 'offsets', 'tags', 'values']}
+
+    @staticmethod
+    def _subjects(chunk, row):
+        start, stop = chunk['offsets'][row], chunk['offsets'][row + 1]
+        return list(zip(chunk['tags'][start:stop].tolist(), chunk['values'][start:stop].tolist()))
+
+
+def load(path):
+    """ Opens store """
+    logger.debug("Loading tags from %s", path)
+    return TagStore(path)
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'index.npz'))
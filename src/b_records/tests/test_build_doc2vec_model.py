@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import pytest
+from b_records import build_doc2vec_model
+from b_records import dedup
+from b_records import vectors
+
+
+class RecordingModel():
+    """ Records the learning rate range of each train call, and overwrites alpha and min_alpha like gensim does """
+    def __init__(self, alpha=0.025, min_alpha=0.0001):
+        self.alpha = alpha
+        self.min_alpha = min_alpha
+        self.corpus_count = 0
+        self.corpus_total_words = 0
+        self.calls = []
+
+    def train(self, corpus_file, total_examples, total_words, epochs, start_alpha, end_alpha, callbacks=()):
+        self.calls.append((epochs, start_alpha, end_alpha))
+        self.alpha, self.min_alpha = start_alpha, end_alpha
+
+
+def _alphas(model):
+    return [a for _, start, end in model.calls for a in (start, end)]
+
+
+def test_train_in_chunks_decays_alpha_across_chunks():
+    model = RecordingModel()
+    build_doc2vec_model._train_in_chunks(model, [], 200, checkpoint_every=50)
+
+    assert [epochs for epochs, _, _ in model.calls] == [50, 50, 50, 50]
+    alphas = _alphas(model)
+    assert alphas[0] == 0.025
+    assert all(a >= b for a, b in zip(alphas, alphas[1:]))
+    assert abs(alphas[-1] - 0.0001) < 1e-12
+
+
+def test_train_in_chunks_resumes_alpha_from_state():
+    model = RecordingModel()
+    state = {'done': 0, 'curve': [], 'best': -1, 'best_epoch': 0, 'stale': 0}
+    model.train = _interrupt_after(model.train, 2)
+    try:
+        build_doc2vec_model._train_in_chunks(model, [], 200, checkpoint_every=50, state=state)
+    except KeyboardInterrupt:
+        pass
+
+    resumed = RecordingModel(alpha=model.alpha, min_alpha=model.min_alpha)
+    build_doc2vec_model._train_in_chunks(resumed, [], 200, checkpoint_every=50, state=state)
+
+    assert [epochs for epochs, _, _ in resumed.calls] == [50, 50]
+    alphas = _alphas(resumed)
+    assert abs(alphas[0] - (0.025 - (0.025 - 0.0001) * 100 / 200)) < 1e-12
+    assert all(a >= b for a, b in zip(alphas, alphas[1:]))
+    assert abs(alphas[-1] - 0.0001) < 1e-12
+
+
+def _interrupt_after(train, calls):
+    done = []
+
+    def interrupted(*args, **kwargs):
+        if len(done) == calls:
+            raise KeyboardInterrupt
+        done.append(1)
+        return train(*args, **kwargs)
+    return interrupted
+
+
+@pytest.mark.parametrize('checkpoint_every', [50, None])
+def test_resume_trains_remaining_epochs(tmp_path, checkpoint_every):
+    import joblib
+
+    abstracts_file = str(tmp_path / 'abstracts.pkl')
+    joblib.dump({'870970-basis:1': 'one', '870970-basis:2': 'two'}, abstracts_file)
+    corpus_file = tmp_path / f"tokens-{build_doc2vec_model._corpus_key(abstracts_file, None)}.txt"
+    corpus_file.write_text('870970-basis:1\tone\n870970-basis:2\ttwo\n')
+    prefix = str(tmp_path / 'model')
+    params = {'corpus': corpus_file.name, 'epochs': 200, 'min_count': 2, 'eval_every': None, 'validation_size': 500,
+              'checkpoint_every': checkpoint_every}
+    state = {'done': 150, 'curve': [], 'best': -1, 'best_epoch': 0, 'stale': 0, 'alpha': 0.025, 'min_alpha': 0.0001}
+    build_doc2vec_model._save_checkpoint(RecordingModel(0.007, 0.001), f"{prefix}-300-2.d2v.checkpoint", params, state)
+
+    model = build_doc2vec_model.train(abstracts_file, epochs=200, outfile_prefix=prefix, resume=True)
+
+    assert [epochs for epochs, _, _ in model.calls] == [50]
+    assert abs(model.calls[0][1] - (0.025 - (0.025 - 0.0001) * 150 / 200)) < 1e-12
+    assert abs(model.calls[0][2] - 0.0001) < 1e-12
+    assert not (tmp_path / 'model-300-2.d2v.checkpoint').exists()
+
+
+def test_checkpoint_not_matching_its_state_is_ignored(tmp_path):
+    import joblib
+
+    checkpoint_file = str(tmp_path / 'model.d2v.checkpoint')
+    params = {'corpus': 'tokens.txt', 'epochs': 200, 'checkpoint_every': 50}
+    state = {'done': 100, 'curve': [], 'best': -1, 'best_epoch': 0, 'stale': 0}
+    build_doc2vec_model._save_checkpoint(RecordingModel(), checkpoint_file, params, state)
+    assert build_doc2vec_model._load_checkpoint(checkpoint_file, params)['state'] == state
+
+    # killed after the model of the next checkpoint replaced the file, but before its state
+    joblib.dump(RecordingModel(0.01), checkpoint_file)
+    assert build_doc2vec_model._load_checkpoint(checkpoint_file, params) is None
+
+
+def test_train_tags_documents_with_pids(tmp_path):
+    import joblib
+
+    abstracts = {f"870970-basis:{i}": f"hest ko {'får' if i % 2 else 'gris'} {i}" for i in range(20)}
+    abstracts['870970-basis:20'] = '!'
+    abstracts_file = str(tmp_path / 'abstracts.pkl')
+    joblib.dump(abstracts, abstracts_file)
+
+    model = build_doc2vec_model.train(abstracts_file, emb_size=8, epochs=2, outfile_prefix=None, cache_dir=str(tmp_path))
+
+    assert model.docvecs.offset2doctag == [pid for pid in abstracts if pid != '870970-basis:20']
+    assert model.docvecs.doctags['870970-basis:7'].offset == 7
+    assert len(model.docvecs.vectors_docs) == 20
+
+
+def _abstracts(n, duplicated=0, seed=0):
+    """ n abstracts of random words, the first duplicated of them repeated under other pids """
+    rng = np.random.RandomState(seed)
+    words = [''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), 6)) for _ in range(200)]
+    abstracts = {f"870970-basis:{i}": ' '.join(rng.choice(words, 30)) for i in range(n)}
+    abstracts.update({f"870970-basis:copy-{i}": abstracts[f"870970-basis:{i}"] for i in range(duplicated)})
+    return abstracts
+
+
+def test_update_after_dedup_training_does_not_retrain(tmp_path, monkeypatch):
+    import joblib
+
+    abstracts_file = str(tmp_path / 'abstracts.pkl')
+    joblib.dump(_abstracts(40, duplicated=5), abstracts_file)
+    prefix = str(tmp_path / 'model')
+    build_doc2vec_model.train(abstracts_file, emb_size=8, epochs=2, outfile_prefix=prefix, export_dtype='float32',
+                              dedup_threshold=0.8)
+    model_file = f"{prefix}-8-40.d2v"
+    assert len(build_doc2vec_model._read_hashes(f"{model_file}.hashes.json")) == 45
+    assert os.path.exists(f"{model_file}.clusters.npz")
+
+    def retrain(*args, **kwargs):
+        raise AssertionError('retrained')
+    monkeypatch.setattr(build_doc2vec_model, 'train', retrain)
+
+    build_doc2vec_model.update(abstracts_file, model_file, outfile_prefix=prefix, max_drift=0)
+    build_doc2vec_model.update(abstracts_file, model_file, f"{model_file}.vectors", outfile_prefix=prefix, max_drift=0)
+
+
+def test_update_carries_clusters_and_dedup(tmp_path, monkeypatch):
+    import joblib
+
+    abstracts = _abstracts(40, duplicated=5)
+    abstracts_file = str(tmp_path / 'abstracts.pkl')
+    joblib.dump(abstracts, abstracts_file)
+    prefix = str(tmp_path / 'model')
+    build_doc2vec_model.train(abstracts_file, emb_size=8, epochs=2, outfile_prefix=prefix, dedup_threshold=0.8)
+    model_file = f"{prefix}-8-40.d2v"
+
+    unchanged = build_doc2vec_model.update(abstracts_file, model_file, outfile_prefix=prefix, max_drift=0)
+    assert dedup.load_clusters(os.path.join(unchanged, 'clusters.npz'))[0] == {
+        f"870970-basis:copy-{i}": f"870970-basis:{i}" for i in range(5)}
+    assert len(vectors.load(unchanged).tags) == 40
+
+    abstracts['870970-basis:copy-0'] = _abstracts(1, seed=1)['870970-basis:0']
+    abstracts['870970-basis:new'] = _abstracts(1, seed=2)['870970-basis:0']
+    changed_file = str(tmp_path / 'changed.pkl')
+    joblib.dump(abstracts, changed_file)
+    updated = build_doc2vec_model.update(changed_file, model_file, unchanged, outfile_prefix=prefix)
+    assert dedup.load_clusters(os.path.join(updated, 'clusters.npz'))[0] == {
+        f"870970-basis:copy-{i}": f"870970-basis:{i}" for i in range(1, 5)}
+    assert set(vectors.load(updated).tags) == {f"870970-basis:{i}" for i in range(40)} | {'870970-basis:copy-0',
+                                                                                            '870970-basis:new'}
+
+    retrained = []
+    monkeypatch.setattr(build_doc2vec_model, 'train', lambda *args, **kwargs: retrained.append(kwargs))
+    assert build_doc2vec_model.update(changed_file, model_file, outfile_prefix=prefix, max_drift=0, export_dtype=None) is None
+    assert retrained == [{'dedup_threshold': 0.8}]
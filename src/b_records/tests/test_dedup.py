@@ -0,0 +1,21 @@
+from b_records import dedup
+
+WORDS = 'den lille pige med svovlstikkerne frøs på nytårsaften i den kolde by hvor ingen ville købe'.split()
+
+
+def test_dedup_clusters_near_duplicates(tmp_path):
+    corpus_file = tmp_path / 'tokens.txt'
+    lines = [('870970-basis:book', WORDS + ['roman']),
+             ('870970-basis:ebook', WORDS),
+             ('870970-basis:audiobook', WORDS + ['lydbog', 'roman']),
+             ('870970-basis:other', 'en helt anden historie om en hund der bor på landet med sin familie'.split())]
+    corpus_file.write_text(''.join(f"{pid}\t{' '.join(tokens)}\n" for pid, tokens in lines), encoding='utf-8')
+
+    deduped_file, clusters_file = dedup.dedup(str(corpus_file), threshold=0.7, workers=1)
+    clusters, stats = dedup.load_clusters(clusters_file)
+
+    assert clusters == {'870970-basis:book': '870970-basis:audiobook', '870970-basis:ebook': '870970-basis:audiobook'}
+    with open(deduped_file, encoding='utf-8') as f:
+        assert [line.partition('\t')[0] for line in f] == ['870970-basis:audiobook', '870970-basis:other']
+    assert stats['representatives'] == 2
+    assert dedup.dedup(str(corpus_file), threshold=0.7, workers=1) == (deduped_file, clusters_file)
@@ -0,0 +1,184 @@
+from collections import defaultdict
+import os
+import numpy as np
+import pytest
+from b_records import benchmark
+from b_records import dedup
+from b_records import generate_subjects
+from b_records import tag_store
+from b_records import vectors
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """ Vector store and archive of a synthetic corpus of 600 pids in 10 topics, 10% of them content-first pids """
+    metadata, tag_archive, topic = benchmark.corpus(600, topics=10, vocabulary=500)
+    pids = list(metadata)
+    docvecs = benchmark.topic_vectors(topic, dim=32)
+    archive_file = str(tmp_path / 'archive.txt')
+    benchmark.write_archive(tag_archive, archive_file)
+    store = str(tmp_path / 'vectors')
+    vectors.export(pids, docvecs, store)
+    return store, archive_file, pids, docvecs, tag_archive
+
+
+def _brute_force(pids, docvecs, pid2tags, min_similarity, by_value):
+    """ Tags of each untagged pid from the similarity to every content-first pid, as the first version of generate_tags """
+    normalized = docvecs / np.linalg.norm(docvecs, axis=1, keepdims=True)
+    result = {}
+    for i, pid in enumerate(pids):
+        if pid in pid2tags:
+            continue
+        values = defaultdict(float)
+        for j, other in enumerate(pids):
+            similarity = float(normalized[i] @ normalized[j])
+            if other in pid2tags and similarity > min_similarity:
+                for tag in pid2tags[other]:
+                    values[tag] += similarity if by_value else 1
+        if values:
+            result[pid] = dict(values)
+    return result
+
+
+def _as_dicts(tags):
+    return {pid: {str(tag): value for tag, value in subjects} for pid, subjects in tags.items()}
+
+
+@pytest.mark.parametrize('by_value', [False, True])
+def test_exact_matches_brute_force(corpus, by_value):
+    store, archive_file, pids, docvecs, tag_archive = corpus
+
+    generated = generate_subjects.generate_tags(store, archive_file, by_value=by_value, block_size=64)
+    expected = _brute_force(pids, docvecs, tag_archive, 0.45, by_value)
+
+    assert expected
+    assert generated.keys() == expected.keys()
+    for pid, subjects in generated.items():
+        assert dict(subjects) == pytest.approx(expected[pid], rel=1e-4)
+        values = [value for _, value in subjects]
+        assert values == sorted(values, reverse=True)
+
+
+def test_exact_matches_most_similar(corpus, tmp_path):
+    """ Tags of a pickled doc2vec model match the per-pid most_similar scan that generate_tags replaced """
+    import joblib
+    from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+
+    store, archive_file, pids, docvecs, tag_archive = corpus
+    model = Doc2Vec([TaggedDocument(['ord'], [pid]) for pid in pids], vector_size=docvecs.shape[1], min_count=1, epochs=1)
+    model.docvecs.vectors_docs[:] = docvecs
+    model_file = str(tmp_path / 'model.d2v')
+    joblib.dump(model, model_file)
+
+    expected = {}
+    for i, pid in enumerate(pids):
+        if pid not in tag_archive:
+            values = defaultdict(int)
+            for other, similarity in model.docvecs.most_similar(positive=[model.docvecs[i]], topn=len(pids)):
+                if other in tag_archive and similarity > 0.45:
+                    for tag in tag_archive[other]:
+                        values[tag] += 1
+            if values:
+                expected[pid] = dict(values)
+
+    generated = generate_subjects.generate_tags(model_file, archive_file)
+
+    assert generated.keys() == expected.keys()
+    assert {pid: dict(subjects) for pid, subjects in generated.items()} == expected
+
+
+def test_incremental_matches_full_run(corpus, tmp_path):
+    store, archive_file, pids, docvecs, tag_archive = corpus
+    state_file = str(tmp_path / 'state.npz')
+    generate_subjects.generate_tags(store, archive_file, state_file=state_file, block_size=64)
+
+    changed = docvecs.copy()
+    rng = np.random.default_rng(1)
+    untagged = [i for i, pid in enumerate(pids) if pid not in tag_archive]
+    tagged = [i for i, pid in enumerate(pids) if pid in tag_archive]
+    for i in list(rng.choice(untagged, 20, replace=False)) + list(rng.choice(tagged, 3, replace=False)):
+        changed[i] = docvecs[rng.integers(len(pids))]
+    changed_store = str(tmp_path / 'changed-vectors')
+    vectors.export(pids + ['870970-basis:new'], np.concatenate([changed, docvecs[:1]]), changed_store)
+
+    incremental = generate_subjects.generate_tags(changed_store, archive_file, state_file=state_file, block_size=64)
+    full = generate_subjects.generate_tags(changed_store, archive_file, block_size=64)
+
+    assert incremental.keys() == full.keys()
+    for pid, subjects in full.items():
+        assert dict(incremental[pid]) == pytest.approx(dict(subjects), rel=1e-4)
+
+    with pytest.raises(ValueError):
+        generate_subjects.generate_tags(changed_store, archive_file, state_file=state_file, workers=2)
+
+
+def test_resume_matches_uninterrupted_run(corpus, tmp_path, monkeypatch):
+    store, archive_file, _, _, _ = corpus
+    expected = generate_subjects.generate_tags(store, archive_file, block_size=32)
+    prefix = str(tmp_path / 'predicted-tags')
+    write = tag_store.Writer.write
+    written = []
+
+    def interrupted(writer, pid, subjects):
+        if len(written) == len(expected) // 2:
+            raise KeyboardInterrupt
+        written.append(pid)
+        write(writer, pid, subjects)
+
+    monkeypatch.setattr(tag_store.Writer, 'write', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        generate_subjects.generate_tags(store, archive_file, prefix, block_size=32, checkpoint_every=1)
+    monkeypatch.undo()
+    assert os.listdir(f"{prefix}.partial")
+
+    resumed = generate_subjects.generate_tags(store, archive_file, prefix, block_size=32, checkpoint_every=1, resume=True)
+
+    assert resumed == expected
+    assert not os.path.exists(f"{prefix}.partial")
+
+
+def test_workers_and_shards_match_single_run(corpus, tmp_path):
+    store, archive_file, _, _, _ = corpus
+    expected = generate_subjects.generate_tags(store, archive_file, block_size=64)
+
+    assert generate_subjects.generate_tags(store, archive_file, block_size=64, workers=2) == expected
+
+    prefix = str(tmp_path / 'predicted-tags')
+    shard_files = []
+    for i in range(3):
+        generate_subjects.generate_tags(store, archive_file, prefix, block_size=64, shard=(i, 3), output_format='store')
+        shard_files.append(f"{prefix}-shard-{i}-of-3.tags")
+        assert not os.path.exists(f"{prefix}-shard-{i}-of-3.tag-index")
+    merged = generate_subjects.merge_shards(shard_files, str(tmp_path / 'merged'))
+
+    assert _as_dicts(merged) == _as_dicts(expected)
+    assert os.path.exists(str(tmp_path / f"merged-{len(expected)}.pkl"))
+    assert os.path.exists(str(tmp_path / 'merged.tag-index'))
+    assert _as_dicts(generate_subjects.merge_shards(shard_files, None)) == _as_dicts(expected)
+
+
+def test_dedup_fans_out_cluster_tags(corpus, tmp_path):
+    store, archive_file, pids, docvecs, tag_archive = corpus
+    untagged = [pid for pid in pids if pid not in tag_archive]
+    tagged = [pid for pid in pids if pid in tag_archive]
+    # untagged members of untagged and tagged representatives, and a tagged member
+    clusters = {untagged[1]: untagged[0], untagged[2]: untagged[0], untagged[4]: tagged[0], untagged[5]: tagged[0],
+                tagged[1]: untagged[3]}
+    index = {pid: i for i, pid in enumerate(pids)}
+    duplicated = docvecs.copy()
+    for member, representative in clusters.items():
+        duplicated[index[member]] = docvecs[index[representative]]
+    full_store = str(tmp_path / 'full-vectors')
+    vectors.export(pids, duplicated, full_store)
+    kept = [i for i, pid in enumerate(pids) if pid not in clusters]
+    deduped_store = str(tmp_path / 'deduped-vectors')
+    vectors.export([pids[i] for i in kept], docvecs[kept], deduped_store)
+    dedup.save_clusters(os.path.join(deduped_store, 'clusters.npz'), clusters)
+
+    fanned = generate_subjects.generate_tags(deduped_store, archive_file)
+    expected = generate_subjects.generate_tags(full_store, archive_file)
+
+    assert fanned.keys() == expected.keys()
+    for pid, subjects in expected.items():
+        assert dict(fanned[pid]) == pytest.approx(dict(subjects), rel=1e-4)
+    assert fanned[untagged[1]] == fanned[untagged[0]]
@@ -0,0 +1,156 @@
+import json
+import os
+import uuid
+import numpy as np
+import pytest
+from b_records import archive
+from b_records import benchmark
+from b_records import db
+from b_records import get_abstract
+from b_records.abstract_store import AbstractStore
+
+TEST_URL = os.environ.get('B_RECORDS_TEST_DB_URL')
+
+
+def _metadata(abstract, type=('Bog',), dk5=('sk',)):
+    return {'abstract': [abstract], 'collection': ['870970-basis'], 'audience': ['voksenmaterialer'], 'language': ['dan'],
+            'type': list(type), 'dk5': list(dk5)}
+
+
+ROWS = {f"870970-basis:{i}": _metadata(f"Abstract number {i} " + 'x' * 100) for i in range(40)}
+ROWS['870970-basis:film'] = _metadata('A film ' + 'x' * 100, type=('Film (dvd)',), dk5=('77.7',))
+ROWS['870970-basis:short'] = _metadata('Too short')
+ROWS['870970-basis:compass'] = _metadata('Short', type=('Film (dvd)',))
+ROWS['870970-basis:scalar'] = dict(_metadata('Scalar type and dk5 ' + 'x' * 100), type='Bog', dk5='sk')
+ROWS['870970-basis:scalar-film'] = dict(_metadata('Scalar film ' + 'x' * 100), type='Film (dvd)', dk5=None)
+ROWS['870970-basis:scalar-abstract'] = dict(_metadata(''), abstract='Scalar abstract ' + 'x' * 100)
+ROWS['870970-basis:missing'] = {k: v for k, v in _metadata('No type ' + 'x' * 100).items() if k != 'type'}
+
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    """ B_RECORDS_TEST_DB_URL (a postgres:// url), or a throwaway server started by pgserver if it is installed """
+    if TEST_URL:
+        yield TEST_URL
+        return
+    pgserver = pytest.importorskip('pgserver', reason='B_RECORDS_TEST_DB_URL is not set and pgserver is not installed')
+    server = pgserver.get_server(str(tmp_path_factory.mktemp('pgdata')), cleanup_mode='stop')
+    yield server.get_uri()
+    server.cleanup()
+
+
+@pytest.fixture
+def lowell(postgres_url, monkeypatch):
+    """ Postgres schema with a metadata table holding ROWS, used as LOWELL """
+    import psycopg2
+
+    schema = f"b_records_test_{uuid.uuid4().hex[:8]}"
+    conn = psycopg2.connect(postgres_url)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"CREATE TABLE {schema}.metadata (pid TEXT PRIMARY KEY, metadata JSONB NOT NULL)")
+        cur.executemany(f"INSERT INTO {schema}.metadata VALUES (%s, %s)", [(p, json.dumps(m)) for p, m in ROWS.items()])
+    monkeypatch.setenv('LOWELL_URL', f"{postgres_url}{'&' if '?' in postgres_url else '?'}options=-csearch_path%3D{schema}")
+    try:
+        yield schema
+    finally:
+        db.close_pools()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.close()
+
+
+@pytest.fixture
+def archive_file(tmp_path):
+    tagged = archive.Archive(['870970-basis:compass'], np.array([0, 1]), np.array([0], dtype=np.int32), ['tag'], {'tag': 'tag'})
+    path = str(tmp_path / 'archive.txt')
+    benchmark.write_archive(tagged, path)
+    return path
+
+
+EXPECTED = {pid for pid in ROWS if pid not in ('870970-basis:film', '870970-basis:short', '870970-basis:scalar-film',
+                                              '870970-basis:missing')}
+
+
+@pytest.mark.parametrize('parallel', [1, db.MAXCONN + 2])
+def test_get_abstracts(lowell, archive_file, parallel):
+    abstracts = get_abstract.get_abstracts(archive_file, outfile_prefix=None, parallel=parallel)
+
+    assert set(abstracts) == EXPECTED
+    assert abstracts['870970-basis:3'] == ROWS['870970-basis:3']['abstract'][0]
+    assert abstracts['870970-basis:scalar-abstract'] == ROWS['870970-basis:scalar-abstract']['abstract']
+
+
+def test_harvest_more_partitions_than_default_pool(lowell, archive_file, tmp_path):
+    store_file = str(tmp_path / 'abstracts.sqlite')
+
+    assert get_abstract.harvest(archive_file, store_file, parallel=db.MAXCONN + 2) == (len(EXPECTED), 0, 0)
+    with AbstractStore(store_file) as store:
+        assert set(store.abstracts()) == EXPECTED
+    assert get_abstract.harvest(archive_file, store_file, parallel=db.MAXCONN + 2) == (0, 0, 0)
+
+
+class RecordingCursor():
+    """ db.Cursor that records the statements executed and returns no rows """
+    executed = []
+
+    def __init__(self, *args, maxconn=db.MAXCONN, **kwargs):
+        self.maxconn = maxconn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, stmt, params):
+        self.executed.append((stmt, params, self.maxconn))
+
+    def __iter__(self):
+        return iter(())
+
+
+def test_partitions_statement(monkeypatch):
+    monkeypatch.setattr(db, 'Cursor', RecordingCursor)
+    monkeypatch.setattr(RecordingCursor, 'executed', [])
+    parallel = db.MAXCONN + 2
+
+    assert get_abstract._get_abstracts_parallel(['870970-basis:1'], limit=100, min_length=50, parallel=parallel) == []
+
+    executed = sorted(RecordingCursor.executed, key=lambda e: e[1]['partition'])
+    assert [params['partition'] for _, params, _ in executed] == list(range(parallel))
+    for stmt, params, maxconn in executed:
+        assert "mod(hashtext(pid)::bigint + 2147483648, %(partitions)s) = %(partition)s" in stmt
+        assert params == {'compass_pids': ['870970-basis:1'], 'min_length': 50, 'partition': params['partition'],
+                          'partitions': parallel, 'limit': -(-100 // parallel)}
+        assert maxconn == parallel
+        for field in ('type', 'dk5'):
+            assert f"jsonb_array_elements_text({get_abstract._as_array(field)})" in stmt
+        assert f"length({get_abstract._first('abstract')})" in stmt
+        assert "metadata->'abstract'->>0" not in stmt
+
+
+class FakePool():
+    """ ThreadedConnectionPool that records whether it was closed """
+    def __init__(self, minconn, maxconn, url):
+        self.maxconn = maxconn
+        self.closed = False
+
+    def closeall(self):
+        self.closed = True
+
+
+def test_growing_pool_keeps_replaced_pool_open(monkeypatch):
+    pool = pytest.importorskip('psycopg2.pool')
+    monkeypatch.setattr(pool, 'ThreadedConnectionPool', FakePool)
+    url = 'postgres://test/growing'
+
+    small = db._pool(url, db.MAXCONN)
+    assert db._pool(url, db.MAXCONN - 1) is small
+    large = db._pool(url, db.MAXCONN + 2)
+
+    assert large.maxconn == db.MAXCONN + 2
+    assert not small.closed
+    db.close_pools()
+    assert small.closed and large.closed
@@ -0,0 +1,36 @@
+import contextlib
+import io
+import pytest
+from b_records import benchmark
+from b_records import report
+from b_records import tag_store
+
+TAGS = {f"870970-basis:{i}": [('0', 1.0)] for i in range(25)}
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    """ Pages of pids whose metadata is fetched by make_report, instead of fetching it from LOWELL """
+    pages = []
+    monkeypatch.setattr(report.db, 'Cursor', contextlib.nullcontext)
+    monkeypatch.setattr(report, 'get_metadata', lambda cur, pids: pages.append(pids) or {})
+    return pages
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_report_pages_limited_pids(tmp_path, fetched, shuffle):
+    tagged = benchmark.corpus(20)[1]
+    archive_file = str(tmp_path / 'archive.txt')
+    benchmark.write_archive(tagged, archive_file)
+    path = str(tmp_path / 'predicted.tags')
+    with tag_store.Writer(path, chunk_size=4) as writer:
+        for pid, subjects in TAGS.items():
+            writer.write(pid, subjects)
+
+    report.make_report(path, archive_file, limit=7, shuffle=shuffle, output_format='text', out=io.StringIO(), page_size=3)
+
+    assert [len(page) for page in fetched] == [3, 3, 1]
+    pids = [pid for page in fetched for pid in page]
+    assert len(set(pids)) == 7 and set(pids) <= TAGS.keys()
+    if not shuffle:
+        assert pids == list(TAGS)[:7]
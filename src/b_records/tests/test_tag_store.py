@@ -0,0 +1,62 @@
+import pytest
+from b_records import tag_index
+from b_records import tag_store
+
+TAGS = {f"870970-basis:{i}": [(f"tag {t}", float(i % 7 + t)) for t in range(1 + i % 4)] for i in range(25)}
+
+
+def _write(path, tags, chunk_size=4):
+    with tag_store.Writer(path, chunk_size=chunk_size) as writer:
+        for pid, subjects in tags.items():
+            writer.write(pid, subjects)
+    return tag_store.load(path)
+
+
+def test_store_round_trip(tmp_path):
+    store = _write(str(tmp_path / 'predicted.tags'), TAGS)
+
+    assert tag_store.is_store(str(tmp_path / 'predicted.tags'))
+    assert len(store) == len(TAGS)
+    assert list(store) == list(TAGS)
+    assert dict(store.items()) == TAGS
+    assert {pid: store[pid] for pid in reversed(list(TAGS))} == TAGS
+    assert store.read(['870970-basis:9', '870970-basis:unknown', '870970-basis:2']) == \
+        {'870970-basis:9': TAGS['870970-basis:9'], '870970-basis:2': TAGS['870970-basis:2']}
+    assert store.slice(5, 10) == {pid: TAGS[pid] for pid in list(TAGS)[5:10]}
+    assert '870970-basis:unknown' not in store
+    with pytest.raises(KeyError):
+        store['870970-basis:unknown']
+
+
+def test_aborted_writer_leaves_no_store(tmp_path):
+    path = str(tmp_path / 'predicted.tags')
+    with pytest.raises(RuntimeError):
+        with tag_store.Writer(path, chunk_size=4) as writer:
+            for pid, subjects in TAGS.items():
+                writer.write(pid, subjects)
+            raise RuntimeError
+
+    assert not tag_store.is_store(path)
+    assert not (tmp_path / 'predicted.tags.tmp').exists()
+
+
+@pytest.mark.parametrize('source', ['dict', 'store'])
+def test_index_round_trip(tmp_path, source):
+    tags = TAGS if source == 'dict' else _write(str(tmp_path / 'predicted.tags'), TAGS)
+    index = tag_index.load(tag_index.build(tags, str(tmp_path / 'predicted.tag-index')))
+
+    postings = {}
+    for pid, subjects in TAGS.items():
+        assert index.subjects(pid) == subjects
+        for tag, value in subjects:
+            postings.setdefault(tag, []).append((pid, value))
+    assert sorted(index) == sorted(postings)
+    for tag, expected in postings.items():
+        assert index.lookup(tag) == sorted(expected, key=lambda p: (-p[1], p[0]))
+        assert index.count(tag, min_value=4) == sum(1 for _, value in expected if value >= 4)
+        assert index.top(tag, 2) == index.lookup(tag)[:2]
+    both = {pid: dict(TAGS[pid]) for pid in TAGS if {'tag 1', 'tag 2'} <= dict(TAGS[pid]).keys()}
+    assert index.intersect(['tag 1', 'tag 2']) == sorted(((pid, values['tag 1'] + values['tag 2']) for pid, values in both.items()),
+                                                         key=lambda p: (-p[1], p[0]))
+    assert index.lookup('unknown') == []
+    assert index.subjects('870970-basis:unknown') is None
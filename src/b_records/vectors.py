@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -*- mode: python -*-
+"""
+:mod:`b_records.vectors` -- Document vector store
+
+=====================
+Document Vector Store
+=====================
+
+Stores the doc tags and unit length docvecs of a doc2vec model in a
+directory that can be memory mapped, so stages that only need the
+document vectors do not have to unpickle the whole model.
+
+The directory holds
+
+* `tags.json` -- the doc tag of each row
+* `vectors.npy` -- float32, float16 or int8 matrix of docvecs
+* `scale.npy` -- per row scale of the int8 matrix
+
+float32 vectors are used directly from the mapped file. float16 and int8
+vectors are converted to float32 when read.
+"""
+import json
+import logging
+import os
+import shutil
+import numpy as np
+from b_records import metrics
+logger = logging.getLogger(__name__)
+
+DTYPES = ['float32', 'float16', 'int8']
+
+
+class DocVectors():
+    """ Doc tags and memory mapped docvecs """
+    def __init__(self, tags, vectors, scale=None):
+        self.tags = tags
+        self.vectors = vectors
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.tags)
+
+    def matrix(self, rows=None):
+        """
+        Returns float32 docvecs
+
+        :param rows:
+            If given, only these rows are returned
+        """
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        if vectors.dtype == np.float32:
+            return vectors
+        vectors = vectors.astype(np.float32)
+        if self.scale is not None:
+            vectors *= (self.scale if rows is None else self.scale[rows])[:, None]
+        return vectors
+
+
+def export(tags, vectors, path, dtype='float32'):
+    """
+    Writes vector store
+
+    :param tags:
+        doc tag of each vector
+    :param vectors:
+        docvecs. They are scaled to unit length before they are written
+    :param path:
+        directory to write store to
+    :param dtype:
+        one of float32, float16 or int8
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}. Must be one of {DTYPES}")
+    with metrics.phase('export vectors', len(vectors)):
+        _export(tags, vectors, path, dtype)
+
+
+def _export(tags, vectors, path, dtype):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors = vectors / norms
+
+    tmp = path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with open(os.path.join(tmp, 'tags.json'), 'w') as f:
+        json.dump(list(tags), f)
+    if dtype == 'int8':
+        scale = np.abs(vectors).max(axis=1) / 127
+        scale[scale == 0] = 1
+        np.save(os.path.join(tmp, 'scale.npy'), scale.astype(np.float32))
+        vectors = np.round(vectors / scale[:, None]).astype(np.int8)
+    np.save(os.path.join(tmp, 'vectors.npy'), vectors.astype(dtype))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    logger.info("Wrote %d %s vectors to %s", len(vectors), dtype, path)
+
+
+def export_model(model, path, dtype='float32'):
+    """ Writes vector store with the docvecs of a doc2vec model """
+    tags = [model.docvecs.offset2doctag[i] for i in range(len(model.docvecs))]
+    export(tags, model.docvecs.vectors_docs, path, dtype)
+
+
+def load(path):
+    """ Opens vector store with the vectors memory mapped """
+    logger.debug("Loading vectors from %s", path)
+    with open(os.path.join(path, 'tags.json')) as f:
+        tags = json.load(f)
+    vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    scale = None
+    if os.path.exists(os.path.join(path, 'scale.npy')):
+        scale = np.load(os.path.join(path, 'scale.npy'))
+    return DocVectors(tags, vectors, scale)
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'vectors.npy'))
+
+
+def cli():
+    """ Commandline interface """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export docvecs of doc2vec model to memory mappable vector store')
+    parser.add_argument('model_file',
+                        help='file containing doc2vec model')
+    parser.add_argument('-o', '--outfile',
+                        help='directory to write vectors to. Default is MODEL_FILE.vectors', default=None)
+    parser.add_argument('-d', '--dtype', choices=DTYPES,
+                        help='type of stored vectors. Default is float32', default='float32')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='verbose output')
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=level)
+
+    import joblib
+    export_model(joblib.load(args.model_file), args.outfile or f"{args.model_file}.vectors", args.dtype)